@@ -1,16 +1,28 @@
-import os, re, json, sqlite3, time, random, asyncio, threading
+import os, re, sys, json, sqlite3, time, random, asyncio, threading, contextlib, hashlib, copy, queue, atexit, bisect, functools
+import logging, logging.handlers
+from array import array
+from collections import Counter, OrderedDict, deque
 from typing import List, Optional, Dict, Any, Tuple
 
 import httpx
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
+from storage import Storage
+from lsh import MinHashLSH
+from mem_snapshot import MemSnapshot, open_snapshot, write_snapshot
+import mem_embed
+from stage_model import load_model as load_stage_model
+from commit_store import COMMIT_STORE as COMMIT_STORE_KIND, CommitStore, open_commit_store, migrate_if_empty
+
 # ================== ENV ==================
 load_dotenv(override=True)
 OPENAI_API_KEY = (os.getenv("OPENAI_API_KEY") or "").strip()
-if not OPENAI_API_KEY:
+OPENAI_BASE_URL = os.getenv("QR_OPENAI_BASE", "https://api.openai.com/v1").rstrip("/")  # point at fake_openai.py for offline runs
+if not OPENAI_API_KEY and "api.openai.com" in OPENAI_BASE_URL:
     raise RuntimeError("OPENAI_API_KEY not set")
 
 MODEL        = os.getenv("QR_MODEL", "gpt-4o-mini")
@@ -19,11 +31,33 @@ MAX_TOKENS   = int(os.getenv("QR_MAX_TOKENS", "220"))
 USER_NAME    = os.getenv("QUICKRIZZ_NAME", "Wingman").strip()
 USER_STYLE   = os.getenv("QUICKRIZZ_STYLE", "playful, concise, confident, flirty").strip()
 CONTEXT_WINDOW = 10 # how many prior messages to consider
+PIPELINE_MODE  = os.getenv("QR_PIPELINE", "split")  # "split" = stage/idea/generate calls, "fused" = one call
 # anti-429 controls
-MIN_INTERVAL_MS   = int(os.getenv("QR_MIN_INTERVAL_MS", "2500"))
 MAX_RETRIES       = int(os.getenv("QR_MAX_RETRIES", "4"))
 BACKOFF_BASE_SEC  = float(os.getenv("QR_BACKOFF_BASE", "0.9"))
 BACKOFF_CAP_SEC   = float(os.getenv("QR_BACKOFF_CAP", "8.0"))
+# upstream rate limiter (token buckets sized to the account's limits)
+LIMIT_RPM         = float(os.getenv("QR_LIMIT_RPM", "500"))        # requests per minute
+LIMIT_TPM         = float(os.getenv("QR_LIMIT_TPM", "200000"))     # tokens per minute
+LIMIT_BURST_SEC   = float(os.getenv("QR_LIMIT_BURST_SEC", "10"))   # bucket size = this many seconds of rate
+LIMIT_CONCURRENCY = int(os.getenv("QR_LIMIT_CONCURRENCY", "8"))    # max in-flight upstream calls
+LIMIT_MIN_SCALE   = float(os.getenv("QR_LIMIT_MIN_SCALE", "0.1"))  # never adapt below 10% of configured rate
+# hedged upstream calls (a duplicate races a slow call; both go through the limiter)
+HEDGE_ENABLE      = os.getenv("QR_HEDGE", "0") == "1"
+HEDGE_PCT         = float(os.getenv("QR_HEDGE_PCT", "95"))         # fire the duplicate at this percentile of recent latency
+HEDGE_MIN_SEC     = float(os.getenv("QR_HEDGE_MIN_SEC", "1.0"))    # ...but never sooner than this
+HEDGE_BUDGET      = float(os.getenv("QR_HEDGE_BUDGET", "0.05"))    # duplicates allowed per upstream call (5% extra quota)
+HEDGE_WINDOW      = int(os.getenv("QR_HEDGE_WINDOW", "200"))       # recent successful latencies kept
+HEDGE_MIN_SAMPLES = int(os.getenv("QR_HEDGE_MIN_SAMPLES", "20"))   # no hedging until this many are observed
+# shared upstream HTTP client (pooled, keep-alive)
+HTTP_HTTP2        = os.getenv("QR_HTTP2", "0") == "1"              # needs the h2 package
+HTTP_MAX_CONN     = int(os.getenv("QR_HTTP_MAX_CONN", "20"))
+HTTP_MAX_KEEPALIVE= int(os.getenv("QR_HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_SEC= float(os.getenv("QR_HTTP_KEEPALIVE_SEC", "30"))
+HTTP_CONNECT_SEC  = float(os.getenv("QR_HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_SEC     = float(os.getenv("QR_HTTP_READ_TIMEOUT", "18"))
+HTTP_WRITE_SEC    = float(os.getenv("QR_HTTP_WRITE_TIMEOUT", "10"))
+HTTP_POOL_SEC     = float(os.getenv("QR_HTTP_POOL_TIMEOUT", "5"))
 
 # ===== Memory knobs =====
 MEM_ENABLE         = os.getenv("QR_MEM_ENABLE", "1") == "1"
@@ -32,12 +66,355 @@ MEM_MIN_JACCARD    = float(os.getenv("QR_MEM_MIN_JACCARD", "0.22"))# similarity
 MEM_MIN_LEN        = int(os.getenv("QR_MEM_MIN_LEN", "6"))         # ignore very short inputs
 MEM_PREF_LIKED     = os.getenv("QR_MEM_PREF_LIKED", "1") == "1"    # prefer rating == "Y"
 MEM_MERGE_LIMIT    = int(os.getenv("QR_MEM_MERGE_LIMIT", "3"))     # how many memory lines to inject
+MEM_BACKEND        = os.getenv("QR_MEM_BACKEND", "postings").lower() # "postings" (inverted lists) | "lsh" (MinHash)
+MEM_LSH_BANDS      = int(os.getenv("QR_MEM_LSH_BANDS", "32"))      # more bands = higher recall, more candidates
+MEM_LSH_ROWS       = int(os.getenv("QR_MEM_LSH_ROWS", "2"))        # more rows = stricter buckets
+MEM_LSH_SEED       = int(os.getenv("QR_MEM_LSH_SEED", "1"))
+MEM_SNAPSHOT_PATH  = os.getenv("QR_MEM_SNAPSHOT", "qr_mem.snap")  # mmap'd index snapshot; "" = always build in memory
+MEM_WATCH_SEC      = float(os.getenv("QR_MEM_WATCH_SEC", "5"))     # poll the commit store for outside changes; 0 = off
+MEM_RETRIEVAL      = os.getenv("QR_MEM_RETRIEVAL", "jaccard").lower() # "jaccard" (word trigrams) | "embed" (char n-gram TF-IDF, needs numpy)
+MEM_EMBED_DIM      = int(os.getenv("QR_MEM_EMBED_DIM", "512"))     # vector width; each key costs 4*dim bytes
+MEM_EMBED_MIN_SIM  = float(os.getenv("QR_MEM_EMBED_MIN_SIM", "0.6"))# cosine threshold for embed retrieval
+
+# ===== /suggest response cache =====
+CACHE_ENABLE       = os.getenv("QR_CACHE_ENABLE", "1") == "1"
+CACHE_SIZE         = int(os.getenv("QR_CACHE_SIZE", "512"))         # max cached responses (LRU)
+CACHE_TTL_SEC      = float(os.getenv("QR_CACHE_TTL_SEC", "120"))    # entries older than this are recomputed
+
+# ===== Request coalescing (single-flight) =====
+COALESCE_ENABLE    = os.getenv("QR_COALESCE", "1") == "1"          # share identical in-flight /suggest + LLM calls
+
+# ===== Local stage classifier (see stage_model.py) =====
+STAGE_MODEL_PATH     = os.getenv("QR_STAGE_MODEL", "qr_stage_model.json")   # trained artifact; missing = always ask the LLM
+STAGE_LOCAL_MIN_CONF = os.getenv("QR_STAGE_LOCAL_MIN_CONF", "auto")          # answer locally at or above this; "auto" = the threshold training validated
+
+# ===== Prompt assembly =====
+PROMPT_HISTORY_TOKENS = int(os.getenv("QR_PROMPT_HISTORY_TOKENS", "800"))  # generate HISTORY cut (oldest first) to fit; 0 = whole window
+
+# ===== Per-thread sessions (clients may send only new messages) =====
+SESSION_ENABLE     = os.getenv("QR_SESSIONS", "1") == "1"          # keep state per (site, thread) when the request names a thread
+SESSION_SIZE       = int(os.getenv("QR_SESSION_SIZE", "2048"))      # threads kept in memory (LRU)
+SESSION_TTL_SEC    = float(os.getenv("QR_SESSION_TTL_SEC", "1800")) # idle threads are forgotten after this
+SESSION_PERSIST    = os.getenv("QR_SESSION_PERSIST", "0") == "1"   # also keep them in SQLite (restarts, other workers)
+
+# ===== Idea memo (reuse a thread's idea until the conversation moves) =====
+IDEA_MEMO_ENABLE   = os.getenv("QR_IDEA_MEMO", "1") == "1"          # kept on the thread's session; no session = always ask
+IDEA_MAX_REUSE     = int(os.getenv("QR_IDEA_MAX_REUSE", "4"))       # recompute after this many reuses in a row
+IDEA_MIN_OVERLAP   = float(os.getenv("QR_IDEA_MIN_OVERLAP", "0.5")) # share of the window's words the idea's window had
 
 # ===== Default heat floor =====
 MIN_SPICE_FLOOR    = int(os.getenv("QR_MIN_SPICE_FLOOR", "2"))     # 0–3; assume flirty by default
+CUE_CACHE_SIZE     = int(os.getenv("QR_CUE_CACHE", "4096"))        # per-message cue scan results kept (LRU)
+
+# ================== LOGGING ==================
+# Records are queued and formatted on a background thread, so the hot path never blocks on
+# stdout and debug payloads (passed as `extra={"data": ...}`) are only serialized when emitted.
+#   QR_LOG_LEVEL=INFO                      default level for every component
+#   QR_LOG_LEVELS=rank=DEBUG,openai=WARNING per-component overrides (mem, spice, rank, openai, ...)
+#   QR_LOG_SAMPLE=suggest=0.1,rank=0.05     keep this fraction of sub-WARNING records per component
+#   QR_LOG_RATE=50                          max sub-WARNING records/sec per component (0 = unlimited)
+#   QR_LOG_JSON=1                           one JSON object per line; 0 = "[QR][component] msg {...}"
+LOG_LEVEL      = os.getenv("QR_LOG_LEVEL", "INFO").upper()
+LOG_JSON       = os.getenv("QR_LOG_JSON", "1") == "1"
+LOG_RATE       = float(os.getenv("QR_LOG_RATE", "0"))
+LOG_QUEUE_SIZE = int(os.getenv("QR_LOG_QUEUE_SIZE", "10000"))
+
+def _parse_kv(spec: str) -> Dict[str, str]:
+    out = {}
+    for part in (spec or "").split(","):
+        k, _, v = part.partition("=")
+        if k.strip() and v.strip():
+            out[k.strip()] = v.strip()
+    return out
+
+LOG_LEVELS = {k: v.upper() for k, v in _parse_kv(os.getenv("QR_LOG_LEVELS", "")).items()}
+LOG_SAMPLE = {k: float(v) for k, v in _parse_kv(os.getenv("QR_LOG_SAMPLE", "")).items()}
+LOG_DROPPED: Dict[Tuple[str, str], int] = {}   # (component, reason) -> count; exported on /metrics
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        out = {"ts": round(record.created, 3), "level": record.levelname.lower(),
+               "component": record.name.split(".", 1)[-1], "msg": record.getMessage()}
+        data = getattr(record, "data", None)
+        if data is not None:
+            out["data"] = data
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = f"[QR][{record.name.split('.', 1)[-1]}] {record.getMessage()}"
+        data = getattr(record, "data", None)
+        if data is not None:
+            line += " " + json.dumps(data, ensure_ascii=False, default=str)
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+class _SampleFilter(logging.Filter):
+    """Per-component sampling + rate cap for sub-WARNING records; warnings and errors always pass."""
+    def __init__(self):
+        super().__init__()
+        self._buckets: Dict[str, List[float]] = {}   # component -> [tokens, last_ts]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        comp = record.name.split(".", 1)[-1]
+        p = LOG_SAMPLE.get(comp)
+        if p is not None and random.random() >= p:
+            return self._drop(comp, "sampled")
+        if LOG_RATE > 0:
+            now = time.monotonic()
+            b = self._buckets.setdefault(comp, [LOG_RATE, now])
+            b[0] = min(LOG_RATE, b[0] + (now - b[1]) * LOG_RATE)
+            b[1] = now
+            if b[0] < 1.0:
+                return self._drop(comp, "rate")
+            b[0] -= 1.0
+        return True
+
+    def _drop(self, comp: str, reason: str) -> bool:
+        LOG_DROPPED[(comp, reason)] = LOG_DROPPED.get((comp, reason), 0) + 1
+        return False
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # keep the record as-is: formatting (and json.dumps of `data`) happens on the listener thread
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            comp = record.name.split(".", 1)[-1]
+            LOG_DROPPED[(comp, "queue_full")] = LOG_DROPPED.get((comp, "queue_full"), 0) + 1
+
+def _setup_logging() -> logging.handlers.QueueListener:
+    root = logging.getLogger("qr")
+    root.setLevel(LOG_LEVEL)
+    root.propagate = False
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    for comp, lvl in LOG_LEVELS.items():
+        logging.getLogger(f"qr.{comp}").setLevel(lvl)
+    q: "queue.Queue[logging.LogRecord]" = queue.Queue(LOG_QUEUE_SIZE)
+    qh = _QueueHandler(q)
+    qh.addFilter(_SampleFilter())
+    root.addHandler(qh)
+    out = logging.StreamHandler(sys.stdout)
+    out.setFormatter(_JsonFormatter() if LOG_JSON else _TextFormatter())
+    listener = logging.handlers.QueueListener(q, out, respect_handler_level=False)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+_log_listener = _setup_logging()
+
+def get_log(component: str) -> logging.Logger:
+    return logging.getLogger(f"qr.{component}")
+
+log_http    = get_log("http")
+log_mem     = get_log("mem")
+log_limiter = get_log("limiter")
+log_openai  = get_log("openai")
+log_spice   = get_log("spice")
+log_stage   = get_log("stage")
+log_rank    = get_log("rank")
+log_suggest = get_log("suggest")
+log_metrics = get_log("metrics")
+log_session = get_log("session")
+log_feedback= get_log("feedback")
+
+# ================== METRICS ==================
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0)
+TOKEN_BUCKETS   = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+COUNT_BUCKETS   = (1, 5, 10, 25, 50, 100, 250, 1000, 5000, 25000)
+
+def _labels_key(labels: Dict[str, Any]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _fmt_labels(labels: Tuple[Tuple[str, str], ...], extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items: return ""
+    esc = lambda v: v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+class Metrics:
+    """
+    Minimal in-process registry rendered in Prometheus text format on /metrics.
+    Counters and histograms are recorded directly; point-in-time values (limiter queue, cache
+    size, ...) come from collector callbacks evaluated at scrape time.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta: Dict[str, Tuple[str, str]] = {}      # name -> (type, help)
+        self._counters: Dict[str, Dict[Tuple, float]] = {}
+        self._hists: Dict[str, Dict[Tuple, List]] = {}   # name -> labels -> [bucket counts..., sum, count]
+        self._buckets: Dict[str, Tuple] = {}
+        self._collectors: List[Any] = []
+
+    def counter(self, name: str, help: str):
+        self._meta[name] = ("counter", help)
+        self._counters.setdefault(name, {})
+
+    def histogram(self, name: str, help: str, buckets: Tuple = LATENCY_BUCKETS):
+        self._meta[name] = ("histogram", help)
+        self._hists.setdefault(name, {})
+        self._buckets[name] = buckets
+
+    def collector(self, fn):
+        """fn() -> iterable of (name, type, help, labels dict, value)."""
+        self._collectors.append(fn)
+        return fn
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _labels_key(labels)
+        buckets = self._buckets.get(name, LATENCY_BUCKETS)
+        with self._lock:
+            series = self._hists.setdefault(name, {})
+            h = series.get(key)
+            if h is None:
+                h = series[key] = [0] * len(buckets) + [0.0, 0]
+            for i, b in enumerate(buckets):
+                if value <= b:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    @contextlib.contextmanager
+    def span(self, stage: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("qr_stage_seconds", time.perf_counter() - t0, stage=stage)
+
+    def timed(self, stage: str):
+        """Decorator: record the wrapped (sync or async) function under qr_stage_seconds{stage=...}."""
+        def deco(fn):
+            if asyncio.iscoroutinefunction(fn):
+                async def aw(*a, **kw):
+                    with self.span(stage):
+                        return await fn(*a, **kw)
+                aw.__name__, aw.__doc__ = fn.__name__, fn.__doc__
+                return aw
+            def w(*a, **kw):
+                with self.span(stage):
+                    return fn(*a, **kw)
+            w.__name__, w.__doc__ = fn.__name__, fn.__doc__
+            return w
+        return deco
+
+    def render(self) -> str:
+        out: List[str] = []
+        with self._lock:
+            for name, series in self._counters.items():
+                typ, hlp = self._meta.get(name, ("counter", ""))
+                out += [f"# HELP {name} {hlp}", f"# TYPE {name} {typ}"]
+                out += [f"{name}{_fmt_labels(k)} {v:g}" for k, v in series.items()]
+            for name, series in self._hists.items():
+                _, hlp = self._meta.get(name, ("histogram", ""))
+                buckets = self._buckets.get(name, LATENCY_BUCKETS)
+                out += [f"# HELP {name} {hlp}", f"# TYPE {name} histogram"]
+                for k, h in series.items():
+                    for i, b in enumerate(buckets):
+                        out.append(f"{name}_bucket{_fmt_labels(k, ('le', f'{b:g}'))} {h[i]}")
+                    out.append(f"{name}_bucket{_fmt_labels(k, ('le', '+Inf'))} {h[-1]}")
+                    out.append(f"{name}_sum{_fmt_labels(k)} {h[-2]:.6f}")
+                    out.append(f"{name}_count{_fmt_labels(k)} {h[-1]}")
+        seen = set()
+        for fn in self._collectors:
+            try:
+                rows = list(fn())
+            except Exception as e:
+                log_metrics.warning("collector failed: %s", e)
+                continue
+            for name, typ, hlp, labels, value in rows:
+                if name not in seen:
+                    out += [f"# HELP {name} {hlp}", f"# TYPE {name} {typ}"]
+                    seen.add(name)
+                out.append(f"{name}{_fmt_labels(_labels_key(labels))} {float(value):g}")
+        return "\n".join(out) + "\n"
+
+METRICS = Metrics()
+METRICS.histogram("qr_stage_seconds", "Wall time per pipeline stage")
+METRICS.histogram("qr_upstream_attempt_seconds", "Wall time per upstream HTTP attempt (by status)")
+METRICS.histogram("qr_upstream_backoff_seconds", "Sleep between upstream retries")
+METRICS.histogram("qr_limiter_wait_seconds", "Time spent waiting for a rate-limiter slot")
+METRICS.histogram("qr_upstream_tokens", "Token usage per completion from the response usage field", TOKEN_BUCKETS)
+METRICS.counter("qr_upstream_requests_total", "Upstream HTTP attempts by status")
+METRICS.counter("qr_upstream_retries_total", "Upstream attempts that were retried")
+METRICS.counter("qr_upstream_429_total", "Upstream 429 responses")
+METRICS.counter("qr_upstream_giveups_total", "Upstream calls that exhausted all retries")
+METRICS.counter("qr_hedge_total", "Hedged upstream calls by outcome (fired, won, lost, no_budget)")
+METRICS.histogram("qr_hedge_saved_seconds", "Estimated latency saved per winning hedge")
+METRICS.counter("qr_parse_failures_total", "Model responses that were not valid JSON")
+METRICS.counter("qr_memory_lookups_total", "Memory lookups")
+METRICS.counter("qr_memory_hits_total", "Memory lookups that returned at least one line")
+METRICS.histogram("qr_mem_rebuild_seconds", "Background memory index rebuilds")
+METRICS.counter("qr_mem_rebuilds_total", "Memory index rebuilds by reason")
+METRICS.histogram("qr_memory_candidates", "Keys Jaccard-checked per memory lookup", COUNT_BUCKETS)
+METRICS.counter("qr_suggest_total", "/suggest requests by outcome")
+METRICS.counter("qr_stage_classify_total", "Stage classifications by who answered (local model or LLM)")
+METRICS.counter("qr_prompt_history_trimmed_total", "Generate prompts whose HISTORY was cut to QR_PROMPT_HISTORY_TOKENS")
+METRICS.counter("qr_idea_total", "Idea lookups by result (reused, or why it was recomputed)")
+METRICS.histogram("qr_idea_staleness_turns", "Messages since a reused idea was computed", COUNT_BUCKETS)
+
+# ================== UPSTREAM HTTP CLIENT ==================
+_http: Optional[httpx.AsyncClient] = None
+
+def _http_timeout(read: Optional[float] = None) -> httpx.Timeout:
+    return httpx.Timeout(connect=HTTP_CONNECT_SEC, read=read or HTTP_READ_SEC,
+                         write=HTTP_WRITE_SEC, pool=HTTP_POOL_SEC)
+
+def _new_http_client() -> httpx.AsyncClient:
+    http2 = HTTP_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            log_http.warning("QR_HTTP2=1 but h2 is not installed (pip install 'httpx[http2]'); using HTTP/1.1")
+            http2 = False
+    limits = httpx.Limits(max_connections=HTTP_MAX_CONN,
+                          max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                          keepalive_expiry=HTTP_KEEPALIVE_SEC)
+    log_http.info("client up http2=%s max_conn=%d keepalive=%d", http2, HTTP_MAX_CONN, HTTP_MAX_KEEPALIVE)
+    return httpx.AsyncClient(http2=http2, limits=limits, timeout=_http_timeout())
+
+def http_client() -> httpx.AsyncClient:
+    """Long-lived pooled client; opened by the lifespan handler (or lazily outside the server)."""
+    global _http
+    if _http is None or _http.is_closed:
+        _http = _new_http_client()
+    return _http
+
+@contextlib.asynccontextmanager
+async def lifespan(_app: FastAPI):
+    global _http
+    http_client()
+    MEM_WATCHER.start()
+    if MEM_WATCHER.interval > 0 and MEM.source != await asyncio.to_thread(COMMIT_STORE.fingerprint):
+        asyncio.get_running_loop().create_task(MEM_WATCHER.rebuild("stale_snapshot"))
+    try:
+        yield
+    finally:
+        await MEM_WATCHER.stop()
+        if _http is not None:
+            await _http.aclose()
+            _http = None
+            log_http.info("client closed")
+        await asyncio.to_thread(DB.close)   # flush queued feedback writes
 
 # ================== APP & CORS ==================
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], allow_credentials=True,
@@ -46,9 +423,9 @@ app.add_middleware(
 
 # ================== DB for feedback ==================
 DB_PATH = os.getenv("QR_DB", "qrizz.db")
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-cur = conn.cursor()
-cur.execute("""
+DB = Storage(DB_PATH)   # WAL; writes are queued and group-committed by a background thread
+atexit.register(DB.close)
+DB.executescript("""
 CREATE TABLE IF NOT EXISTS feedback(
   id INTEGER PRIMARY KEY,
   ts INTEGER,
@@ -57,24 +434,18 @@ CREATE TABLE IF NOT EXISTS feedback(
   option TEXT,
   label TEXT,
   meta  TEXT
-)
+);
+CREATE INDEX IF NOT EXISTS idx_feedback_label_ts ON feedback(label, ts);
+CREATE INDEX IF NOT EXISTS idx_feedback_stage_label_ts ON feedback(stage, label, ts);
 """)
-conn.commit()
-_db_lock = threading.Lock()
-
-# --- Commit store json file ---
-COMMITS_PATH = os.getenv("QR_COMMITS", "qr_commits.json")
-
-def _load_commits():
-    try:
-        with open(COMMITS_PATH, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
+FEEDBACK_INSERT = "INSERT INTO feedback(ts, stage, latest, option, label, meta) VALUES (?,?,?,?,?,?)"
 
-def _save_commits(obj):
-    with open(COMMITS_PATH, "w", encoding="utf-8") as f:
-        json.dump(obj, f, ensure_ascii=False, indent=2)
+# --- Commit store (QR_COMMIT_STORE=sqlite|log; see commit_store.py) ---
+COMMITS_PATH = os.getenv("QR_COMMITS", "qr_commits.json")   # legacy JSON, imported once into an empty store
+COMMIT_STORE = open_commit_store(COMMIT_STORE_KIND, DB)
+migrate_if_empty(COMMIT_STORE, COMMITS_PATH)
+atexit.register(COMMIT_STORE.close)
+_commit_lock = threading.Lock()   # keeps store upsert + MEM update ordered per /commit
 
 # ================== MODELS ==================
 class Msg(BaseModel):
@@ -87,6 +458,11 @@ class SuggestReq(BaseModel):
     site: Optional[str] = None
     thread: Optional[str] = None  #what does optional do here
     spice: Optional[int] = None
+    pipeline: Optional[str] = None  # "split" | "fused"; overrides QR_PIPELINE for A/B runs
+    nocache: bool = False           # skip the response cache (still recomputes + stores)
+    append: List[Msg] = []          # new messages for `thread` (instead of resending `context`)
+    base: Optional[int] = None      # session "len" the client last saw; a mismatch asks for a resync
+    reset: bool = False             # forget the thread's session (history and stage floor) first
 
 class FeedbackReq(BaseModel):
     stage: str
@@ -94,6 +470,10 @@ class FeedbackReq(BaseModel):
     option: str                                                 #whats difference between feedbackReq and commitReq
     label: str = "clicked"    # also accept "up"/"down"
     meta: Optional[Dict[str, Any]] = None
+    ts: Optional[int] = None  # client click time (ms); batched events arrive late
+
+class FeedbackBatchReq(BaseModel):
+    events: List[FeedbackReq]
 
 class CommitReq(BaseModel):
     text: str                 # latest incoming text 
@@ -165,16 +545,179 @@ _SLANG = _load_slang()
 # longest first; allow tokens like "tl;dr"
 _keys = sorted(_SLANG.keys(), key=len, reverse=True)
 _pat  = re.compile(r'\b(' + '|'.join(re.escape(k).replace(r'\;',';') for k in _keys) + r')\b', re.I)
-def expand_slang(s: str) -> str:
-    if not s: return s
-    def repl(m):                #make it so that it knows what lolllll is or something, rn it just sees lol
-        k = m.group(0).lower()
-        return _SLANG.get(k, k)
-    return _pat.sub(repl, s)
+def _slang_repl(m):             #make it so that it knows what lolllll is or something, rn it just sees lol
+    k = m.group(0).lower()
+    return _SLANG.get(k, k)
 
-def stitched_k_exp(history: List[Msg], k=CONTEXT_WINDOW) -> str:
-    xs = history[-k:]
-    return "\n".join(f"{m.role}: {expand_slang(clamp(m.text))}" for m in xs)
+class SlangExpander:
+    """
+    Same result as _pat.sub() without the alternation: text is split into word runs and the
+    separators between them, and a trie of glossary keys (lowercased words, exact separators)
+    takes the longest key starting at each word, e.g. "no cap" over "no". Text that isn't
+    ASCII goes to the regex, since re's Unicode case folding and \w differ from str.lower(),
+    and so does everything if a key doesn't start and end on a word character.
+    """
+    _SPLIT = re.compile(r"(\w+)")
+
+    def __init__(self, slang: Dict[str, str]):
+        self._root: Optional[Dict[str, list]] = {}
+        for key, val in slang.items():
+            parts = self._SPLIT.split(key)
+            if not key.isascii() or parts[0] or parts[-1] or len(parts) < 3:
+                self._root = None       # not word-bounded: only the regex gets this right
+                return
+            node = self._root
+            for i in range(1, len(parts), 2):
+                ent = node.setdefault(parts[i], [None, {}])    # [value if a key ends here, separator -> node]
+                if i + 2 < len(parts):
+                    node = ent[1].setdefault(parts[i + 1], {})
+                else:
+                    ent[0] = val
+
+    def _longest(self, parts: List[str], i: int) -> Optional[Tuple[int, str]]:
+        node, best = self._root, None
+        while True:
+            ent = node.get(parts[i].lower())
+            if ent is None:
+                return best
+            if ent[0] is not None:
+                best = (i, ent[0])
+            if i + 2 >= len(parts):
+                return best
+            node = ent[1].get(parts[i + 1])
+            if node is None:
+                return best
+            i += 2
+
+    def expand(self, s: str) -> str:
+        if not s: return s
+        root = self._root
+        if root is None or not s.isascii():
+            return _pat.sub(_slang_repl, s)
+        parts = self._SPLIT.split(s)    # separators at even indexes, words at odd
+        hit, i = False, 1
+        while i < len(parts):
+            if parts[i].lower() in root:
+                m = self._longest(parts, i)
+                if m is not None:
+                    parts[i:m[0] + 1] = [m[1]]
+                    hit = True
+            i += 2
+        return "".join(parts) if hit else s
+
+_EXPANDER = SlangExpander(_SLANG)
+
+def expand_slang(s: str) -> str:
+    return _EXPANDER.expand(s)
+
+class Turn:
+    """One message of a Conversation; each normalized form is computed on first use."""
+    __slots__ = ("role", "raw", "_text", "_line", "_low", "_exp")
+
+    def __init__(self, role: str, raw: str):
+        self.role, self.raw = role, raw
+        self._text = self._line = self._low = self._exp = None
+
+    @property
+    def text(self) -> str:      # clamp()ed
+        if self._text is None:
+            self._text = clamp(self.raw)
+        return self._text
+
+    @property
+    def line(self) -> str:      # clamp()ed again as the prompts show it: drops a space the 350-char cut left
+        if self._line is None:
+            self._line = clamp(self.text)
+        return self._line
+
+    @property
+    def low(self) -> str:
+        if self._low is None:
+            self._low = self.text.lower()
+        return self._low
+
+    @property
+    def exp(self) -> str:       # slang-expanded line, case kept
+        if self._exp is None:
+            self._exp = expand_slang(self.line)
+        return self._exp
+
+class Conversation:
+    """
+    A /suggest context parsed once per request. Stage, idea, spice, the cache key and the
+    prompts read their clamped / lowercased / slang-expanded forms from here instead of
+    each re-running clamp and expand_slang over the same messages.
+    """
+    def __init__(self, context: List[Msg], k: int = CONTEXT_WINDOW):
+        self.turns = [Turn(m.role, m.text) for m in context[-k:]] if k > 0 else []
+        self.stage_floor: Optional[str] = None    # earliest stage allowed (a session's last stage)
+        self._msgs: Optional[List[Msg]] = None
+        self._latest: Optional[str] = None
+        self._latest_exp: Optional[str] = None
+        self._joined: Dict[Tuple[str, int], str] = {}
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+    @classmethod
+    def of_turns(cls, turns: List[Turn], k: int = CONTEXT_WINDOW) -> "Conversation":
+        """Over already-parsed turns (a session's), so their normalized forms are reused."""
+        conv = cls([], k)
+        conv.turns = turns[-k:] if k > 0 else []
+        return conv
+
+    @property
+    def msgs(self) -> List[Msg]:
+        """Clamped messages, for code that takes List[Msg]."""
+        if self._msgs is None:
+            self._msgs = [Msg(role=t.role, text=t.text) for t in self.turns]
+        return self._msgs
+
+    @property
+    def latest(self) -> str:
+        """Last non-empty message from them (see last_incoming)."""
+        if self._latest is None:
+            self._latest = next((t.line for t in reversed(self.turns) if t.role == "them" and t.text), "")
+        return self._latest
+
+    @property
+    def latest_exp(self) -> str:
+        if self._latest_exp is None:
+            self._latest_exp = expand_slang(self.latest)
+        return self._latest_exp
+
+    def _memo(self, name: str, k: int, make) -> str:
+        v = self._joined.get((name, k))
+        if v is None:
+            v = self._joined[(name, k)] = make(self.turns[-k:] if k > 0 else [])
+        return v
+
+    def stitched(self, k: int = CONTEXT_WINDOW) -> str:
+        """stitched_k() over the last K turns."""
+        return self._memo("raw", k, lambda xs: "\n".join(f"{t.role}: {t.line}" for t in xs))
+
+    def stitched_exp(self, k: int = CONTEXT_WINDOW) -> str:
+        """stitched_k() with each message slang-expanded."""
+        return self._memo("exp", k, lambda xs: "\n".join(f"{t.role}: {t.exp}" for t in xs))
+
+    def fit(self, k: int, budget: int) -> int:
+        """Largest k' <= K whose stitched(k') is about BUDGET tokens or less (never below 1); K if it all fits."""
+        if budget <= 0:
+            return k
+        used = 0
+        for i, t in enumerate(reversed(self.turns[-k:] if k > 0 else [])):
+            used += (len(t.role) + len(t.line) + 3) // 4      # "role: line\n", ~4 chars per token
+            if used > budget and i:
+                return i
+        return k
+
+    def window_low(self, k: int = CONTEXT_WINDOW) -> str:
+        """Non-empty messages of the last K turns, space-joined and lowercased."""
+        return self._memo("low", k, lambda xs: " ".join(t.low for t in xs if t.text))
+
+    def stage_text(self, k: int = CONTEXT_WINDOW) -> str:
+        """All of the last K turns space-joined, lowercased, then slang-expanded (slang may span two)."""
+        return self._memo("stage", k, lambda xs: expand_slang(" ".join(t.low for t in xs)))
 
 # ===== Memory index (approx lookup from qr_commits.json) =====
 _WORD_RX = re.compile(r"[a-z0-9']+")
@@ -191,78 +734,277 @@ def _trigrams(tokens: List[str]) -> List[str]:
 def _tokens(s: str) -> List[str]:
     return _WORD_RX.findall(s)
 
-def _jaccard(a: set, b: set) -> float:
-    if not a or not b: return 0.0
-    inter = len(a & b)
-    if inter == 0: return 0.0
-    return inter / float(len(a | b))
+def _mem_recipe(backend: str, retrieval: str = "jaccard") -> str:
+    # anything that changes which grams a key produces (or how LSH buckets them) invalidates a snapshot
+    slang = hashlib.blake2b(json.dumps(_SLANG, sort_keys=True).encode("utf-8"), digest_size=8).hexdigest()
+    if retrieval == "embed":
+        return f"embed-v1|{MEM_EMBED_DIM}|n{mem_embed.NGRAM_MIN}-{mem_embed.NGRAM_MAX}|slang={slang}"
+    lsh = f"{MEM_LSH_BANDS}x{MEM_LSH_ROWS}s{MEM_LSH_SEED}" if backend == "lsh" else "-"
+    return f"grams-v1|{backend}|{lsh}|slang={slang}"
+
+def _grams_for(text: str) -> set:
+    toks = _tokens(_norm_text(text))
+    return set(_trigrams(toks) or toks)
+
+class _KeyRec:
+    __slots__ = ("key", "grams", "items")
+
+    def __init__(self, key: str, grams: array, items: List[Dict[str, Any]]):
+        self.key = key        # original key text
+        self.grams = grams    # sorted gram ids, array('I')
+        self.items = items    # commit items for this key
 
 class MemIndex:
-    def __init__(self, path: str):
-        self.path = path
-        self.data: Dict[str, Any] = {}
-        self.key_grams: Dict[str, set] = {}
-        self.postings: Dict[str, set] = {}  # gram -> set(keys)
+    """
+    Remembered keys searchable by trigram Jaccard. Grams and keys are interned to int ids;
+    each gram's postings are a sorted array('I') of key ids and each key keeps its sorted
+    gram ids, so Jaccard is |q & k| / (|q| + |k| - |q & k|) from an overlap count.
+    Candidates come from one of two backends (QR_MEM_BACKEND): "postings" counts overlaps
+    across the inverted list of every query gram (exact, but common grams drag in most of
+    the store); "lsh" looks up MinHash band buckets (see lsh.py) so the shortlist stays
+    small at any size, then counts overlaps for the survivors.
+
+    With QR_MEM_SNAPSHOT set, a build is written to a memory-mapped snapshot (mem_snapshot.py)
+    and served from it; the next start opens that file instead of rebuilding unless the
+    store's fingerprint or the build recipe changed. Keys committed after that land in the
+    in-memory structures as an overlay that shadows the snapshot's copy of the same key.
+    ALLOW_STALE opens a snapshot whatever store state it came from; SOURCE then tells the
+    watcher (MemWatcher) that a rebuild is due.
+
+    RETRIEVAL="embed" (QR_MEM_RETRIEVAL) drops the grams and scores keys by cosine over
+    hashed char-n-gram TF-IDF rows instead (mem_embed.py), so paraphrases and typos of a
+    remembered line still match. The rows ride along in the snapshot; committed keys are
+    appended to an in-memory matrix.
+    """
+    def __init__(self, store: CommitStore, backend: str = MEM_BACKEND, snapshot_path: str = MEM_SNAPSHOT_PATH,
+                 allow_stale: bool = False, retrieval: str = MEM_RETRIEVAL):
+        if backend not in ("postings", "lsh"):
+            raise RuntimeError(f"unknown QR_MEM_BACKEND={backend!r} (expected postings or lsh)")
+        if retrieval not in ("jaccard", "embed"):
+            raise RuntimeError(f"unknown QR_MEM_RETRIEVAL={retrieval!r} (expected jaccard or embed)")
+        self.store = store
+        self.backend = backend
+        self.retrieval = retrieval
+        self.snapshot_path = snapshot_path
+        self.recipe = _mem_recipe(backend, retrieval)
+        self.allow_stale = allow_stale
+        self.source = ""                              # store fingerprint this index reflects
+        self.encoder = mem_embed.HashedTfidf(MEM_EMBED_DIM) if retrieval == "embed" else None
+        self._base: Optional[MemSnapshot] = None
+        self._emb_base = None                         # snapshot rows (numpy view over the mapping); embed only
+        self._shadow: set = set()                     # snapshot key ids replaced by the overlay
+        self._reset_overlay()
+        self._lock = threading.Lock()       # similar() runs off-loop while /commit updates
+        self.generation = 0                 # bumped on every change; part of the response cache key
         self._load_and_build()
 
+    def _reset_overlay(self):
+        self._gram_ids: Dict[str, int] = {}
+        self._key_ids: Dict[str, int] = {}
+        self._recs: List[_KeyRec] = []                # key id -> record
+        self.postings: List[array] = []               # gram id -> sorted key ids; postings backend only
+        self.lsh = MinHashLSH(MEM_LSH_BANDS, MEM_LSH_ROWS, MEM_LSH_SEED) if self.backend == "lsh" else None
+        self.emb = mem_embed.EmbedMatrix(self.encoder.dim, 64) if self.encoder is not None else None
+
+    def _grams(self, text: str) -> set:
+        return _grams_for(text) if self.encoder is None else set()
+
+    def _attach_locked(self, snap: MemSnapshot):
+        self._reset_overlay()
+        self._base, self._shadow, self._emb_base = snap, set(), None
+        if self.encoder is not None:
+            self.encoder.idf = mem_embed.as_vector(snap.emb_idf())
+            self._emb_base = mem_embed.as_rows(snap.emb_rows(), self.encoder.dim)
+
+    def __len__(self) -> int:
+        base = self._base.n_keys - len(self._shadow) if self._base is not None else 0
+        return base + len(self._recs)
+
+    def keys(self) -> List[str]:
+        with self._lock:
+            out = [r.key for r in self._recs]
+            base = self._base
+            if base is not None:
+                out += [base.key(k) for k in range(base.n_keys) if k not in self._shadow]
+        return out
+
+    def _intern_locked(self, grams: set) -> array:
+        ids = self._gram_ids
+        for g in grams:
+            if g not in ids:
+                ids[g] = len(ids)
+                if self.lsh is None:
+                    self.postings.append(array("I"))
+        return array("I", sorted(ids[g] for g in grams))
+
+    def _index_locked(self, key: str, grams: set, items: List[Dict[str, Any]]):
+        gids = self._intern_locked(grams)
+        kid = self._key_ids.get(key)
+        if kid is None:
+            kid = self._key_ids[key] = len(self._recs)
+            self._recs.append(_KeyRec(key, gids, items))
+            old = ()
+        else:
+            rec = self._recs[kid]
+            old, rec.grams, rec.items = rec.grams, gids, items
+        if self.lsh is not None:
+            self.lsh.add(kid, grams)        # replaces any previous signature
+            return
+        for g in old:
+            p = self.postings[g]
+            i = bisect.bisect_left(p, kid)
+            if i < len(p) and p[i] == kid:
+                del p[i]
+        for g in gids:
+            p = self.postings[g]
+            if not p or p[-1] < kid:
+                p.append(kid)               # new keys get the highest id: stays sorted
+            else:
+                bisect.insort(p, kid)
+
     def _load_and_build(self):
-        self.data = _load_commits()
-        self.key_grams.clear()
-        self.postings.clear()
-        for key in self.data.keys():
-            nk = _norm_text(key)
-            toks = _tokens(nk)
-            grams = set(_trigrams(toks) or toks)
-            self.key_grams[key] = grams
-            for g in grams:
-                self.postings.setdefault(g, set()).add(key)
-        print(f"[QR][mem] built index keys={len(self.data)} grams={len(self.postings)}")
-
-    def reload(self):
-        self._load_and_build()
+        t0 = time.perf_counter()
+        source = self.store.fingerprint()
+        snap = None
+        if self.snapshot_path:
+            snap = open_snapshot(self.snapshot_path, None if self.allow_stale else source, self.recipe)
+        if snap is not None:
+            with self._lock:
+                self._attach_locked(snap)
+                self.source = snap.meta.get("source", "")
+                self.generation += 1
+            log_mem.info("opened snapshot %s keys=%d stale=%s in %.1fms", self.snapshot_path, snap.n_keys,
+                         self.source != source, 1000 * (time.perf_counter() - t0))
+            return
+        data = self.store.load_all()
+        with self._lock:
+            self._reset_overlay()
+            self._base, self._shadow, self._emb_base = None, set(), None
+            for key, entry in data.items():
+                self._index_locked(key, self._grams(key), (entry or {}).get("items") or [])
+            if self.encoder is not None:
+                norm = [_norm_text(key) for key in data]
+                self.encoder.fit(norm)
+                for key, text in zip(data, norm):
+                    self.emb.add(key, self.encoder.encode(text))
+            if self.snapshot_path:
+                self._snapshot_locked(source)
+            self.source = source
+            self.generation += 1
+        log_mem.info("built index backend=%s keys=%d in %.0fms", self.retrieval if self.encoder else self.backend, len(self),
+                     1000 * (time.perf_counter() - t0))
+
+    def _snapshot_locked(self, source: str):
+        """Write the in-memory index out and serve from the mapped file instead."""
+        grams = [""] * len(self._gram_ids)
+        for g, i in self._gram_ids.items():
+            grams[i] = g
+        keys = [(r.key, r.grams, r.items) for r in self._recs]
+        bands = [self.lsh.bands_of(kid) for kid in range(len(self._recs))] if self.lsh is not None else None
+        emb = (self.encoder.dim, self.emb.matrix(), self.encoder.idf) if self.emb is not None else None  # rows follow key ids
+        try:
+            write_snapshot(self.snapshot_path, {"source": source, "recipe": self.recipe}, grams, keys,
+                           bands, MEM_LSH_BANDS if self.lsh is not None else 0, emb)
+            snap = MemSnapshot(self.snapshot_path)
+        except Exception as e:
+            log_mem.warning("snapshot write failed, serving from memory: %s", e)
+            return
+        self._attach_locked(snap)
 
     def add_or_update_key(self, key: str, items: List[Dict[str, Any]]):
         # update in-memory structures after /commit
-        self.data[key] = {"items": items}
-        nk = _norm_text(key)
-        toks = _tokens(nk)
-        grams = set(_trigrams(toks) or toks)
-        # remove old postings if existed
-        old = self.key_grams.get(key)
-        if old:
-            for g in old:
-                s = self.postings.get(g)
-                if s:
-                    s.discard(key)
-        # add new
-        self.key_grams[key] = grams
-        for g in grams:
-            self.postings.setdefault(g, set()).add(key)
+        grams = self._grams(key)
+        vec = self.encoder.encode(_norm_text(key)) if self.encoder is not None else None
+        with self._lock:
+            kid = self._base.key_id(key) if self._base is not None else -1
+            if kid >= 0:
+                self._shadow.add(kid)
+            self._index_locked(key, grams, items)
+            if vec is not None and kid < 0:
+                self.emb.add(key, vec)      # a snapshot key keeps its row: the vector only depends on the text
+            self.generation += 1
+
+    def _scored_locked(self, qgrams: set) -> Tuple[List[Tuple[str, float]], int]:
+        """(key, jaccard) above MEM_MIN_JACCARD, plus how many candidates were checked."""
+        nq, ncand = len(qgrams), 0
+        bids = self.lsh.band_ids(qgrams) if self.lsh is not None else None
+        scored: List[Tuple[str, float]] = []
+        base = self._base
+        if base is not None:
+            bq = [g for g in map(base.gram_id, qgrams) if g >= 0]
+            if self.lsh is not None:
+                cands: set = set()
+                for band, bk in enumerate(bids or ()):
+                    cands.update(base.lsh_bucket(band, bk))
+                qset = set(bq)
+                overlaps = [(kid, len(qset.intersection(base.key_grams(kid)))) for kid in cands]
+            else:
+                cnt: Counter = Counter()
+                for g in bq:
+                    cnt.update(base.postings(g))
+                overlaps = cnt.items()
+            ncand += len(overlaps)
+            for kid, inter in overlaps:
+                if inter and kid not in self._shadow:
+                    sc = inter / float(nq + base.key_len(kid) - inter)
+                    if sc >= MEM_MIN_JACCARD:
+                        scored.append((base.key(kid), sc))
+        qids = [self._gram_ids[g] for g in qgrams if g in self._gram_ids]
+        recs = self._recs
+        if self.lsh is not None:
+            qset = set(qids)
+            overlaps = [(kid, len(qset.intersection(recs[kid].grams))) for kid in self.lsh.lookup(bids)]
+        else:
+            cnt = Counter()
+            for g in qids:
+                cnt.update(self.postings[g])      # C-level count over each sorted block
+            overlaps = cnt.items()
+        ncand += len(overlaps)
+        for kid, inter in overlaps:
+            if inter:
+                sc = inter / float(nq + len(recs[kid].grams) - inter)
+                if sc >= MEM_MIN_JACCARD:
+                    scored.append((recs[kid].key, sc))
+        return scored, ncand
+
+    def _embedded(self, q, topk: int) -> Tuple[List[Tuple[str, float]], int]:
+        """(key, cosine) of the TOPK nearest rows above MEM_EMBED_MIN_SIM from base and overlay, plus rows scanned."""
+        with self._lock:                    # rows are append-only: views taken here stay valid unlocked
+            base, rows, emb = self._base, self._emb_base, self.emb
+            m, keys = emb.matrix(), emb.keys
+        scored: List[Tuple[str, float]] = []
+        if rows is not None:
+            scored += [(base.key(kid), sc) for kid, sc in mem_embed.top_k(rows @ q, topk, MEM_EMBED_MIN_SIM)]
+        scored += [(keys[i], sc) for i, sc in mem_embed.top_k(m @ q, topk, MEM_EMBED_MIN_SIM)]
+        return scored, (rows.shape[0] if rows is not None else 0) + m.shape[0]
 
     def similar(self, latest: str, topk: int = MEM_TOPK_KEYS) -> List[Tuple[str, float]]:
         if not MEM_ENABLE: return []
         if not latest or len(latest) < MEM_MIN_LEN: return []
-        qn = _norm_text(latest)
-        qtoks = _tokens(qn)
-        qgrams = set(_trigrams(qtoks) or qtoks)
+        if self.encoder is not None:
+            out, nrows = self._embedded(self.encoder.encode(_norm_text(latest)), topk)
+            METRICS.observe("qr_memory_candidates", nrows, backend="embed")
+            out.sort(key=lambda t: (-t[1], t[0]))
+            return out[:topk]
+        qgrams = _grams_for(latest)
         if not qgrams: return []
-        # candidate gather
-        cand_keys: set = set()
-        for g in qgrams:
-            if g in self.postings:
-                cand_keys |= self.postings[g]
-        scored: List[Tuple[str, float]] = []
-        for k in cand_keys:
-            kg = self.key_grams.get(k) or set()
-            sc = _jaccard(qgrams, kg)
-            if sc >= MEM_MIN_JACCARD:
-                scored.append((k, sc))
-        scored.sort(key=lambda t: t[1], reverse=True)
-        return scored[:topk]
+        with self._lock:
+            out, ncand = self._scored_locked(qgrams)
+        METRICS.observe("qr_memory_candidates", ncand, backend=self.backend)
+        out.sort(key=lambda t: (-t[1], t[0]))   # ties by key, so snapshot and memory layouts agree
+        return out[:topk]
+
+    def items_for(self, key: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            kid = self._key_ids.get(key)
+            if kid is not None:
+                return self._recs[kid].items
+            base = self._base
+            kid = base.key_id(key) if base is not None else -1
+        return base.items(kid) if kid >= 0 else []
 
     def best_lines_for(self, key: str, limit: int = 3) -> List[str]:
-        entry = self.data.get(key) or {}
-        items = entry.get("items") or []
+        items = self.items_for(key)
         # prefer rating == "Y"
         if MEM_PREF_LIKED:
             pos = [it.get("resp") for it in items if (isinstance(it, dict) and (it.get("rating") == "Y"))]
@@ -272,7 +1014,144 @@ class MemIndex:
         any_lines = [it.get("resp") for it in items if isinstance(it, dict)]
         return [clean_option(x) for x in any_lines if x][:limit]
 
-MEM = MemIndex(COMMITS_PATH)
+MEM = MemIndex(COMMIT_STORE, allow_stale=MEM_WATCH_SEC > 0)   # a stale snapshot is refreshed in the background
+
+@METRICS.timed("memory")
+def memory_lines(latest: str) -> List[str]:
+    """Remembered replies for keys similar to LATEST (CPU-only; safe to run off-loop)."""
+    mem_lines: List[str] = []
+    if not MEM_ENABLE:
+        return mem_lines
+    METRICS.inc("qr_memory_lookups_total")
+    mem = MEM   # one index for the whole lookup, even if the watcher swaps in a new one meanwhile
+    try:
+        sims = mem.similar(latest)
+        for key, score in sims:
+            lines = mem.best_lines_for(key, limit=MEM_MERGE_LIMIT)
+            for ln in lines:
+                if ln and ln not in mem_lines:
+                    mem_lines.append(ln)
+            if len(mem_lines) >= MEM_MERGE_LIMIT:
+                break
+        if mem_lines:
+            METRICS.inc("qr_memory_hits_total")
+            log_mem.info("hit", extra={"data": {"keys": [k for k,_ in sims], "picked": mem_lines}})
+    except Exception as e:
+        log_mem.warning("lookup failed: %s", e)
+    return mem_lines
+
+# ---- Background rebuild ----
+class MemWatcher:
+    """
+    Polls the commit store's fingerprint and, when something other than our own /commit
+    changed it (another worker, a migration, a hand edit), rebuilds the index on a worker
+    thread and swaps it into MEM. Lookups keep using the old index until the swap; commits
+    that land during the build are replayed into the new one under _commit_lock first.
+    """
+    def __init__(self, interval: float = MEM_WATCH_SEC):
+        self.interval = interval
+        self.known = MEM.source           # fingerprint MEM reflects, including our own commits
+        self.seen = MEM.source            # fingerprint at the last poll
+        self._pending: Optional[Dict[str, List[Dict[str, Any]]]] = None   # commits seen mid-rebuild
+        self._chain: List[str] = []       # mid-rebuild: fingerprints the store passed through by our commits only
+        self._lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self.rebuilds = 0
+        self.last_rebuild_ms = 0.0
+        self.last_reason = ""
+        self.last_error = ""
+
+    def note_commit(self, key: str, items: List[Dict[str, Any]], before: str, after: str):
+        """Called under _commit_lock after our own upsert."""
+        if self._pending is not None:
+            self._pending[key] = items
+            if self._chain and before == self._chain[-1]:
+                self._chain.append(after)
+            else:                         # someone else wrote in between: restart from what we saw
+                self._chain = [before, after]
+        if before == self.known:
+            self.known = after            # the store only moved by our write; no rebuild needed
+
+    def _swap(self, new: "MemIndex"):
+        global MEM
+        with _commit_lock:
+            for key, items in (self._pending or {}).items():
+                new.add_or_update_key(key, items)
+            new.generation = MEM.generation + 1
+            # the build read the store at new.source; if only our (replayed) commits moved it
+            # since, MEM now reflects the end of the chain. Otherwise an outside write may be
+            # missing and the next poll rebuilds again.
+            if new.source in self._chain:
+                self.known = self._chain[-1]
+            else:
+                self.known = new.source
+            self._pending, self._chain = None, []
+            MEM = new
+
+    def _begin(self):
+        with _commit_lock:
+            self._pending = {}
+            self._chain = [COMMIT_STORE.fingerprint()]
+
+    async def rebuild(self, reason: str) -> bool:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        if self._lock.locked():
+            return False                  # one is already running; it will pick this change up
+        async with self._lock:
+            t0 = time.perf_counter()
+            try:
+                await asyncio.to_thread(self._begin)
+                new = await asyncio.to_thread(MemIndex, COMMIT_STORE, MEM.backend, MEM.snapshot_path,
+                                                retrieval=MEM.retrieval)
+                await asyncio.to_thread(self._swap, new)
+            except Exception as e:
+                with _commit_lock:
+                    self._pending, self._chain = None, []
+                self.last_error = f"{type(e).__name__}: {e}"
+                log_mem.warning("rebuild failed: %s", self.last_error)
+                return False
+            dt = time.perf_counter() - t0
+            self.rebuilds += 1
+            self.last_rebuild_ms, self.last_reason, self.last_error = round(1000 * dt, 1), reason, ""
+            METRICS.observe("qr_mem_rebuild_seconds", dt)
+            METRICS.inc("qr_mem_rebuilds_total", reason=reason)
+            log_mem.info("rebuilt index reason=%s keys=%d generation=%d in %.0fms", reason, len(MEM),
+                         MEM.generation, 1000 * dt)
+            return True
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                fp = await asyncio.to_thread(COMMIT_STORE.fingerprint)
+            except Exception as e:
+                log_mem.warning("fingerprint failed: %s", e)
+                continue
+            self.seen = fp
+            if fp != self.known:
+                await self.rebuild("store_changed")
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        mem = MEM
+        return {"keys": len(mem), "generation": mem.generation, "backend": mem.retrieval if mem.encoder is not None else mem.backend,
+                "snapshot": mem._base is not None, "overlay_keys": len(mem._recs),
+                "stale": self.seen != self.known, "rebuilds": self.rebuilds,
+                "last_rebuild_ms": self.last_rebuild_ms, "last_reason": self.last_reason,
+                "last_error": self.last_error, "rebuilding": bool(self._lock and self._lock.locked())}
+
+MEM_WATCHER = MemWatcher()
 
 # ---- Style rubric + exemplars ----
 STYLE_RUBRIC = """
@@ -381,24 +1260,81 @@ SPICE4_LIST = [
 SPICE4_RX = re.compile("|".join(SPICE4_LIST), re.I)
 
 # ========= FEEDBACK-AWARE FEW-SHOTS =========
+LIKED_LABELS = ("up", "clicked", "like", "liked")
+EXEMPLAR_RING = int(os.getenv("QR_EXEMPLAR_RING", "32"))  # liked exemplars kept per stage (and overall)
+
+class ExemplarPool:
+    """
+    Liked (latest, option) pairs kept in memory, newest first:
+    one recency ring per stage, one for rows without a stage, and one overall.
+    Cold-loaded from the feedback table at startup and updated in place by /feedback,
+    so generation never touches SQLite.
+    """
+    def __init__(self, ring: int = EXEMPLAR_RING):
+        self.ring = max(1, ring)
+        self._lock = threading.Lock()
+        self._by_stage: Dict[str, deque] = {}
+        self._unstaged: deque = deque(maxlen=self.ring)
+        self._all: deque = deque(maxlen=self.ring)
+        self.generation = 0   # bumped on every change; part of the response cache key
+
+    def load(self, db: sqlite3.Connection):
+        marks = ",".join("?" * len(LIKED_LABELS))
+        q = "SELECT ts, stage, latest, option FROM feedback WHERE label IN (%s) {where} ORDER BY ts DESC LIMIT ?" % marks
+        rows = db.execute(q.format(where=""), (*LIKED_LABELS, self.ring)).fetchall()
+        rows += db.execute(q.format(where="AND (stage IS NULL OR stage = '')"), (*LIKED_LABELS, self.ring)).fetchall()
+        for st in STAGES:
+            rows += db.execute(q.format(where="AND stage = ?"), (*LIKED_LABELS, st, self.ring)).fetchall()
+        # replay oldest -> newest so every ring ends up newest-first; the overall ring dedupes by row
+        seen = set()
+        with self._lock:
+            self._by_stage.clear(); self._unstaged.clear(); self._all.clear()
+            for ts, st, latest, opt in sorted(rows, key=lambda r: r[0] or 0):
+                key = (ts, st, latest, opt)
+                if key in seen:
+                    continue
+                seen.add(key)
+                self._add_locked(ts or 0, st, latest, opt)
+            self.generation += 1
+        log_feedback.info("exemplar pool loaded stages=%d total=%d", len(self._by_stage), len(self._all))
+
+    def _add_locked(self, ts: int, stage: Optional[str], latest: Optional[str], option: Optional[str]) -> bool:
+        latest = latest or ""
+        opt = (option or "").strip()
+        if not (latest and opt):
+            return False
+        ent = (ts, latest, opt)
+        self._all.appendleft(ent)
+        if stage:
+            ring = self._by_stage.get(stage)
+            if ring is None:
+                ring = self._by_stage[stage] = deque(maxlen=self.ring)
+            ring.appendleft(ent)
+        else:
+            self._unstaged.appendleft(ent)
+        return True
+
+    def add(self, ts: int, stage: Optional[str], latest: Optional[str], option: Optional[str], label: str):
+        if label not in LIKED_LABELS:
+            return
+        with self._lock:
+            if self._add_locked(ts, stage, latest, option):
+                self.generation += 1
+
+    def get(self, k: int, stage: Optional[str] = None) -> List[Tuple[int, str, str]]:
+        with self._lock:
+            if not stage:
+                return list(self._all)[:k]
+            # stage-specific rows plus rows that never recorded a stage, newest first
+            both = list(self._by_stage.get(stage, ())) + list(self._unstaged)
+        both.sort(key=lambda e: e[0], reverse=True)
+        return both[:k]
+
+EXEMPLAR_POOL = ExemplarPool()
+EXEMPLAR_POOL.load(DB.reader())
+
 def liked_exemplars(k: int = 6, stage: Optional[str] = None):
-    try:
-        rows = conn.execute(
-            "SELECT latest, option, stage FROM feedback WHERE label IN ('up','clicked','like','liked') "
-            "ORDER BY ts DESC LIMIT ?", (max(6, k),)
-        ).fetchall()
-        out = []
-        for latest, opt, st in rows:
-            latest = latest or ""
-            opt = (opt or "").strip()
-            if not (latest and opt):
-                continue
-            if stage and st and st != stage:
-                continue
-            out.append( (f"She: {latest}", {"options":[opt]}) )
-        return out
-    except Exception:
-        return []
+    return [(f"She: {latest}", {"options":[opt]}) for _, latest, opt in EXEMPLAR_POOL.get(k, stage)]
 
 # ---- Opener fallbacks ----
 OPENER_FALLBACKS = [
@@ -430,62 +1366,544 @@ def score_line(s: str, spice: int) -> float:
 def strip_winks(s: str) -> str:
     return re.sub(WINK_EMOJI_RX, "", s)
 
-# ---- single-flight + throttle state ----
-_openai_lock = asyncio.Semaphore(1)
-_last_call_ms = 0
+# ================== UPSTREAM RATE LIMITER ==================
+_DUR_RX = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
 
-async def _throttle():
-    global _last_call_ms
-    now = int(time.time() * 1000)
-    wait_ms = (_last_call_ms + MIN_INTERVAL_MS) - now
-    if wait_ms > 0:
-        await asyncio.sleep(wait_ms / 1000.0)
-    _last_call_ms = int(time.time() * 1000)
+def _parse_duration(v: Optional[str]) -> Optional[float]:
+    """'1s', '6m0s', '250ms', '0.5' -> seconds."""
+    if not v: return None
+    v = v.strip()
+    try:
+        return float(v)
+    except ValueError:
+        pass
+    parts = _DUR_RX.findall(v)
+    if not parts: return None
+    mult = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+    return sum(float(n) * mult[u] for n, u in parts)
 
-async def openai_chat_async(messages, temperature=0.2, max_tokens=200, timeout=18) -> str:
-    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
-    payload = {"model": MODEL, "messages": messages, "temperature": temperature, "max_tokens": max_tokens, "n": 1}
-    async with _openai_lock:
-        await _throttle()
-        attempt, last_err = 0, None
-        while attempt < MAX_RETRIES:
-            attempt += 1
+def _hdr_float(headers, name: str) -> Optional[float]:
+    try:
+        v = headers.get(name)
+        return float(v) if v is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def _retry_after_sec(headers) -> Optional[float]:
+    ms = _hdr_float(headers, "retry-after-ms")
+    if ms is not None:
+        return ms / 1000.0
+    return _hdr_float(headers, "retry-after")
+
+def _estimate_tokens(messages: List[Dict[str, Any]], max_tokens: int) -> int:
+    # ~4 chars per token plus per-message framing; completion budget counts against TPM too
+    chars = sum(len(str(m.get("content") or "")) for m in messages)
+    return chars // 4 + 4 * len(messages) + int(max_tokens)
+
+class TokenBucket:
+    """Continuously refilled bucket: `per_minute` tokens/min, holds LIMIT_BURST_SEC worth of tokens."""
+    def __init__(self, per_minute: float):
+        self.base_rate = max(per_minute, 1.0) / 60.0
+        self.rate = self.base_rate
+        self.capacity = max(1.0, self.base_rate * LIMIT_BURST_SEC)
+        self.tokens = self.capacity
+        self._ts = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self._ts:
+            self.tokens = min(self.capacity, self.tokens + (now - self._ts) * self.rate)
+            self._ts = now
+
+    def wait_time(self, cost: float, now: float) -> float:
+        self._refill(now)
+        cost = min(cost, self.capacity)
+        if self.tokens >= cost: return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def take(self, cost: float, now: float):
+        self._refill(now)
+        self.tokens -= min(cost, self.capacity)
+
+    def give_back(self, amount: float):
+        # reconcile an estimate with actual usage (negative amount charges extra)
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def cap_to(self, remaining: float):
+        # the server's view of our remaining quota wins over the local estimate
+        self.tokens = min(self.tokens, remaining)
+
+class RateLimiter:
+    """
+    RPM + TPM token buckets with bounded concurrency for upstream calls.
+    - acquire a slot with `async with LIMITER.slot(est_tokens):`
+    - `observe()` feeds response status/headers back: x-ratelimit-remaining-* caps the buckets,
+      retry-after / exhausted quota blocks everyone until reset, 429s halve the rate and
+      successes slowly restore it (AIMD)
+    """
+    def __init__(self, rpm: float, tpm: float, concurrency: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.concurrency = max(1, concurrency)
+        self.scale = 1.0
+        self._sem: Optional[asyncio.Semaphore] = None  # created lazily on the serving loop
+        self._blocked_until = 0.0
+        self._last_cut = 0.0   # one rate cut per burst of 429s, not one per concurrent caller
+        # stats
+        self.waiting = 0
+        self.inflight = 0
+        self.granted = 0
+        self.throttled = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_last = 0.0
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.concurrency)
+        return self._sem
+
+    async def _take(self, est_tokens: int):
+        while True:
+            now = time.monotonic()
+            delay = self._blocked_until - now
+            if delay <= 0:
+                delay = max(self.requests.wait_time(1, now), self.tokens.wait_time(est_tokens, now))
+                if delay <= 0:
+                    self.requests.take(1, now)
+                    self.tokens.take(est_tokens, now)
+                    return
+            await asyncio.sleep(delay)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, est_tokens: int):
+        t0 = time.monotonic()
+        sem = self._semaphore()
+        self.waiting += 1
+        try:
+            await sem.acquire()
             try:
-                async with httpx.AsyncClient(timeout=timeout) as client:
-                    r = await client.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-                if r.status_code == 429 or r.status_code >= 500:
-                    ra = r.headers.get("retry-after")
-                    if ra and ra.isdigit():
-                        delay = min(BACKOFF_CAP_SEC, int(ra))
+                await self._take(est_tokens)
+            except BaseException:
+                sem.release()
+                raise
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - t0
+        METRICS.observe("qr_limiter_wait_seconds", waited)
+        self.granted += 1
+        self.wait_total += waited
+        self.wait_last = waited
+        self.wait_max = max(self.wait_max, waited)
+        if waited > 0.05:
+            self.throttled += 1
+        self.inflight += 1
+        try:
+            yield waited
+        finally:
+            self.inflight -= 1
+            sem.release()
+
+    def _set_scale(self, scale: float):
+        self.scale = max(LIMIT_MIN_SCALE, min(1.0, scale))
+        self.requests.rate = self.requests.base_rate * self.scale
+        self.tokens.rate = self.tokens.base_rate * self.scale
+
+    def block_for(self, seconds: float):
+        self._blocked_until = max(self._blocked_until, time.monotonic() + max(0.0, seconds))
+
+    def observe(self, status: int, headers, est_tokens: int = 0, used_tokens: Optional[int] = None):
+        rem_req = _hdr_float(headers, "x-ratelimit-remaining-requests")
+        rem_tok = _hdr_float(headers, "x-ratelimit-remaining-tokens")
+        if rem_req is not None:
+            self.requests.cap_to(rem_req)
+            if rem_req <= 0:
+                self.block_for(_parse_duration(headers.get("x-ratelimit-reset-requests")) or 1.0)
+        if rem_tok is not None:
+            self.tokens.cap_to(rem_tok)
+            if rem_tok <= 0:
+                self.block_for(_parse_duration(headers.get("x-ratelimit-reset-tokens")) or 1.0)
+        if used_tokens is not None and est_tokens:
+            self.tokens.give_back(est_tokens - used_tokens)
+        if status == 429:
+            ra = _retry_after_sec(headers)
+            if ra is not None:
+                self.block_for(min(BACKOFF_CAP_SEC, ra))
+            now = time.monotonic()
+            if now - self._last_cut >= 1.0:
+                self._last_cut = now
+                self._set_scale(self.scale * 0.5)
+                log_limiter.warning("429 -> rate scale %.2f", self.scale)
+        elif 200 <= status < 300 and self.scale < 1.0:
+            self._set_scale(self.scale + 0.05)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "queue_depth": self.waiting,
+            "inflight": self.inflight,
+            "concurrency": self.concurrency,
+            "granted": self.granted,
+            "throttled": self.throttled,
+            "wait_avg_ms": round(1000 * self.wait_total / self.granted, 1) if self.granted else 0.0,
+            "wait_max_ms": round(1000 * self.wait_max, 1),
+            "wait_last_ms": round(1000 * self.wait_last, 1),
+            "rate_scale": round(self.scale, 3),
+            "blocked_for_ms": round(max(0.0, self._blocked_until - now) * 1000, 1),
+            "rpm": round(self.requests.rate * 60, 1),
+            "tpm": round(self.tokens.rate * 60, 1),
+            "requests_available": round(self.requests.tokens, 1),
+            "tokens_available": round(self.tokens.tokens, 1),
+        }
+
+LIMITER = RateLimiter(LIMIT_RPM, LIMIT_TPM, LIMIT_CONCURRENCY)
+
+def _observe_usage(usage: Optional[Dict[str, Any]]):
+    for kind in ("prompt_tokens", "completion_tokens"):
+        v = (usage or {}).get(kind)
+        if isinstance(v, (int, float)):
+            METRICS.observe("qr_upstream_tokens", v, kind=kind.split("_")[0])
+
+async def _retry_sleep(delay: float):
+    METRICS.inc("qr_upstream_retries_total")
+    METRICS.observe("qr_upstream_backoff_seconds", delay)
+    await asyncio.sleep(delay)
+
+def _backoff_delay(attempt: int, headers) -> float:
+    ra = _retry_after_sec(headers)
+    if ra is not None:
+        return min(BACKOFF_CAP_SEC, ra)
+    base = BACKOFF_BASE_SEC * (2 ** (attempt - 1))
+    return min(BACKOFF_CAP_SEC, base + random.uniform(0, 0.75))
+
+# ================== HEDGING ==================
+def _usable(t: "asyncio.Task") -> bool:
+    return not t.cancelled() and t.exception() is None and t.result().status_code < 500 and t.result().status_code != 429
+
+class Hedger:
+    """
+    Races a duplicate of a slow upstream attempt. Once an attempt has been upstream (holding
+    its LIMITER slot) past the HEDGE_PCT percentile of recent upstream latencies (at least
+    HEDGE_MIN_SEC), a second identical attempt starts; the first usable response wins and the
+    other is cancelled. Time queued in the limiter is local backpressure, not upstream
+    slowness: it neither starts the clock nor counts in the samples. Each attempt takes its
+    own LIMITER slot, so the duplicate is charged to RPM/TPM and concurrency like any call (a
+    cancelled one keeps its charge: the provider may have done the work), and a losing
+    429/5xx is still fed to LIMITER.observe.
+    Every call earns HEDGE_BUDGET credit (capped), each duplicate spends 1, so duplicates
+    stay under that share of upstream calls.
+    Saved latency is an estimate: for a winning hedge, the mean of recent latencies beyond the
+    primary's time upstream so far, minus that time, i.e. how much longer it would likely have taken.
+    Used from the event loop only.
+    """
+    def __init__(self, pct: float, min_delay: float, budget: float, window: int, min_samples: int):
+        self.pct = pct
+        self.min_delay = min_delay
+        self.budget = budget
+        self.min_samples = max(1, min_samples)
+        self._lat: deque = deque(maxlen=max(1, window))
+        self.cap = max(1.0, budget * window)
+        self.credit = 0.0
+        self.calls = self.fired = self.won = self.no_budget = 0
+        self.saved_total = 0.0
+
+    def delay(self) -> Optional[float]:
+        if len(self._lat) < self.min_samples:
+            return None
+        xs = sorted(self._lat)
+        return max(self.min_delay, xs[min(len(xs) - 1, int(self.pct / 100.0 * len(xs)))])
+
+    def _saved(self, at: float) -> float:
+        tail = [x for x in self._lat if x > at]
+        return sum(tail) / len(tail) - at if tail else 0.0
+
+    async def run(self, fn):
+        """fn(sent) -> httpx.Response for one attempt, resolving SENT once it holds its LIMITER slot."""
+        self.calls += 1
+        self.credit = min(self.cap, self.credit + self.budget)
+        delay = self.delay()
+        loop = asyncio.get_running_loop()
+        sent = [loop.create_future()]
+        first = asyncio.ensure_future(fn(sent[0]))
+        tasks = [first]
+        try:
+            if delay is not None:
+                await asyncio.wait([first, sent[0]], return_when=asyncio.FIRST_COMPLETED)
+                if not first.done():
+                    await asyncio.wait(tasks, timeout=delay)
+                if not first.done():
+                    if self.credit >= 1.0:
+                        self.credit -= 1.0
+                        self.fired += 1
+                        METRICS.inc("qr_hedge_total", outcome="fired")
+                        sent.append(loop.create_future())
+                        tasks.append(asyncio.ensure_future(fn(sent[1])))
                     else:
-                        base = BACKOFF_BASE_SEC * (2 ** (attempt - 1))
-                        delay = min(BACKOFF_CAP_SEC, base + random.uniform(0, 0.75))
-                    print(f"[QR][openai] {r.status_code} -> backoff {delay:.2f}s (attempt {attempt}/{MAX_RETRIES})")
-                    last_err = r.text
-                    await asyncio.sleep(delay); continue
-                r.raise_for_status()
-                data = r.json()
-                content = (data.get("choices", [{}])[0].get("message", {}) or {}).get("content", "") or ""
-                print(f"[QR][openai] ok in attempt {attempt}, len={len(content)}")
-                return content
-            except Exception as e:
-                last_err = str(e)
-                delay = min(BACKOFF_CAP_SEC, BACKOFF_BASE_SEC + random.uniform(0, 0.5))
-                print(f"[QR][openai][exception] {type(e).__name__}: {e} -> sleep {delay:.2f}s (attempt {attempt}/{MAX_RETRIES})")
-                await asyncio.sleep(delay)
-        print("[QR][openai][giveup]", last_err)
-        return ""
-
-async def openai_chat_json(messages, temperature=0.7, max_tokens=120, timeout=18) -> Dict[str, Any]:
-    content = await openai_chat_async(messages, temperature=temperature, max_tokens=max_tokens, timeout=timeout)
+                        self.no_budget += 1
+                        METRICS.inc("qr_hedge_total", outcome="no_budget")
+            pending = set(tasks)
+            winner = None
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((t for t in tasks if t in done and _usable(t)), None)
+            if winner is None:                              # all failed: hand back a response over an error
+                winner = next((t for t in tasks if t.exception() is None), first)
+            for t in tasks:                                 # the caller observes only the winner
+                if t is not winner and t.done() and not t.cancelled() and t.exception() is None and not _usable(t):
+                    r = t.result()
+                    LIMITER.observe(r.status_code, r.headers)
+                    if r.status_code == 429:
+                        METRICS.inc("qr_upstream_429_total")
+            now = time.monotonic()
+            if len(tasks) > 1 and winner is tasks[1] and _usable(winner):
+                primary = now - sent[0].result()
+                saved = self._saved(primary)
+                self.won += 1
+                self.saved_total += saved
+                METRICS.inc("qr_hedge_total", outcome="won")
+                METRICS.observe("qr_hedge_saved_seconds", saved)
+                # samples are per attempt: the duplicate's own time, and the primary's so far
+                # (a lower bound) so cancelled slow calls still weigh on the percentile
+                self._lat.append(now - sent[1].result())
+                self._lat.append(primary)
+            elif _usable(winner):
+                if len(tasks) > 1:
+                    METRICS.inc("qr_hedge_total", outcome="lost")
+                self._lat.append(now - sent[0].result())
+            return winner.result()
+        finally:
+            for t in tasks:
+                if not t.done():
+                    t.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        d = self.delay()
+        return {"enabled": HEDGE_ENABLE, "calls": self.calls, "fired": self.fired, "won": self.won,
+                "no_budget": self.no_budget, "credit": round(self.credit, 2),
+                "delay_ms": round(d * 1000, 1) if d is not None else None,
+                "saved_total_sec": round(self.saved_total, 3)}
+
+HEDGER = Hedger(HEDGE_PCT, HEDGE_MIN_SEC, HEDGE_BUDGET, HEDGE_WINDOW, HEDGE_MIN_SAMPLES)
+
+# ================== SINGLE-FLIGHT ==================
+class SingleFlight:
+    """
+    Concurrent callers with the same key await one shared task instead of repeating the work.
+    The task is shielded, so a caller that disconnects doesn't cancel it for the others.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[str, "asyncio.Future"] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn) -> Tuple[Any, bool]:
+        """Returns (result, shared) where shared=True means another caller's task was joined."""
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task), True
+        task = asyncio.ensure_future(fn())
+        self._inflight[key] = task
+        self.leaders += 1
+
+        def _done(t, key=key):
+            if self._inflight.get(key) is t:
+                del self._inflight[key]
+        task.add_done_callback(_done)
+        return await asyncio.shield(task), False
+
+    def stats(self) -> Dict[str, Any]:
+        return {"inflight": len(self._inflight), "leaders": self.leaders, "coalesced": self.coalesced}
+
+OPENAI_FLIGHT = SingleFlight("openai")
+
+def _payload_key(payload: Dict[str, Any]) -> str:
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+async def openai_chat_async(messages, temperature=0.2, max_tokens=200, timeout=None, response_format=None) -> str:
+    payload = {"model": MODEL, "messages": messages, "temperature": temperature, "max_tokens": max_tokens, "n": 1}
+    if response_format:
+        payload["response_format"] = response_format
+    if not COALESCE_ENABLE:
+        return await _openai_chat(payload, timeout)
+    content, shared = await OPENAI_FLIGHT.do(_payload_key(payload), lambda: _openai_chat(payload, timeout))
+    if shared:
+        log_openai.debug("coalesced with in-flight call")
+    return content
+
+async def _post_once(payload: Dict[str, Any], headers: Dict[str, str], est: int, timeout=None,
+                     sent: Optional["asyncio.Future"] = None) -> httpx.Response:
+    async with LIMITER.slot(est):
+        if sent is not None and not sent.done():
+            sent.set_result(time.monotonic())   # for Hedger: the upstream clock starts here
+        t0, status = time.perf_counter(), "error"
+        try:
+            r = await http_client().post(f"{OPENAI_BASE_URL}/chat/completions", headers=headers,
+                                         json=payload, timeout=_http_timeout(timeout))
+            status = r.status_code
+        except asyncio.CancelledError:
+            status = "cancelled"      # lost a hedge race
+            raise
+        finally:
+            METRICS.observe("qr_upstream_attempt_seconds", time.perf_counter() - t0, status=status)
+            METRICS.inc("qr_upstream_requests_total", status=status)
+    return r
+
+async def _openai_chat(payload: Dict[str, Any], timeout=None) -> str:
+    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
+    est = _estimate_tokens(payload["messages"], payload["max_tokens"])
+    attempt, last_err = 0, None
+    while attempt < MAX_RETRIES:
+        attempt += 1
+        try:
+            if HEDGE_ENABLE:
+                r = await HEDGER.run(lambda sent: _post_once(payload, headers, est, timeout, sent))
+            else:
+                r = await _post_once(payload, headers, est, timeout)
+            if r.status_code == 429 or r.status_code >= 500:
+                LIMITER.observe(r.status_code, r.headers)
+                if r.status_code == 429:
+                    METRICS.inc("qr_upstream_429_total")
+                delay = _backoff_delay(attempt, r.headers)
+                log_openai.warning("%s -> backoff %.2fs (attempt %d/%d)", r.status_code, delay, attempt, MAX_RETRIES)
+                last_err = r.text
+                await _retry_sleep(delay); continue
+            r.raise_for_status()
+            data = r.json()
+            usage = data.get("usage") or {}
+            LIMITER.observe(r.status_code, r.headers, est, usage.get("total_tokens"))
+            _observe_usage(usage)
+            content = (data.get("choices", [{}])[0].get("message", {}) or {}).get("content", "") or ""
+            log_openai.debug("ok in attempt %d, len=%d", attempt, len(content))
+            return content
+        except Exception as e:
+            last_err = str(e)
+            delay = min(BACKOFF_CAP_SEC, BACKOFF_BASE_SEC + random.uniform(0, 0.5))
+            log_openai.warning("%s: %s -> sleep %.2fs (attempt %d/%d)", type(e).__name__, e, delay, attempt, MAX_RETRIES)
+            await _retry_sleep(delay)
+    METRICS.inc("qr_upstream_giveups_total")
+    log_openai.error("giveup: %s", last_err)
+    return ""
+
+async def openai_chat_json(messages, temperature=0.7, max_tokens=120, timeout=None, response_format=None) -> Dict[str, Any]:
+    content = await openai_chat_async(messages, temperature=temperature, max_tokens=max_tokens, timeout=timeout,
+                                      response_format=response_format)
     try:
         start = content.find("{"); end = content.rfind("}")
         if start != -1 and end != -1: content = content[start:end+1]
         return json.loads(content)
     except Exception:
+        if content:
+            METRICS.inc("qr_parse_failures_total")
         return {}
 
 # ================== SPICE CUES ==================
+_HOT_CUES = ("desire", "touch", "proximity", "tease", "wink", "erotic_q", "readiness")   # mutual + latest nudge
+_STREAK_CUES = ("desire", "touch", "erotic_q", "readiness", "wink")
+_WINDOW_CUES = ("desire", "touch", "proximity", "body", "permission", "exclusive", "sensory", "command", "tease",
+                "wink", "erotic_q", "readiness", "invite", "green_up", "red_down")   # spice4 only matters at level 3+
+
+class CueScanner:
+    """
+    Which cue patterns occur in a text, as a bitmask. A message's bits are computed once and
+    cached, so a thread only pays for messages it hasn't sent before; later requests OR them.
+
+    joined() answers for " ".join of several messages: a cue found in any message is in the
+    joined text too, and a cue that cannot match across a space cannot appear only at a
+    boundary, so just the cues that are still missing and can span a space (a phrase like
+    "come" / "over" split over two messages) are searched for in the joined text.
+    """
+    _SPANS = (" ", r"\s", ".", r"\W", "[^")   # pattern pieces that can match a space
+
+    def __init__(self, cues: List[Tuple[str, "re.Pattern"]], maxsize: int = CUE_CACHE_SIZE):
+        self.names = [n for n, _ in cues]
+        self.bit = {n: 1 << i for i, n in enumerate(self.names)}
+        self._rx = [(1 << i, rx) for i, (_, rx) in enumerate(cues)]
+        self._all = (1 << len(cues)) - 1
+        self._spans = sum(b for b, rx in self._rx if any(p in rx.pattern for p in self._SPANS))
+        # multi-word slang keys ("no cap") expand differently once two messages are joined
+        self._slang_splits = [(k[:i], k[i + 1:]) for k in _SLANG for i, ch in enumerate(k) if ch == " "]
+        self.maxsize = max(1, maxsize)
+        self._masks: "OrderedDict[str, int]" = OrderedDict()
+        self._msgs: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        self._lock = threading.Lock()     # infer_spice runs on worker threads
+        self.hits = self.misses = 0
+
+    def _scan(self, text: str, bits: int) -> int:
+        # one search per cue: each keeps re's literal-prefix skip, which a combined
+        # alternation loses (measured 2-4x slower in CPython's backtracking engine)
+        mask = 0
+        for b, rx in self._rx:
+            if b & bits and rx.search(text):
+                mask |= b
+        return mask
+
+    def _cached(self, d: "OrderedDict[str, Any]", key: str, make) -> Any:
+        with self._lock:
+            v = d.get(key)
+            if v is not None:
+                d.move_to_end(key)
+                self.hits += 1
+                return v
+            self.misses += 1
+        v = make(key)
+        with self._lock:
+            d[key] = v
+            while len(d) > self.maxsize:
+                d.popitem(last=False)
+        return v
+
+    def mask(self, text: str) -> int:
+        """Cue bits of TEXT as given."""
+        return self._cached(self._masks, text, lambda t: self._scan(t, self._all))
+
+    def _message(self, text: str) -> Tuple[str, int]:
+        # lower() then expand_slang(), as infer_spice reads a message, and its cue bits
+        def make(t: str) -> Tuple[str, int]:
+            exp = expand_slang(t.lower())
+            return exp, self.mask(exp)
+        return self._cached(self._msgs, text, make)
+
+    def _straddles(self, left: str, right: str) -> bool:
+        return any(left.endswith(a) and right.startswith(b) for a, b in self._slang_splits)
+
+    def joined(self, texts: List[str], *want: str) -> int:
+        """Bits of the WANT cues (default all) in expand_slang(" ".join(TEXTS).lower())."""
+        bits = sum(self.bit[n] for n in want) if want else self._all
+        if self._slang_splits and len(texts) > 1:
+            runs = [texts[0]]
+            for t in texts[1:]:
+                if self._straddles(runs[-1].lower(), t.lower()):
+                    runs[-1] = runs[-1] + " " + t       # slang spans the boundary: expand the pair as one
+                else:
+                    runs.append(t)
+            texts = runs
+        msgs = [self._message(t) for t in texts]
+        mask = 0
+        for _, m in msgs:
+            mask |= m
+        mask &= bits
+        missing = bits & self._spans & ~mask
+        if missing and len(msgs) > 1:
+            mask |= self._scan(" ".join(exp for exp, _ in msgs), missing)
+        return mask
+
+    def has(self, mask: int, *names: str) -> bool:
+        return any(mask & self.bit[n] for n in names)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"size": len(self._masks) + len(self._msgs), "hits": self.hits, "misses": self.misses}
+
+CUES = CueScanner([
+    ("desire", DESIRE_RX), ("touch", TOUCH_RX), ("proximity", PROX_RX), ("body", BODY_RX),
+    ("permission", PERMISSION_RX), ("exclusive", EXCLUSIVE_RX), ("sensory", SENSORY_RX),
+    ("command", COMMAND_RX), ("tease", TEASE_RX), ("wink", WINK_OR_SMIRK), ("erotic_q", EROTIC_Q_RX),
+    ("readiness", READINESS_RX), ("invite", INVITE_RX), ("green_up", GREEN_UP), ("red_down", RED_DOWN),
+    ("spice4", SPICE4_RX),
+])
+
+@METRICS.timed("infer_spice")
 def infer_spice(history: List[Msg], latest: str, k:int=CONTEXT_WINDOW) -> Tuple[int, Dict[str,Any]]: #infers spice level from 0-4 based on cues
     """
     Heuristic heat detector over last k turns:
@@ -494,65 +1912,62 @@ def infer_spice(history: List[Msg], latest: str, k:int=CONTEXT_WINDOW) -> Tuple[
     - reciprocity bonus (both roles hot)
     - softer cooling from RED_DOWN to avoid false drops
     - Spice-4 triggers escalate above level 3 when explicit invite phrases appear
+    Cue hits come from CUES (one cached scan per message); check_spice.py holds the
+    per-regex version this must agree with.
     """
     window = history[-k:]
-    window_text = " ".join(m.text for m in window if m.text).lower()
-    window_text = expand_slang(window_text)  
-    latest_low  = expand_slang((latest or "").lower()) 
+    win_texts = [m.text for m in window if m.text]
+    win = CUES.joined(win_texts, *_WINDOW_CUES)
+    lat = CUES.mask(expand_slang((latest or "").lower()))
 
     score = 1.0
     hits: List[Tuple[str,str]] = []
 
-    def bump(rx: re.Pattern, w: float, tag: str):
+    def bump(cue: str, w: float, tag: str):
         nonlocal score
-        if rx.search(window_text):
+        if CUES.has(win, cue):
             score += w
             hits.append((tag, "win"))
 
     # strong up-signals
-    bump(DESIRE_RX,     1.0, "desire")
-    bump(TOUCH_RX,      1.0, "touch")
-    bump(PROX_RX,       0.9, "proximity")
-    bump(BODY_RX,       0.7, "body")
-    bump(PERMISSION_RX, 0.4, "permission")
-    bump(EXCLUSIVE_RX,  0.4, "exclusive")
-    bump(SENSORY_RX,    0.6, "sensory")
-    bump(COMMAND_RX,    0.4, "command")
-    bump(TEASE_RX,      0.6, "tease")
-    bump(WINK_OR_SMIRK, 0.8, "wink")
-    bump(EROTIC_Q_RX,   1.2, "erotic_q")
-    bump(READINESS_RX,  0.9, "readiness")
-    bump(INVITE_RX,     0.5, "invite")
+    bump("desire",     1.0, "desire")
+    bump("touch",      1.0, "touch")
+    bump("proximity",  0.9, "proximity")
+    bump("body",       0.7, "body")
+    bump("permission", 0.4, "permission")
+    bump("exclusive",  0.4, "exclusive")
+    bump("sensory",    0.6, "sensory")
+    bump("command",    0.4, "command")
+    bump("tease",      0.6, "tease")
+    bump("wink",       0.8, "wink")
+    bump("erotic_q",   1.2, "erotic_q")
+    bump("readiness",  0.9, "readiness")
+    bump("invite",     0.5, "invite")
 
     # reciprocity bonus (both sides spicy)
-    them_text = expand_slang(" ".join(m.text for m in window if m.role=="them")).lower()
-    you_text  = expand_slang(" ".join(m.text for m in window if m.role=="you")).lower()
-    mutual = 0
-    for rx in (DESIRE_RX, TOUCH_RX, PROX_RX, TEASE_RX, WINK_OR_SMIRK, EROTIC_Q_RX, READINESS_RX):
-        if rx.search(them_text) and rx.search(you_text): mutual += 1
+    them = CUES.joined([m.text or "" for m in window if m.role=="them"], *_HOT_CUES)
+    them_hot = [c for c in _HOT_CUES if CUES.has(them, c)]
+    you  = CUES.joined([m.text or "" for m in window if m.role=="you"], *them_hot) if them_hot else 0
+    mutual = sum(1 for cue in _HOT_CUES if CUES.has(them, cue) and CUES.has(you, cue))
     if mutual:
         score += 0.45 * mutual
         hits.append(("mutual", str(mutual)))
 
     # consecutive-hot bonus
     last4 = [m for m in window if m.text][-4:] # if last 4 consecutive messages from them are spicy, gives streak bonus 
-    hot_theirs = sum(1 for m in last4 if m.role=="them" and ( 
-        DESIRE_RX.search(m.text.lower()) or TOUCH_RX.search(m.text.lower()) or
-        EROTIC_Q_RX.search(m.text.lower()) or READINESS_RX.search(m.text.lower()) or
-        WINK_OR_SMIRK.search(m.text) 
-    ))
+    hot_theirs = sum(1 for m in last4 if m.role=="them" and CUES.has(CUES.mask(m.text.lower()), *_STREAK_CUES))
     if hot_theirs >= 2: #if at least 2 of their last 4 messages are spicy, add .8 to score
         score += 0.8
         hits.append(("streak", str(hot_theirs)))
 
     # legacy soft cues 
     red_hit = False
-    if GREEN_UP.search(window_text): score += 0.6; hits.append(("green_up","1"))
-    if RED_DOWN.search(window_text): 
+    if CUES.has(win, "green_up"): score += 0.6; hits.append(("green_up","1"))
+    if CUES.has(win, "red_down"): 
         score -= 0.35; hits.append(("red_down","1")); red_hit = True
 
     # latest nudge
-    if any(rx.search(latest_low) for rx in (DESIRE_RX, TOUCH_RX, PROX_RX, TEASE_RX, WINK_OR_SMIRK, EROTIC_Q_RX, READINESS_RX)):
+    if CUES.has(lat, *_HOT_CUES):
         score += 0.8; hits.append(("latest_hot","1"))
 
     # thresholds tuned (base 0–3)
@@ -567,14 +1982,24 @@ def infer_spice(history: List[Msg], latest: str, k:int=CONTEXT_WINDOW) -> Tuple[
         lvl = max(lvl, MIN_SPICE_FLOOR)
 
     # ---- Spice-4 escalation on explicit invites  ----
-    if lvl >= 3 and (SPICE4_RX.search(window_text) or SPICE4_RX.search(latest_low)):
+    if lvl >= 3 and CUES.has(CUES.joined(win_texts, "spice4") | lat, "spice4"):
         lvl = 4
         hits.append(("spice4", "trigger"))
 
     dbg = {"score": round(score,2), "hits": hits[-10:], "latest": latest, "red_hit": red_hit, "level": lvl}
-    print("[QR][spice]", dbg)
+    log_spice.debug("inferred", extra={"data": dbg})
     return lvl, dbg
 
+def resolve_spice(requested: Optional[int], inferred: int, conv: Conversation) -> int:
+    # allow inferred spice 4; user-specified spice only honored for 0–3
+    spice = requested if isinstance(requested, int) and 0 <= requested <= 3 else inferred
+
+    # ---- enforce floor unless RED_DOWN seen ----
+    hist_text = conv.window_low(CONTEXT_WINDOW)
+    if not RED_DOWN.search(hist_text):
+        spice = max(spice, MIN_SPICE_FLOOR)
+    return spice
+
 def temp_for_spice(spice: int) -> float:
     return {0: 0.2, 1: 0.35, 2: 0.5, 3: 0.65, 4: 0.75}.get(int(spice), 0.35) #what does this do
 
@@ -591,11 +2016,10 @@ def mode_guide(spice: int) -> str:
 # ================== STAGE : FORWARD ONLY ==================
 STAGE_INDEX = {s:i for i,s in enumerate(STAGES)}
 
-def heuristic_stage_from_history(history: List[Msg]) -> Tuple[str, Dict[str,Any]]: # finds stage based on keywords
+def heuristic_stage_from_history(conv: Conversation) -> Tuple[str, Dict[str,Any]]: # finds stage based on keywords
      #this is bugged gotta fix this make it a general wieght not just if it discovers a word
      #maybe have a floor, like cr arenas. if you get to a later stage, you cant go back
-    text = " ".join((m.text or "") for m in history[-CONTEXT_WINDOW:]).lower()
-    text = expand_slang(text)  
+    text = conv.stage_text(CONTEXT_WINDOW)
     idx = 0
     why = []
     if re.search(r"\b(hey|hi|hello)\b", text): idx = max(idx, STAGE_INDEX["opener"])
@@ -611,14 +2035,33 @@ def heuristic_stage_from_history(history: List[Msg]) -> Tuple[str, Dict[str,Any]
         idx = max(idx, STAGE_INDEX["confirm"]); why.append("explicit time")
     if re.search(r"\b(see you|on my way|locked in|it'?s a date|it’s a date)\b", text):
         idx = max(idx, STAGE_INDEX["wrap"]); why.append("locked-in")
+    if STAGE_INDEX.get(conv.stage_floor or "", -1) > idx:   # forward-only across requests of a thread
+        idx = STAGE_INDEX[conv.stage_floor]; why.append("session-floor")
     idx = max(0, min(idx, len(STAGES)-1))
     return STAGES[idx], {"why": why}
 
-async def classify_stage(history: List[Msg], latest: str) -> Tuple[str, Dict[str,Any]]:
-    heur_stage, heur_dbg = heuristic_stage_from_history(history)
+STAGE_MODEL = load_stage_model(STAGE_MODEL_PATH, STAGES)
+STAGE_MIN_CONF: Optional[float] = None    # None = always ask the LLM
+if STAGE_MODEL is not None:
+    STAGE_MIN_CONF = STAGE_MODEL.meta.get("min_conf") if STAGE_LOCAL_MIN_CONF == "auto" else float(STAGE_LOCAL_MIN_CONF)
+    log_stage.info("local model %s: %s rows, min conf %s", STAGE_MODEL_PATH, STAGE_MODEL.meta.get("rows"), STAGE_MIN_CONF)
+
+@METRICS.timed("classify_stage")
+async def classify_stage(conv: Conversation) -> Tuple[str, Dict[str,Any]]:
+    heur_stage, heur_dbg = heuristic_stage_from_history(conv)
+    if STAGE_MIN_CONF is not None:
+        local_stage, conf = STAGE_MODEL.predict(_norm_text(conv.latest))
+        if conf >= STAGE_MIN_CONF:
+            METRICS.inc("qr_stage_classify_total", source="local")
+            final_stage = STAGES[max(STAGE_INDEX[local_stage], STAGE_INDEX[heur_stage])]
+            dbg = {"model_raw": None, "model": local_stage, "local_conf": round(conf, 3), "heuristic": heur_stage,
+                   "chosen": final_stage, **heur_dbg}
+            log_stage.debug("classified locally", extra={"data": dbg})
+            return final_stage, dbg
+    METRICS.inc("qr_stage_classify_total", source="llm")
     sys = "Label the dating chat stage with one token: " + ", ".join(STAGES) + ". Respond with just the token. Prefer later stage when mixed."
-    hist_exp = stitched_k_exp(history, CONTEXT_WINDOW)  
-    latest_exp = expand_slang(latest)       
+    hist_exp = conv.stitched_exp(CONTEXT_WINDOW)
+    latest_exp = conv.latest_exp
     usr = f"HISTORY(last {CONTEXT_WINDOW}):\n{hist_exp}\n\nLATEST:\n{latest_exp}\n\nStage:"
     out = await openai_chat_async([{"role":"system","content":sys},{"role":"user","content":usr}],
                                   temperature=0.1, max_tokens=5)
@@ -626,21 +2069,25 @@ async def classify_stage(history: List[Msg], latest: str) -> Tuple[str, Dict[str
     model_stage = token if token in STAGES else "banter"
     final_stage = STAGES[max(STAGE_INDEX[model_stage], STAGE_INDEX[heur_stage])]
     dbg = {"model_raw": out, "model": model_stage, "heuristic": heur_stage, "chosen": final_stage, **heur_dbg}
-    print("[QR][classify_stage]", dbg)
+    log_stage.debug("classified", extra={"data": dbg})
     return final_stage, dbg
 
 # ================== IDEA (LLM-SUMMARIZED) ==================
-async def extract_idea(history: List[Msg], latest: str) -> Tuple[str, Dict[str,Any]]:
+@METRICS.timed("extract_idea")
+async def extract_idea(conv: Conversation) -> Tuple[str, Dict[str,Any]]:
     sys = "Summarize the core conversational idea/goal in 2–5 words (no punctuation). Examples: 'come over tonight', 'set a time', 'flirty teasing escalates'. Respond with only the phrase."
-    hist_exp = stitched_k_exp(history, 20)  
-    latest_exp = expand_slang(latest)       
+    hist_exp = conv.stitched_exp(20)
+    latest_exp = conv.latest_exp
     usr = f"HISTORY(last 20):\n{hist_exp}\n\nLATEST:\n{latest_exp}\n\nIDEA:"
     out = await openai_chat_async([{"role":"system","content":sys},{"role":"user","content":usr}],
                                   temperature=0.2, max_tokens=8)
+    return _clean_idea(out), {"raw": out}
+
+def _clean_idea(out: str) -> str:
     idea = clamp(out).strip().lower()
     idea = re.sub(r"[^a-z0-9\s']", "", idea)[:40]
     idea = idea or "move things forward" #can i switch or to and
-    return idea, {"raw": out}
+    return idea
 
 # ================== PLAN ==================
 def plan_strategy(stage: str) -> Dict[str,str]:
@@ -666,12 +2113,36 @@ def plan_strategy(stage: str) -> Dict[str,str]:
             "tip":  tips.get(stage,"Direct answer; 5–14 words; single CTA.")}
 
 # ================== GENERATE  ==================
-async def generate_options(history: List[Msg], latest: str, stage: str, plan: Dict[str,str], spice: int, idea: str, n=1) -> Tuple[List[str], Dict[str, Any]]:
-    low = (latest or "").lower()
-    ask_name = any(k in low for k in ["name", "who are you", "who’s this", "who is this"])
+# Messages go most-stable first so the provider's prompt-prefix cache keeps matching:
+#   PROMPT_PREFIX    rubric + fixed few-shots, built once and shared by every generate/fused call
+#   liked few-shots  per stage, re-rendered only when the feedback pool changes
+#   system           the per-request part: mode, stage plan, hints, IDEA
+#   user             HISTORY (cut to PROMPT_HISTORY_TOKENS) + LATEST + the ask
+def _shots(pairs) -> List[Dict[str, str]]:
+    msgs = []
+    for u,a in pairs:
+        msgs += [{"role":"user","content":u},{"role":"assistant","content":json.dumps(a)}]
+    return msgs
+
+PROMPT_PREFIX: Tuple[Dict[str, str], ...] = (
+    {"role":"system","content":
+        "You are QuickRizz.\n" + STYLE_RUBRIC +
+        (f"If asked name/identity, answer briefly as {USER_NAME}. Otherwise never introduce my name.\n" if USER_NAME else "") +
+        "If heat is 3, prioritize flirty proximity-forward lines (suggestive, confident). "
+        "If heat is 4, be direct, consent-affirming, and concrete about proximity or plan."},
+    *_shots(EXEMPLARS),
+)
 
+@functools.lru_cache(maxsize=64)
+def _liked_shots(stage: str, generation: int) -> Tuple[Dict[str, str], ...]:
+    # GENERATION (EXEMPLAR_POOL's) is only part of the cache key
+    return tuple(_shots(liked_exemplars(6, stage)))
+
+@functools.lru_cache(maxsize=None)
+def _stage_fragment(stage: str, spice: int, asks_idea: bool) -> str:
+    plan = plan_strategy(stage)
     idea_hint = ""
-    if IDEA_TRIGGER.search(latest):
+    if asks_idea:
         idea_hint = (
             "\nIf LATEST asks for an idea/plan, prefer cheeky, proximity-forward ideas, e.g.: "
             "\"movie and blanket on my couch\", "
@@ -690,34 +2161,36 @@ async def generate_options(history: List[Msg], latest: str, stage: str, plan: Di
             "Keep 3–5 words; light, open-ended energy."
         )
 
-    system = (
-        "You are QuickRizz.\n" + STYLE_RUBRIC +
+    return (
         mode_guide(spice) + idea_hint + opener_hint + "\n" +
-        (f"If asked name/identity, answer briefly as {USER_NAME}. Otherwise never introduce my name.\n" if USER_NAME else "") +
-        f"IDEA: {idea}\n" +
-        f"Stage: {stage}. Goal: {plan['goal']}. Tip: {plan['tip']}.\n" +
-        "If heat is 3, prioritize flirty proximity-forward lines (suggestive, confident). "
-        "If heat is 4, be direct, consent-affirming, and concrete about proximity or plan."
+        f"Stage: {stage}. Goal: {plan['goal']}. Tip: {plan['tip']}.\n"
     )
 
-    msgs = [{"role":"system","content":system}]
+def _generate_system(latest: str, stage: str, spice: int, idea: str) -> str:
+    """The per-request system message; the stable instructions are in PROMPT_PREFIX."""
+    return _stage_fragment(stage, int(spice), bool(IDEA_TRIGGER.search(latest))) + f"IDEA: {idea}"
 
-    for u,a in EXEMPLARS:
-        msgs += [{"role":"user","content":u},{"role":"assistant","content":json.dumps(a)}]
-    for u,a in liked_exemplars(6, stage):
-        msgs += [{"role":"user","content":u},{"role":"assistant","content":json.dumps(a)}]
+def _generate_messages(conv: Conversation, latest: str, system: str, stage: str, ask: str) -> List[Dict[str, str]]:
+    msgs = list(PROMPT_PREFIX)
+    msgs += _liked_shots(stage, EXEMPLAR_POOL.generation)
+    msgs.append({"role":"system","content":system})
 
+    k = conv.fit(CONTEXT_WINDOW, PROMPT_HISTORY_TOKENS)
+    if k < min(CONTEXT_WINDOW, len(conv)):
+        METRICS.inc("qr_prompt_history_trimmed_total")
     user = (
         "HISTORY (latest last, keep context):\n"
-        f"{stitched_k(history, CONTEXT_WINDOW)}\n\n"
+        f"{conv.stitched(k)}\n\n"
         "LATEST:\n"
         f"{latest}\n\n"
-        "Return 6 candidates in JSON."
+        f"{ask}"
     )
     msgs.append({"role":"user","content":user})
+    return msgs
 
-    obj = await openai_chat_json(msgs, temperature=temp_for_spice(spice), max_tokens=120)
-    cands = obj.get("options", []) if isinstance(obj, dict) else []
+def filter_candidates(cands: List[Any], latest: str, spice: int) -> List[str]:
+    low = (latest or "").lower()
+    ask_name = any(k in low for k in ["name", "who are you", "who’s this", "who is this"])
 
     pool: List[str] = []
     for s in cands:
@@ -735,7 +2208,9 @@ async def generate_options(history: List[Msg], latest: str, stage: str, plan: Di
         if re.search(r"\b(vibe|snack|snacks)\b", s, flags=re.I):
             continue
         pool.append(s)
+    return pool
 
+def rank_options(pool: List[str], stage: str, spice: int, n: int) -> List[str]:
     ranked = sorted(pool, key=lambda x: score_line(x, spice), reverse=True)
 
     # Extra guardrails for openers: keep things vague/non-directional
@@ -753,10 +2228,19 @@ async def generate_options(history: List[Msg], latest: str, stage: str, plan: Di
             filtered = OPENER_FALLBACKS[:]
         ranked = filtered
 
-    chosen = ranked[:max(1, n)]
+    return ranked[:max(1, n)]
+
+async def generate_options(conv: Conversation, latest: str, stage: str, plan: Dict[str,str], spice: int, idea: str, n=1) -> Tuple[List[str], Dict[str, Any]]:
+    system = _generate_system(latest, stage, spice, idea)
+    msgs = _generate_messages(conv, latest, system, stage, "Return 6 candidates in JSON.")
+
+    obj = await openai_chat_json(msgs, temperature=temp_for_spice(spice), max_tokens=120)
+    cands = obj.get("options", []) if isinstance(obj, dict) else []
+
+    chosen = rank_options(filter_candidates(cands, latest, spice), stage, spice, n)
 
     dbg = { "generated": cands, "ranked_top": chosen, "latest": latest, "stage": stage, "spice": spice, "idea": idea }
-    print("[QR][rank]", json.dumps(dbg, ensure_ascii=False))
+    log_rank.debug("ranked", extra={"data": dbg})
     return chosen, dbg
 
 # ===== Forward-only stage enforcer =====
@@ -778,24 +2262,12 @@ REGRESS_CUES_RX = re.compile(
 _NEXT = {s: STAGE_ORDER[i+1] if i+1 < len(STAGE_ORDER) else None for i,s in enumerate(STAGE_ORDER)}
 _PREV = {s: STAGE_ORDER[i-1] if i-1 >= 0 else None for i,s in enumerate(STAGE_ORDER)}
 
-# keep original generator
-__generate_options_orig = generate_options
-
-async def generate_options(*args, **kwargs):
+def forward_enforce(options: List[str], dbg: Dict[str, Any], stage: str) -> Tuple[List[str], Dict[str, Any]]:
     """
-    Wrapper: calls original generator, then
     - prefers forward-cue lines,
     - blocks regression cues once stage >= logistics,
     - re-ranks with a small forward bonus.
     """
-    options, dbg = await __generate_options_orig(*args, **kwargs)
-
-    # unpack current stage (positional args: history, latest, stage, plan, spice, idea, n)
-    try:
-        stage = (args[2] if len(args) >= 3 else kwargs.get("stage")) or "banter"
-    except Exception:
-        stage = "banter"
-
     target = _NEXT.get(stage)
     stage_i = STAGE_POS.get(stage, 1)
 
@@ -829,14 +2301,563 @@ async def generate_options(*args, **kwargs):
     }
     return pool[:len(options)], dbg
 
+# keep original generator
+__generate_options_orig = generate_options
+
+@METRICS.timed("generate_options")
+async def generate_options(*args, **kwargs):
+    """
+    Wrapper: calls original generator, then applies the forward-only enforcer.
+    """
+    options, dbg = await __generate_options_orig(*args, **kwargs)
+
+    # unpack current stage (positional args: conv, latest, stage, plan, spice, idea, n)
+    try:
+        stage = (args[2] if len(args) >= 3 else kwargs.get("stage")) or "banter"
+    except Exception:
+        stage = "banter"
+
+    return forward_enforce(options, dbg, stage)
+
+# ================== FUSED (ONE CALL: STAGE + IDEA + OPTIONS) ==================
+FUSED_SCHEMA = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "suggestion",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "stage":   {"type": "string", "enum": STAGES},
+                "idea":    {"type": "string"},
+                "options": {"type": "array", "items": {"type": "string"}},
+            },
+            "required": ["stage", "idea", "options"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+@METRICS.timed("fused")
+async def fused_suggest(conv: Conversation, latest: str, spice: int, n=1):
+    """
+    One structured-output call that labels the stage, summarizes the idea and writes candidates.
+    Same post-processing as the three-call path: heuristic stage floor, candidate filters,
+    score_line ranking, then the forward enforcer.
+    """
+    msgs, heur_stage, heur_dbg = _fused_messages(conv, latest, spice)
+    obj = await openai_chat_json(msgs, temperature=temp_for_spice(spice), max_tokens=160,
+                                 response_format=FUSED_SCHEMA)
+    return _fused_result(obj, heur_stage, heur_dbg, latest, spice, n)
+
+def _fused_messages(conv: Conversation, latest: str, spice: int):
+    heur_stage, heur_dbg = heuristic_stage_from_history(conv)
+    system = (
+        _generate_system(latest, heur_stage, spice, "infer it from the chat") +
+        "\nAlso label the chat STAGE with one of: " + ", ".join(STAGES) +
+        f". Prefer later stage when mixed; never earlier than {heur_stage}."
+        "\nAlso summarize the core conversational IDEA/goal in 2–5 words (no punctuation)."
+        "\nWrite the options for the stage you chose and stay on that IDEA."
+        '\nReturn JSON: {"stage":"...","idea":"...","options":["...", "..."]}.'
+    )
+    msgs = _generate_messages(conv, latest, system, heur_stage,
+                              "Return stage, idea and 6 candidates in JSON.")
+    return msgs, heur_stage, heur_dbg
+
+def _fused_result(obj: Any, heur_stage: str, heur_dbg: Dict[str, Any], latest: str, spice: int, n: int):
+    if not isinstance(obj, dict):
+        obj = {}
+
+    token = str(obj.get("stage") or "").strip().lower()
+    model_stage = token if token in STAGES else "banter"
+    stage = STAGES[max(STAGE_INDEX[model_stage], STAGE_INDEX[heur_stage])]
+    stage_dbg = {"model_raw": obj.get("stage"), "model": model_stage, "heuristic": heur_stage, "chosen": stage, **heur_dbg}
+
+    idea = _clean_idea(str(obj.get("idea") or ""))
+    idea_dbg = {"raw": obj.get("idea")}
+
+    cands = obj.get("options", [])
+    if not isinstance(cands, list):
+        cands = []
+    chosen = rank_options(filter_candidates(cands, latest, spice), stage, spice, n)
+    gen_dbg = { "generated": cands, "ranked_top": chosen, "latest": latest, "stage": stage, "spice": spice, "idea": idea }
+    log_rank.debug("fused ranked", extra={"data": gen_dbg})
+    options, gen_dbg = forward_enforce(chosen, gen_dbg, stage)
+    return (stage, stage_dbg), (idea, idea_dbg), (options, gen_dbg)
+
+# ================== STREAMING ==================
+class StreamJSONParser:
+    """
+    Incremental parser for the flat shapes we ask the model for:
+      {"stage": "...", "idea": "...", "options": ["...", "..."]}
+    feed() returns newly completed items as ("field", key, value) for top-level strings and
+    ("option", "options", text) for each finished element of the options array.
+    Anything before the first "{" (e.g. a ```json fence) is skipped.
+    """
+    def __init__(self):
+        self.buf = ""
+        self.pos = 0
+        self.started = False
+        self.depth = 0
+        self.in_str = False
+        self.esc = False
+        self.str_start = 0
+        self.last_sig = ""       # last structural char outside strings
+        self.key: Optional[str] = None
+        self.array_key: Optional[str] = None
+
+    def feed(self, chunk: str) -> List[Tuple[str, str, str]]:
+        out: List[Tuple[str, str, str]] = []
+        self.buf += chunk
+        buf = self.buf
+        i = self.pos
+        while i < len(buf):
+            c = buf[i]
+            if not self.started:
+                if c == "{":
+                    self.started = True
+                    self.depth = 1
+                    self.last_sig = "{"
+                i += 1
+                continue
+            if self.in_str:
+                if self.esc:
+                    self.esc = False
+                elif c == "\\":
+                    self.esc = True
+                elif c == '"':
+                    self.in_str = False
+                    try:
+                        val = json.loads(buf[self.str_start:i+1])
+                    except ValueError:
+                        val = buf[self.str_start+1:i]
+                    if self.depth == 1 and self.last_sig in ("{", ","):
+                        self.key = val
+                    elif self.depth == 1 and self.last_sig == ":" and self.key is not None:
+                        out.append(("field", self.key, val))
+                    elif self.depth == 2 and self.array_key == "options":
+                        out.append(("option", "options", val))
+                    self.last_sig = '"'
+                i += 1
+                continue
+            if c == '"':
+                self.in_str = True
+                self.str_start = i
+            elif c in "{[":
+                if c == "[" and self.depth == 1:
+                    self.array_key = self.key
+                self.depth += 1
+                self.last_sig = c
+            elif c in "}]":
+                self.depth -= 1
+                if self.depth == 1:
+                    self.array_key = None
+                self.last_sig = c
+            elif c in ",:":
+                self.last_sig = c
+            i += 1
+        # drop consumed text, keeping an open string literal intact
+        keep = self.str_start if self.in_str else i
+        self.buf = buf[keep:]
+        if self.in_str:
+            self.str_start = 0
+        self.pos = len(self.buf)
+        return out
+
+async def openai_chat_stream(messages, temperature=0.2, max_tokens=200, timeout=None, response_format=None):
+    """
+    stream=true variant of openai_chat_async: yields content deltas as they arrive.
+    Retries/backoff as usual until the first delta; after that a broken stream just ends.
+    """
+    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
+    payload = {"model": MODEL, "messages": messages, "temperature": temperature, "max_tokens": max_tokens, "n": 1,
+               "stream": True, "stream_options": {"include_usage": True}}
+    if response_format:
+        payload["response_format"] = response_format
+    est = _estimate_tokens(messages, max_tokens)
+    attempt, last_err = 0, None
+    while attempt < MAX_RETRIES:
+        attempt += 1
+        started = False
+        try:
+            async with LIMITER.slot(est):
+                async with http_client().stream("POST", f"{OPENAI_BASE_URL}/chat/completions", headers=headers,
+                                                json=payload, timeout=_http_timeout(timeout)) as r:
+                    METRICS.inc("qr_upstream_requests_total", status=r.status_code)
+                    if r.status_code == 429 or r.status_code >= 500:
+                        LIMITER.observe(r.status_code, r.headers)
+                        if r.status_code == 429:
+                            METRICS.inc("qr_upstream_429_total")
+                        await r.aread()
+                        last_err = r.text
+                        delay = _backoff_delay(attempt, r.headers)
+                        log_openai.warning("stream %s -> backoff %.2fs (attempt %d/%d)", r.status_code, delay, attempt, MAX_RETRIES)
+                    else:
+                        r.raise_for_status()
+                        usage = None
+                        async for line in r.aiter_lines():
+                            if not line.startswith("data:"):
+                                continue
+                            chunk = line[5:].strip()
+                            if chunk == "[DONE]":
+                                break
+                            try:
+                                obj = json.loads(chunk)
+                            except ValueError:
+                                continue
+                            usage = obj.get("usage") or usage
+                            for ch in obj.get("choices") or []:
+                                piece = (ch.get("delta") or {}).get("content")
+                                if piece:
+                                    started = True
+                                    yield piece
+                        LIMITER.observe(r.status_code, r.headers, est, (usage or {}).get("total_tokens"))
+                        _observe_usage(usage)
+                        log_openai.debug("stream ok in attempt %d", attempt)
+                        return
+        except Exception as e:
+            if started:
+                log_openai.warning("stream broken: %s: %s", type(e).__name__, e)
+                return
+            last_err = str(e)
+            delay = min(BACKOFF_CAP_SEC, BACKOFF_BASE_SEC + random.uniform(0, 0.5))
+            log_openai.warning("stream %s: %s -> sleep %.2fs (attempt %d/%d)", type(e).__name__, e, delay, attempt, MAX_RETRIES)
+        await _retry_sleep(delay)
+    METRICS.inc("qr_upstream_giveups_total")
+    log_openai.error("stream giveup: %s", last_err)
+
+# ================== RESPONSE CACHE ==================
+class TTLCache:
+    """Small LRU with per-entry TTL and hit/miss/eviction counters."""
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self._d: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self.hits = self.misses = self.evictions = self.expired = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        ent = self._d.get(key)
+        if ent is None:
+            self.misses += 1
+            return None
+        ts, val = ent
+        if time.monotonic() - ts > self.ttl:
+            del self._d[key]
+            self.expired += 1
+            self.misses += 1
+            return None
+        self._d.move_to_end(key)
+        self.hits += 1
+        return val
+
+    def pop(self, key: str):
+        self._d.pop(key, None)
+
+    def put(self, key: str, val: Any):
+        self._d[key] = (time.monotonic(), val)
+        self._d.move_to_end(key)
+        while len(self._d) > self.maxsize:
+            self._d.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {"size": len(self._d), "maxsize": self.maxsize, "ttl_sec": self.ttl,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "expired": self.expired, "hit_rate": round(self.hits / total, 3) if total else 0.0}
+
+SUGGEST_CACHE = TTLCache(CACHE_SIZE, CACHE_TTL_SEC)
+
+def suggest_cache_key(conv: Conversation, n: int, spice: Optional[int], pipeline: str) -> str:
+    # normalized last CONTEXT_WINDOW turns + request knobs + memory/exemplar generations
+    h = hashlib.blake2b(digest_size=16)
+    for t in conv.turns[-CONTEXT_WINDOW:]:
+        h.update(f"{t.role}\x1f{t.low}\x1e".encode("utf-8"))
+    h.update(f"|n={n}|spice={spice}|p={pipeline}|mem={MEM.generation}|fb={EXEMPLAR_POOL.generation}".encode("utf-8"))
+    if conv.stage_floor:
+        h.update(f"|floor={conv.stage_floor}".encode("utf-8"))
+    return h.hexdigest()
+
+# ================== SESSIONS ==================
+class Session:
+    """What the server remembers about one thread between /suggest calls."""
+    __slots__ = ("key", "turns", "total", "stage", "spice", "idea", "idea_memo")
+
+    def __init__(self, key: str, turns: List[Turn], total: int, stage: Optional[str] = None,
+                 spice: Optional[int] = None, idea: Optional[str] = None):
+        self.key = key
+        self.turns = turns      # last CONTEXT_WINDOW turns (parsed once, reused by later requests)
+        self.total = total      # messages the thread has had: the `base` a client appends after
+        self.stage = stage      # furthest stage reached; floors the next classification
+        self.spice = spice
+        self.idea = idea
+        self.idea_memo: Optional["_IdeaEntry"] = None   # see IdeaMemo; in memory only
+
+    def info(self) -> Dict[str, Any]:
+        return {"len": self.total, "stage": self.stage, "spice": self.spice, "idea": self.idea}
+
+SESSION_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions(
+  site   TEXT NOT NULL,
+  thread TEXT NOT NULL,
+  ts     INTEGER,
+  total  INTEGER,
+  turns  TEXT,
+  stage  TEXT,
+  spice  INTEGER,
+  idea   TEXT,
+  PRIMARY KEY (site, thread)
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_ts ON sessions(ts);
+"""
+SESSION_UPSERT = "INSERT OR REPLACE INTO sessions(site, thread, ts, total, turns, stage, spice, idea) VALUES (?,?,?,?,?,?,?,?)"
+
+class SessionStore:
+    """
+    Sessions keyed by (site, thread): an LRU with an idle TTL in memory (TTLCache, used from the
+    event loop only). With a DB every update is also queued to the sessions table, and a miss
+    (restart, eviction, another worker) reloads the row if it is younger than the TTL. Workers
+    don't see each other's in-memory updates; a client that sends `base` gets a resync instead
+    of a diverged history.
+    """
+    def __init__(self, maxsize: int, ttl: float, db: Optional[Storage] = None):
+        self._cache = TTLCache(maxsize, ttl)
+        self.ttl = ttl
+        self.db = db
+        self.loads = self.resyncs = self.write_drops = 0
+        if db is not None:
+            db.executescript(SESSION_SCHEMA)
+            self._write("DELETE FROM sessions WHERE ts < ?", (int((time.time() - ttl) * 1000),))
+
+    @staticmethod
+    def key(site: Optional[str], thread: Optional[str]) -> Optional[str]:
+        if not SESSION_ENABLE or not thread:
+            return None
+        return f"{site or ''}\x1f{thread}"
+
+    def _write(self, sql: str, params: Tuple):
+        try:
+            self.db.write(sql, params)
+        except queue.Full:
+            self.write_drops += 1
+            log_session.warning("write queue full, session not persisted")
+
+    def _load(self, key: str) -> Optional[Session]:
+        site, thread = key.split("\x1f", 1)
+        row = self.db.reader().execute(
+            "SELECT ts, total, turns, stage, spice, idea FROM sessions WHERE site=? AND thread=?", (site, thread)).fetchone()
+        if row is None or row[0] < (time.time() - self.ttl) * 1000:
+            return None
+        turns = [Turn(role, text) for role, text in json.loads(row[2] or "[]")]
+        return Session(key, turns, row[1], row[3], row[4], row[5])
+
+    async def get(self, key: str) -> Optional[Session]:
+        sess = self._cache.get(key)
+        if sess is None and self.db is not None:
+            sess = await asyncio.to_thread(self._load, key)
+            if sess is not None:
+                self.loads += 1
+                self._cache.put(key, sess)
+        return sess
+
+    def put(self, sess: Session):
+        self._cache.put(sess.key, sess)
+        if self.db is not None:
+            site, thread = sess.key.split("\x1f", 1)
+            turns = json.dumps([[t.role, t.raw] for t in sess.turns], ensure_ascii=False)
+            self._write(SESSION_UPSERT, (site, thread, int(time.time() * 1000), sess.total, turns,
+                                         sess.stage, sess.spice, sess.idea))
+
+    def drop(self, key: str):
+        self._cache.pop(key)
+        if self.db is not None:
+            site, thread = key.split("\x1f", 1)
+            self._write("DELETE FROM sessions WHERE site=? AND thread=?", (site, thread))
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._cache.stats(), "loads": self.loads, "resyncs": self.resyncs, "write_drops": self.write_drops}
+
+SESSIONS = SessionStore(SESSION_SIZE, SESSION_TTL_SEC, DB if SESSION_PERSIST else None)
+
+async def open_conversation(data: SuggestReq) -> Tuple[Optional[Conversation], Optional[Session], Optional[Dict[str, Any]]]:
+    """
+    The request's Conversation, plus its thread's Session when it names one. Returns an error
+    body instead (no conversation) when `append` can't be applied: `base` isn't the stored
+    length, or the thread is unknown/expired and no `base` was sent. The client then resends
+    `context`.
+    """
+    key = SessionStore.key(data.site, data.thread)
+    if key is None:
+        return Conversation(data.context or []), None, None
+    if data.reset:
+        SESSIONS.drop(key)
+    sess = None if data.reset else await SESSIONS.get(key)
+    have = sess.total if sess is not None else 0
+    if data.context:                                  # full history: replaces the stored one
+        turns, total = [Turn(m.role, m.text) for m in data.context[-CONTEXT_WINDOW:]], len(data.context)
+    elif (data.base is not None and data.base != have) or (data.base is None and sess is None and data.append):
+        SESSIONS.resyncs += 1
+        log_session.info("resync", extra={"data": {"thread": data.thread, "base": data.base, "have": have}})
+        return None, None, {"ok": False, "error": "resync", "session": {"len": have}}
+    else:
+        turns, total = (sess.turns, sess.total) if sess is not None else ([], 0)
+    if data.append:
+        turns = (turns + [Turn(m.role, m.text) for m in data.append])[-CONTEXT_WINDOW:]
+        total += len(data.append)
+    if sess is None:
+        sess = Session(key, turns, total)
+    else:
+        sess.turns, sess.total = turns, total
+    SESSIONS.put(sess)
+    conv = Conversation.of_turns(turns)
+    conv.stage_floor = sess.stage
+    return conv, sess, None
+
+def record_session(sess: Optional[Session], resp: Dict[str, Any]) -> Dict[str, Any]:
+    """Fold a computed response's stage / spice / idea into SESS; RESP plus a `session` field."""
+    if sess is None:
+        return resp
+    if "idea" in resp:                                # not the no-latest placeholder
+        stage = resp.get("stage")
+        if STAGE_INDEX.get(stage, -1) > STAGE_INDEX.get(sess.stage or "", -1):
+            sess.stage = stage
+        sess.spice, sess.idea = resp.get("spice"), resp.get("idea")
+        SESSIONS.put(sess)
+    return {**resp, "session": sess.info()}
+
+# ================== IDEA MEMO ==================
+class _IdeaEntry:
+    __slots__ = ("idea", "raw", "words", "cues", "stage", "seen", "reuses", "turns")
+
+    def __init__(self, idea: str, raw: str, words: set, cues: int, stage: str, seen: set):
+        self.idea, self.raw = idea, raw
+        self.words, self.cues, self.stage = words, cues, stage    # the window the idea came from
+        self.seen = seen          # (role, text) of the turns the last request had
+        self.reuses = 0           # requests served since it was computed
+        self.turns = 0            # new messages since it was computed
+
+class IdeaMemo:
+    """
+    The last extract_idea result per thread, kept on its Session (so it shares the session's
+    TTL, eviction and reset, and isn't persisted with it). The idea is a 2–5 word summary that
+    rarely moves between consecutive messages, so a request reuses it unless a local check
+    says the thread moved (the reason is the qr_idea_total label):
+      trigger  a new message matches IDEA_TRIGGER (an idea/plan was asked for)
+      cues     the window has spice cues the idea's window didn't
+      stage    the heuristic stage is not the one the idea was computed at
+      drift    under IDEA_MIN_OVERLAP of the window's words were in the idea's window
+      stale    already reused IDEA_MAX_REUSE times in a row
+    Used from the event loop only.
+    """
+    def __init__(self):
+        self.reused = self.computed = 0
+
+    @staticmethod
+    def _changed(ent: _IdeaEntry, new: List[Turn], words: set, cues: int, stage: str) -> Optional[str]:
+        if any(IDEA_TRIGGER.search(t.text) for t in new):
+            return "trigger"
+        if cues & ~ent.cues:
+            return "cues"
+        if stage != ent.stage:
+            return "stage"
+        if words and len(words & ent.words) / len(words) < IDEA_MIN_OVERLAP:
+            return "drift"
+        if ent.reuses >= IDEA_MAX_REUSE:
+            return "stale"
+        return None
+
+    async def idea(self, sess: Optional[Session], conv: Conversation) -> Tuple[str, Dict[str, Any]]:
+        """extract_idea(CONV), or SESS's previous idea when nothing says the thread moved."""
+        if sess is None or not IDEA_MEMO_ENABLE:
+            return await extract_idea(conv)
+        words = set(_tokens(conv.window_low()))
+        cues = CUES.joined([t.text for t in conv.turns if t.text])
+        stage, _ = heuristic_stage_from_history(conv)
+        seen = {(t.role, t.text) for t in conv.turns}
+        ent = sess.idea_memo
+        if ent is None:
+            reason = "new"
+        else:
+            new = [t for t in conv.turns if (t.role, t.text) not in ent.seen]
+            reason = self._changed(ent, new, words, cues, stage)
+        if reason is None:
+            ent.reuses += 1
+            ent.turns += len(new)
+            ent.seen = seen
+            self.reused += 1
+            METRICS.inc("qr_idea_total", result="reused")
+            METRICS.observe("qr_idea_staleness_turns", ent.turns)
+            return ent.idea, {"raw": ent.raw, "memo": "reused", "reuses": ent.reuses, "turns": ent.turns}
+        idea, dbg = await extract_idea(conv)
+        self.computed += 1
+        METRICS.inc("qr_idea_total", result=reason)
+        if dbg.get("raw"):                                # don't pin the fallback an upstream failure returns
+            sess.idea_memo = _IdeaEntry(idea, dbg["raw"], words, cues, stage, seen)
+        return idea, {**dbg, "memo": reason}
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.reused + self.computed
+        return {"reused": self.reused, "computed": self.computed,
+                "reuse_rate": round(self.reused / total, 3) if total else 0.0}
+
+IDEA_MEMO = IdeaMemo()
+
 # ================== ROUTES ==================
 @app.get("/")
 def ok():
     return {"ok": True}
 
-@app.post("/suggest")
-async def suggest(req: Request):
-    body = await req.json()
+@METRICS.collector
+def _runtime_metrics():
+    lim = LIMITER.stats()
+    yield ("qr_limiter_queue_depth", "gauge", "Callers waiting for an upstream slot", {}, lim["queue_depth"])
+    yield ("qr_limiter_inflight", "gauge", "Upstream calls in flight", {}, lim["inflight"])
+    yield ("qr_limiter_rate_scale", "gauge", "Adaptive rate multiplier (1 = configured RPM/TPM)", {}, lim["rate_scale"])
+    c = SUGGEST_CACHE.stats()
+    yield ("qr_cache_entries", "gauge", "Cached /suggest responses", {}, c["size"])
+    for k in ("hits", "misses", "evictions", "expired"):
+        yield ("qr_cache_events_total", "counter", "Response cache events", {"event": k}, c[k])
+    d = HEDGER.delay()
+    if HEDGE_ENABLE and d is not None:
+        yield ("qr_hedge_delay_seconds", "gauge", "Current wait before a duplicate upstream attempt", {}, d)
+    for flight in (SUGGEST_FLIGHT, OPENAI_FLIGHT):
+        yield ("qr_coalesced_total", "counter", "Callers that joined an identical in-flight task", {"layer": flight.name}, flight.coalesced)
+    ss = SESSIONS.stats()
+    yield ("qr_session_entries", "gauge", "Threads with server-side session state in memory", {}, ss["size"])
+    for k in ("hits", "misses", "expired", "evictions", "loads", "resyncs"):
+        yield ("qr_session_events_total", "counter", "Session store events", {"event": k}, ss[k])
+    cues = CUES.stats()
+    yield ("qr_cue_cache_entries", "gauge", "Cached per-message cue scans", {}, cues["size"])
+    for k in ("hits", "misses"):
+        yield ("qr_cue_cache_events_total", "counter", "Cue scan cache events", {"event": k}, cues[k])
+    yield ("qr_mem_keys", "gauge", "Keys in the memory index", {}, len(MEM))
+    yield ("qr_mem_generation", "gauge", "Memory index generation (bumps on every commit and swap)", {}, MEM.generation)
+    db = DB.stats()
+    yield ("qr_db_write_queue", "gauge", "Writes waiting for the SQLite writer thread", {}, db["queued"])
+    yield ("qr_db_rows_total", "counter", "Rows written by the SQLite writer thread", {}, db["rows"])
+    yield ("qr_db_batches_total", "counter", "Group-committed write transactions", {}, db["batches"])
+    yield ("qr_db_commit_seconds_total", "counter", "Time spent in write transactions", {}, db["commit_seconds"])
+    yield ("qr_db_errors_total", "counter", "Failed writes", {}, db["errors"])
+    for (comp, reason), n in list(LOG_DROPPED.items()):
+        yield ("qr_log_dropped_total", "counter", "Log records dropped by sampling, rate cap or a full queue", {"component": comp, "reason": reason}, n)
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats")
+def stats():
+    return {"limiter": LIMITER.stats(), "cache": SUGGEST_CACHE.stats(), "db": DB.stats(), "memory": MEM_WATCHER.stats(),
+            "sessions": SESSIONS.stats(), "idea_memo": IDEA_MEMO.stats(),
+            "coalesce": {"suggest": SUGGEST_FLIGHT.stats(), "openai": OPENAI_FLIGHT.stats()}, "hedge": HEDGER.stats()}
+
+@app.post("/memory/reload")
+async def memory_reload():
+    """Rebuild the memory index in the background (e.g. after editing the store by hand)."""
+    asyncio.get_running_loop().create_task(MEM_WATCHER.rebuild("manual"))
+    return {"ok": True, "memory": MEM_WATCHER.stats()}
+
+def parse_suggest_body(body: Any) -> SuggestReq:
     if isinstance(body, dict):
         if "messages" in body and "context" not in body:
             body["context"] = [
@@ -848,63 +2869,31 @@ async def suggest(req: Request):
                 {"role": (m.get("role") or "them"), "text": (m.get("text") or m.get("content") or "")}
                 for m in (body.get("context") or [])
             ]
+        if "append" in body:
+            body["append"] = [
+                {"role": (m.get("role") or "them"), "text": (m.get("text") or m.get("content") or "")}
+                for m in (body.get("append") or [])
+            ]
+    return SuggestReq(**(body if isinstance(body, dict) else {}))
 
-    data = SuggestReq(**(body if isinstance(body, dict) else {}))
-    hist = [Msg(role=m.role, text=clamp(m.text)) for m in (data.context or [])][-CONTEXT_WINDOW:]
-    latest = last_incoming(hist)
-    print("[QR][suggest][input]", {"hist_len": len(hist), "latest": latest})
-
-    if not latest:
-        return {"stage":"banter", "plan":plan_strategy("banter"), "options":[], "spice": 1, "debug":{"why":"no latest"}}
-
-    # ===== Memory lookup  =====
-    mem_lines: List[str] = []
-    if MEM_ENABLE:
-        try:
-            sims = MEM.similar(latest)
-            for key, score in sims:
-                lines = MEM.best_lines_for(key, limit=MEM_MERGE_LIMIT)
-                for ln in lines:
-                    if ln and ln not in mem_lines:
-                        mem_lines.append(ln)
-                if len(mem_lines) >= MEM_MERGE_LIMIT:
-                    break
-            if mem_lines:
-                print("[QR][mem][hit]", {"keys": [k for k,_ in sims], "picked": mem_lines})
-        except Exception as e:
-            print("[QR][mem][err]", str(e))
-
-    stage, stage_dbg = await classify_stage(hist, latest)
-    plan  = plan_strategy(stage)
-    inferred_spice, spice_dbg = infer_spice(hist, latest, k=CONTEXT_WINDOW)
-    # allow inferred spice 4; user-specified spice only honored for 0–3
-    spice = data.spice if isinstance(data.spice, int) and 0 <= data.spice <= 3 else inferred_spice
-
-    # ---- enforce floor unless RED_DOWN seen ----
-    hist_text = " ".join(m.text for m in hist[-CONTEXT_WINDOW:] if m.text).lower()
-    if not RED_DOWN.search(hist_text):
-        spice = max(spice, MIN_SPICE_FLOOR)
+NO_LATEST_RESP = {"stage":"banter", "plan":plan_strategy("banter"), "options":[], "spice": 1, "debug":{"why":"no latest"}}
 
+def merge_options(mem_lines: List[str], options: List[str], latest: str, spice: int, n: int) -> List[str]:
     # ---- Trim memory influence at high spice (H3+)  ----
     if spice >= 3 and mem_lines:
         mem_lines = mem_lines[:1]
 
-    idea, idea_dbg = await extract_idea(hist, latest)
-
-    options, gen_dbg = await generate_options(hist, latest, stage, plan, spice=spice, idea=idea, n=max(1, min(data.n, 3)))
-    print("[QR][generate_options]", json.dumps(gen_dbg, ensure_ascii=False))
-
     # ===== Merge memory-first =====
     merged: List[str] = []
     for s in (mem_lines + options):
         s = clean_option(s)
         if s and s not in merged:
             merged.append(s)
-        if len(merged) >= data.n:
+        if len(merged) >= n:
             break
     options = merged
 
-    if len(options) < data.n: # fill-ins
+    if len(options) < n: # fill-ins
         low = latest.lower()
         if "name" in low:
             fill = [f"I'm {USER_NAME}. Nice to meet you",
@@ -923,46 +2912,272 @@ async def suggest(req: Request):
                 f = strip_winks(f).strip()
                 if not f: continue
             if f and f not in options: options.append(f)
-            if len(options) >= data.n: break
+            if len(options) >= n: break
+    return options[:n]
+
+def _cached_response(cache_key: Optional[str], data: SuggestReq) -> Optional[Dict[str, Any]]:
+    if not cache_key or data.nocache:
+        return None
+    cached = SUGGEST_CACHE.get(cache_key)
+    if cached is None:
+        return None
+    resp = copy.deepcopy(cached)
+    resp["debug"]["cache"] = "hit"
+    log_suggest.debug("cache hit %s", cache_key[:8])
+    return resp
+
+def _store_response(cache_key: Optional[str], resp: Dict[str, Any], gen_dbg: Dict[str, Any]):
+    # don't pin upstream failures (nothing generated) in the cache
+    if cache_key and gen_dbg.get("generated"):
+        SUGGEST_CACHE.put(cache_key, copy.deepcopy(resp))
+
+@app.post("/suggest")
+async def suggest(req: Request):
+    data = parse_suggest_body(await req.json())
+    conv, sess, err = await open_conversation(data)
+    if err is not None:
+        return err
+    latest = conv.latest
+    log_suggest.info("input", extra={"data": {"hist_len": len(conv), "latest": latest, "thread": sess is not None}})
+
+    if not latest:
+        return record_session(sess, copy.deepcopy(NO_LATEST_RESP))
+
+    pipeline = "fused" if (data.pipeline or PIPELINE_MODE).lower() == "fused" else "split"
+    req_key = suggest_cache_key(conv, data.n, data.spice, pipeline)
+    cache_key = req_key if CACHE_ENABLE else None
+    cached = _cached_response(cache_key, data)
+    if cached is not None:
+        METRICS.inc("qr_suggest_total", outcome="cache_hit")
+        return record_session(sess, cached)
+
+    if not COALESCE_ENABLE:
+        METRICS.inc("qr_suggest_total", outcome="computed")
+        return record_session(sess, await _run_suggest(data, conv, sess, latest, pipeline, cache_key))
+    resp, shared = await SUGGEST_FLIGHT.do(req_key, lambda: _run_suggest(data, conv, sess, latest, pipeline, cache_key))
+    METRICS.inc("qr_suggest_total", outcome="coalesced" if shared else "computed")
+    if shared:
+        resp = copy.deepcopy(resp)
+        resp["debug"]["coalesced"] = True
+        log_suggest.debug("coalesced with in-flight request %s", req_key[:8])
+    return record_session(sess, resp)
+
+SUGGEST_FLIGHT = SingleFlight("suggest")
+
+@METRICS.timed("suggest")
+async def _run_suggest(data: SuggestReq, conv: Conversation, sess: Optional[Session], latest: str, pipeline: str,
+                       cache_key: Optional[str]) -> Dict[str, Any]:
+    # ===== Fan out independent stages =====
+    # memory + spice are CPU-only (run off-loop); stage + idea are independent LLM calls.
+    # generate_options waits only on stage/spice/idea; memory is joined at merge time.
+    n_gen = max(1, min(data.n, 3))
+    mem_task = asyncio.ensure_future(asyncio.to_thread(memory_lines, latest))
+    try:
+        if pipeline == "fused":
+            # spice shapes the prompt, so it is resolved before the single call
+            inferred_spice, spice_dbg = await asyncio.to_thread(infer_spice, conv.msgs, latest, CONTEXT_WINDOW)
+            spice = resolve_spice(data.spice, inferred_spice, conv)
+            (stage, stage_dbg), (idea, idea_dbg), (options, gen_dbg) = await fused_suggest(conv, latest, spice, n=n_gen)
+            plan  = plan_strategy(stage)
+        else:
+            (stage, stage_dbg), (idea, idea_dbg), (inferred_spice, spice_dbg) = await asyncio.gather(
+                classify_stage(conv),
+                IDEA_MEMO.idea(sess, conv),
+                asyncio.to_thread(infer_spice, conv.msgs, latest, CONTEXT_WINDOW),
+            )
+            plan  = plan_strategy(stage)
+            spice = resolve_spice(data.spice, inferred_spice, conv)
+            options, gen_dbg = await generate_options(conv, latest, stage, plan, spice=spice, idea=idea, n=n_gen)
+        log_rank.debug("generate_options", extra={"data": gen_dbg})
+        mem_lines = await mem_task
+    finally:
+        if not mem_task.done():
+            mem_task.cancel()
+
+    options = merge_options(mem_lines, options, latest, spice, data.n)
 
     resp = {
         "stage": stage,
         "plan": plan,
-        "options": options[:data.n],
+        "options": options,
         "spice": spice,
         "idea": idea,
         "debug": {
+            "pipeline": pipeline,
             "stage": stage_dbg,
             "spice": spice_dbg,
             "idea": idea_dbg
         }
     }
-    print("[QR][suggest][resp]", json.dumps(resp, ensure_ascii=False))
+    log_suggest.debug("resp", extra={"data": resp})
+    _store_response(cache_key, resp, gen_dbg)
     return resp
 
-@app.post("/feedback")
-def feedback(req: FeedbackReq):
-    payload = (
-        int(time.time()*1000),
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/suggest/stream")
+async def suggest_stream(req: Request):
+    """
+    Server-Sent Events version of /suggest:
+      spice, memory, stage (+ idea) as soon as known -> one `option` event per streamed candidate
+      that passes the generate filters -> `final` with the same body /suggest returns.
+    """
+    data = parse_suggest_body(await req.json())
+    conv, sess, err = await open_conversation(data)
+    if err is not None:
+        return err
+    latest = conv.latest
+    pipeline = "fused" if (data.pipeline or PIPELINE_MODE).lower() == "fused" else "split"
+    cache_key = suggest_cache_key(conv, data.n, data.spice, pipeline) if (CACHE_ENABLE and latest) else None
+    log_suggest.info("stream input", extra={"data": {"hist_len": len(conv), "latest": latest, "pipeline": pipeline,
+                                                     "thread": sess is not None}})
+
+    async def events():
+        if not latest:
+            yield _sse("final", record_session(sess, NO_LATEST_RESP)); return
+        cached = _cached_response(cache_key, data)
+        if cached is not None:
+            METRICS.inc("qr_suggest_total", outcome="cache_hit")
+            yield _sse("final", record_session(sess, cached)); return
+
+        n_gen = max(1, min(data.n, 3))
+        mem_task = asyncio.ensure_future(asyncio.to_thread(memory_lines, latest))
+        stage_task = idea_task = None
+        try:
+            inferred_spice, spice_dbg = await asyncio.to_thread(infer_spice, conv.msgs, latest, CONTEXT_WINDOW)
+            spice = resolve_spice(data.spice, inferred_spice, conv)
+            yield _sse("spice", {"spice": spice})
+            if pipeline == "split":
+                stage_task = asyncio.ensure_future(classify_stage(conv))
+                idea_task = asyncio.ensure_future(IDEA_MEMO.idea(sess, conv))
+            mem_lines = await mem_task
+            yield _sse("memory", {"options": mem_lines})
+
+            if pipeline == "fused":
+                msgs, heur_stage, heur_dbg = _fused_messages(conv, latest, spice)
+                yield _sse("stage", {"stage": heur_stage, "provisional": True})
+                stream = openai_chat_stream(msgs, temperature=temp_for_spice(spice), max_tokens=160,
+                                            response_format=FUSED_SCHEMA)
+                stage = heur_stage
+            else:
+                (stage, stage_dbg), (idea, idea_dbg) = await asyncio.gather(stage_task, idea_task)
+                plan = plan_strategy(stage)
+                yield _sse("stage", {"stage": stage, "plan": plan, "idea": idea})
+                system = _generate_system(latest, stage, spice, idea)
+                msgs = _generate_messages(conv, latest, system, stage, "Return 6 candidates in JSON.")
+                stream = openai_chat_stream(msgs, temperature=temp_for_spice(spice), max_tokens=120)
+
+            parser = StreamJSONParser()
+            fields: Dict[str, Any] = {}
+            cands: List[str] = []
+            sent: List[str] = []
+            async for piece in stream:
+                for kind, key, val in parser.feed(piece):
+                    if kind == "field":
+                        fields[key] = val
+                        if key == "stage" and pipeline == "fused":
+                            st = str(val).strip().lower()
+                            if st in STAGES and STAGE_INDEX[st] > STAGE_INDEX[stage]:
+                                yield _sse("stage", {"stage": st})
+                        continue
+                    cands.append(val)
+                    for s in filter_candidates([val], latest, spice):
+                        if s not in sent and s not in mem_lines:
+                            sent.append(s)
+                            yield _sse("option", {"text": s, "score": round(score_line(s, spice), 2)})
+
+            if pipeline == "fused":
+                (stage, stage_dbg), (idea, idea_dbg), (options, gen_dbg) = _fused_result(
+                    {**fields, "options": cands}, heur_stage, heur_dbg, latest, spice, n_gen)
+                plan = plan_strategy(stage)
+            else:
+                chosen = rank_options(filter_candidates(cands, latest, spice), stage, spice, n_gen)
+                gen_dbg = {"generated": cands, "ranked_top": chosen, "latest": latest, "stage": stage, "spice": spice, "idea": idea}
+                options, gen_dbg = forward_enforce(chosen, gen_dbg, stage)
+
+            resp = {
+                "stage": stage,
+                "plan": plan,
+                "options": merge_options(mem_lines, options, latest, spice, data.n),
+                "spice": spice,
+                "idea": idea,
+                "debug": {
+                    "pipeline": pipeline,
+                    "stream": True,
+                    "stage": stage_dbg,
+                    "spice": spice_dbg,
+                    "idea": idea_dbg
+                }
+            }
+            log_suggest.debug("stream resp", extra={"data": resp})
+            _store_response(cache_key, resp, gen_dbg)
+            METRICS.inc("qr_suggest_total", outcome="stream")
+            yield _sse("final", record_session(sess, resp))
+        except Exception as e:
+            log_suggest.exception("stream failed: %s", type(e).__name__)
+            yield _sse("error", {"error": type(e).__name__})
+        finally:
+            for t in (mem_task, stage_task, idea_task):
+                if t is not None and not t.done():
+                    t.cancel()
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def _feedback_row(req: FeedbackReq, now: int) -> Tuple:
+    return (
+        req.ts if req.ts and 0 < req.ts <= now else now,
         req.stage,
         req.latest,
         req.option,
         req.label,
         json.dumps(req.meta or {})
     )
-    with _db_lock:
-        conn.execute(
-            "INSERT INTO feedback(ts, stage, latest, option, label, meta) VALUES (?,?,?,?,?,?)",
-            payload
-        )
-        conn.commit()
-    return {"ok": True}
+
+def _queue_feedback(rows: List[Tuple]) -> Dict[str, Any]:
+    """Queue rows for the writer thread (not awaited) and update the in-memory exemplar pool."""
+    try:
+        if len(rows) == 1:
+            DB.write(FEEDBACK_INSERT, rows[0])
+        else:
+            DB.write_many(FEEDBACK_INSERT, rows)
+    except queue.Full:
+        log_feedback.warning("write queue full, dropped %d rows", len(rows))
+        return {"ok": False, "error": "busy"}
+    for ts, stage, latest, option, label, _ in sorted(rows, key=lambda r: r[0]):
+        EXEMPLAR_POOL.add(ts, stage, latest, option, label)
+    return {"ok": True, "accepted": len(rows)}
+
+@app.post("/feedback")
+async def feedback(req: FeedbackReq):
+    return _queue_feedback([_feedback_row(req, int(time.time()*1000))])
+
+@app.post("/feedback/batch")
+async def feedback_batch(req: FeedbackBatchReq):
+    if not req.events:
+        return {"ok": True, "accepted": 0}
+    now = int(time.time()*1000)
+    return _queue_feedback([_feedback_row(e, now) for e in req.events])
 
 # ==============COMMIT TO DATABASE==========================
+def _commit_items(key: str, recs: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], int]:
+    # O(items for KEY): upsert into the store, then refresh that key in the memory index
+    with _commit_lock:
+        before = COMMIT_STORE.fingerprint()
+        items, added = COMMIT_STORE.upsert(key, recs)
+        MEM_WATCHER.note_commit(key, items, before, COMMIT_STORE.fingerprint())
+        try:
+            MEM.add_or_update_key(key, items)
+            log_mem.info("update", extra={"data": {"key": key, "items": len(items)}})
+        except Exception as e:
+            log_mem.warning("update failed: %s", e)
+    return items, added
+
 @app.post("/commit")
 async def commit(req: Request):
     """
-    Writes commits in CMH shape:
+    Upserts items into the commit store (QR_COMMIT_STORE), which exports as CMH shape:
     {
       "<latest text>": {
         "items": [
@@ -972,8 +3187,6 @@ async def commit(req: Request):
       }
     }
     """
-    from pathlib import Path
-
     # read body (no Pydantic model → tolerant)
     try:
         body = await req.json()
@@ -1009,56 +3222,20 @@ async def commit(req: Request):
                 r = None
             norm.append((s, r, reason))
 
-    # file path
-    path = Path(os.getenv("QR_COMMITS", "qr_commits.json"))
-    if not path.exists():
-        path.write_text("{}", encoding="utf-8")
-
-    # load existing
-    try:
-        data = json.loads(path.read_text(encoding="utf-8") or "{}")
-    except Exception:
-        data = {}
-
-    entry = data.get(key) or {}
-    items: List[Dict[str, Any]] = entry.get("items") or []
-
-    # de-dupe by resp; update if exists, else append 
-    index_by_resp = {it.get("resp"): i for i, it in enumerate(items) if isinstance(it, dict)}
-    added = 0
-    for s, rating, reason in norm:
-        rec = {
-            "resp": s,
-            "stage": stage,
-            "heat": heat,
-            "rating": rating,           # preserve incoming rating (Y/N/None)
-            "reason": reason or "",
-            "ts": ts,
-        }
-        if s in index_by_resp:
-            i = index_by_resp[s]
-            old = items[i] if isinstance(items[i], dict) else {}
-            if rating is None:                 # keep previous rating if not provided
-                rec["rating"] = old.get("rating")
-            if not reason:
-                rec["reason"] = old.get("reason", "")
-            items[i] = rec
-        else:
-            items.append(rec)
-            added += 1
-
-    entry["items"] = items
-    data[key] = entry
-
-    # persist
-    path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    recs = [{
+        "resp": s,
+        "stage": stage,
+        "heat": heat,
+        "rating": rating,           # preserve incoming rating (Y/N/None); merge keeps the old one if None
+        "reason": reason or "",
+        "ts": ts,
+    } for s, rating, reason in norm]
 
-    # ===== update in-memory index immediately ====
     try:
-        MEM.add_or_update_key(key, items)
-        print("[QR][mem][update]", {"key": key, "items": len(items)})
+        items, added = await asyncio.to_thread(_commit_items, key, recs)
     except Exception as e:
-        print("[QR][mem][update][err]", str(e))
+        log_mem.warning("commit failed: %s", e)
+        return {"ok": False, "error": "store_failed"}
 
     return {"ok": True, "key": key, "added": added, "total_items": len(items)}
 #+++++++++++++++++++++++++++++++++++++
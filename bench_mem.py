@@ -0,0 +1,205 @@
+"""
+Offline benchmark for the memory index backends (no network, throwaway database).
+
+    python bench_mem.py --keys 200000 --queries 2000
+    python bench_mem.py --keys 1000000 --backends lsh --bands 32 --rows 2
+    python bench_mem.py --memory --keys 200000
+    python bench_mem.py --snapshot --keys 200000
+    python bench_mem.py --backends postings,embed --dim 512
+
+Builds a MemIndex per backend over synthetic chat lines (Zipf-distributed vocabulary, so
+common trigrams behave like real ones), queries it with lightly edited copies of stored
+keys, misspelled copies and unrelated lines, and reports build time, lookup p50/p99,
+candidates (rows scanned, for embed) per lookup, recall against the exact postings backend,
+how often the source key comes back for word-edited and for misspelled queries, and how
+often an unrelated line matches anything. "embed" is QR_MEM_RETRIEVAL=embed (NumPy).
+
+--memory instead compares the heap held by the index layouts (tracemalloc): the original
+str-keyed dict-of-sets layout against the interned array('I') postings layout.
+
+--snapshot times a full build (which writes the mmap snapshot) against opening that
+snapshot in a fresh index, i.e. a worker cold start, and lookups served from the mapping.
+"""
+import argparse, os, random, sys, tempfile, time, tracemalloc, gc
+from typing import Dict, List, Set
+
+os.environ.setdefault("QR_OPENAI_BASE", "http://127.0.0.1:9/v1")   # app import must not need a key
+os.environ["QR_DB"] = os.path.join(tempfile.mkdtemp(prefix="qr-bench-"), "bench.db")
+os.environ.setdefault("QR_LOG_LEVEL", "WARNING")
+os.environ["QR_MEM_SNAPSHOT"] = ""   # in-memory builds unless --snapshot
+
+import app  # noqa: E402
+from commit_store import CommitStore  # noqa: E402
+
+class SyntheticStore(CommitStore):
+    def __init__(self, keys: List[str]):
+        self.keys = keys
+
+    def load_all(self):
+        return {k: {"items": [{"resp": "ok", "rating": "Y"}]} for k in self.keys}
+
+    def fingerprint(self):
+        return f"synthetic:{len(self.keys)}"
+
+def make_vocab(n: int, rng: random.Random) -> List[str]:
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = {"".join(rng.choice(letters) for _ in range(rng.randint(2, 8))) for _ in range(n * 2)}
+    return sorted(words)[:n]
+
+def make_lines(n: int, vocab: List[str], rng: random.Random) -> List[str]:
+    weights = [1.0 / (i + 1) for i in range(len(vocab))]
+    out = set()
+    while len(out) < n:
+        out.add(" ".join(rng.choices(vocab, weights, k=rng.randint(3, 12))))
+    return list(out)
+
+def edit(line: str, vocab: List[str], rng: random.Random) -> str:
+    toks = line.split()
+    toks[rng.randrange(len(toks))] = rng.choice(vocab)
+    return " ".join(toks)
+
+def typo(line: str, rng: random.Random) -> str:
+    """Drop, double or swap a letter in about a third of the words (at least one)."""
+    toks = line.split()
+    hit = [i for i in range(len(toks)) if rng.random() < 0.35] or [rng.randrange(len(toks))]
+    for i in hit:
+        w = toks[i]
+        if len(w) < 2:
+            w += w
+        else:
+            j = rng.randrange(len(w) - 1)
+            w = rng.choice((w[:j] + w[j + 1:], w[:j] + w[j] + w[j:], w[:j] + w[j + 1] + w[j] + w[j + 2:]))
+        toks[i] = w
+    return " ".join(toks)
+
+def pct(xs: List[float], p: float) -> float:
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(p / 100.0 * len(xs)))]
+
+def run(backend: str, keys: List[str], queries: List[str], snapshot: str = "") -> Dict[str, object]:
+    retrieval = "embed" if backend == "embed" else "jaccard"
+    backend = "postings" if backend == "embed" else backend
+    make = lambda: app.MemIndex(SyntheticStore(keys), backend=backend, snapshot_path=snapshot, retrieval=retrieval)
+    t0 = time.perf_counter()
+    idx = make()
+    build = time.perf_counter() - t0
+    if snapshot:
+        t0 = time.perf_counter()
+        idx = make()
+        build = time.perf_counter() - t0   # reported as "open s"
+    lat, cands, results = [], [], []
+    for q in queries:
+        t = time.perf_counter()
+        res = idx.similar(q)
+        lat.append(time.perf_counter() - t)
+        if idx.encoder is not None:
+            cands.append(len(idx))          # brute force: every row is scored
+        else:
+            with idx._lock:
+                cands.append(idx._scored_locked(app._grams_for(q))[1])
+        results.append({k for k, _ in res})
+    return {"build_s": build, "p50_ms": pct(lat, 50) * 1000, "p99_ms": pct(lat, 99) * 1000,
+            "cand_avg": sum(cands) / len(cands), "results": results}
+
+class LegacyLayout:
+    """The pre-interning MemIndex layout: every gram a str, a set per key and per gram."""
+    def __init__(self, keys: List[str]):
+        self.key_grams: Dict[str, Set[str]] = {}
+        self.postings: Dict[str, Set[str]] = {}
+        for key in keys:
+            grams = app._grams_for(key)
+            self.key_grams[key] = grams
+            for g in grams:
+                self.postings.setdefault(g, set()).add(key)
+
+def heap_of(build) -> float:
+    """MB still allocated after build() returns, excluding garbage."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    obj = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del obj
+    return (after - before) / 1e6
+
+def memory(keys: List[str]):
+    # key strings themselves are shared by both layouts and already allocated
+    legacy = heap_of(lambda: LegacyLayout(keys))
+    interned = heap_of(lambda: app.MemIndex(SyntheticStore(keys), backend="postings"))
+    lsh = heap_of(lambda: app.MemIndex(SyntheticStore(keys), backend="lsh"))
+    # the interned index also holds each key's items; measure them to compare like for like
+    items = heap_of(lambda: SyntheticStore(keys).load_all())
+    print(f"{'layout':<22} {'MB':>9} {'bytes/key':>10}")
+    for name, mb in (("legacy dict/set", legacy), ("interned postings", interned - items),
+                     ("interned + lsh", lsh - items)):
+        print(f"{name:<22} {mb:>9.1f} {mb * 1e6 / len(keys):>10.0f}")
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--keys", type=int, default=50000)
+    ap.add_argument("--queries", type=int, default=1000)
+    ap.add_argument("--vocab", type=int, default=5000)
+    ap.add_argument("--backends", default="postings,lsh", help="any of postings, lsh, embed")
+    ap.add_argument("--bands", type=int, default=app.MEM_LSH_BANDS)
+    ap.add_argument("--rows", type=int, default=app.MEM_LSH_ROWS)
+    ap.add_argument("--dim", type=int, default=app.MEM_EMBED_DIM, help="embed vector width")
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("--memory", action="store_true", help="compare index heap size instead of lookup speed")
+    ap.add_argument("--snapshot", action="store_true", help="also time cold start and lookups from the mmap snapshot")
+    args = ap.parse_args()
+
+    app.MEM_LSH_BANDS, app.MEM_LSH_ROWS = args.bands, args.rows
+    app.MEM_EMBED_DIM = args.dim
+    rng = random.Random(args.seed)
+    vocab = make_vocab(args.vocab, rng)
+    keys = make_lines(args.keys, vocab, rng)
+    if args.memory:
+        print(f"{len(keys)} keys")
+        memory(keys)
+        return 0
+    queries, kinds, sources = [], [], []
+    for _ in range(args.queries):
+        r, src = rng.random(), rng.choice(keys)
+        if r < 0.4:
+            queries.append(edit(src, vocab, rng)); kinds.append("edit"); sources.append(src)
+        elif r < 0.7:
+            queries.append(typo(src, rng)); kinds.append("typo"); sources.append(src)
+        else:
+            queries.append(make_lines(1, vocab, rng)[0]); kinds.append("none"); sources.append("")
+    print(f"{len(keys)} keys, {len(queries)} queries, min jaccard {app.MEM_MIN_JACCARD}, "
+          f"min cosine {app.MEM_EMBED_MIN_SIM} (dim {args.dim})")
+
+    def rate(results, kind: str) -> str:
+        idx = [i for i, k in enumerate(kinds) if k == kind]
+        if not idx:
+            return "-"
+        if kind == "none":
+            return f"{sum(1 for i in idx if results[i]) / len(idx):.3f}"
+        return f"{sum(1 for i in idx if sources[i] in results[i]) / len(idx):.3f}"
+
+    exact = None
+    snap_dir = tempfile.mkdtemp(prefix="qr-bench-snap-")
+    print(f"{'backend':<16} {'build s':>8} {'p50 ms':>8} {'p99 ms':>8} {'cand/q':>9} {'recall':>7}"
+          f" {'hit edit':>9} {'hit typo':>9} {'false':>7}")
+    for backend in [b.strip() for b in args.backends.split(",") if b.strip()]:
+        modes = [("", backend)] + ([(os.path.join(snap_dir, backend + ".snap"), backend + " mmap")] if args.snapshot else [])
+        for snap, label in modes:
+            r = run(backend, keys, queries, snap)
+            if backend == "postings" and not snap:
+                exact = r["results"]
+            recall = "-"
+            if exact is not None and backend != "embed":
+                want = sum(len(e) for e in exact)
+                got = sum(len(e & g) for e, g in zip(exact, r["results"]))
+                recall = f"{got / want:.3f}" if want else "-"
+            res = r["results"]
+            print(f"{label:<16} {r['build_s']:>8.3f} {r['p50_ms']:>8.3f} {r['p99_ms']:>8.3f} {r['cand_avg']:>9.1f} {recall:>7}"
+                  f" {rate(res, 'edit'):>9} {rate(res, 'typo'):>9} {rate(res, 'none'):>7}")
+    if args.snapshot:
+        print("(mmap rows: 'build s' is the time to open the existing snapshot, i.e. worker cold start)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+"""
+Equivalence check for infer_spice (no network, throwaway database).
+
+    python check_spice.py --cases 20000
+    python check_spice.py --cases 5000 --seed 3 --bench
+
+infer_spice reads cue hits from CueScanner (cached per-message cue masks). This runs the per-regex
+implementation it replaced (legacy_infer_spice, kept verbatim below) and the live one over
+random threads built from cue phrases, slang, emoji, mixed case, empty messages and
+phrases split across message boundaries, and fails on the first (level, debug) mismatch.
+--bench also times both over growing threads, where each request resends the history.
+"""
+import argparse, os, random, re, sys, tempfile, time
+from typing import Any, Dict, List, Tuple
+
+os.environ.setdefault("QR_OPENAI_BASE", "http://127.0.0.1:9/v1")   # app import must not need a key
+os.environ["QR_DB"] = os.path.join(tempfile.mkdtemp(prefix="qr-check-"), "check.db")
+os.environ.setdefault("QR_LOG_LEVEL", "WARNING")
+os.environ["QR_MEM_SNAPSHOT"] = ""
+
+import app  # noqa: E402
+from app import (Msg, expand_slang, MIN_SPICE_FLOOR, CONTEXT_WINDOW, DESIRE_RX, TOUCH_RX, PROX_RX,  # noqa: E402
+                 BODY_RX, PERMISSION_RX, EXCLUSIVE_RX, SENSORY_RX, COMMAND_RX, TEASE_RX, WINK_OR_SMIRK,
+                 EROTIC_Q_RX, READINESS_RX, INVITE_RX, GREEN_UP, RED_DOWN, SPICE4_RX)
+
+def legacy_infer_spice(history: List[Msg], latest: str, k: int = CONTEXT_WINDOW) -> Tuple[int, Dict[str, Any]]:
+    window = history[-k:]
+    window_text = " ".join(m.text for m in window if m.text).lower()
+    window_text = expand_slang(window_text)
+    latest_low  = expand_slang((latest or "").lower())
+
+    score = 1.0
+    hits: List[Tuple[str,str]] = []
+
+    def bump(rx: re.Pattern, w: float, tag: str):
+        nonlocal score
+        if rx.search(window_text):
+            score += w
+            hits.append((tag, "win"))
+
+    bump(DESIRE_RX,     1.0, "desire")
+    bump(TOUCH_RX,      1.0, "touch")
+    bump(PROX_RX,       0.9, "proximity")
+    bump(BODY_RX,       0.7, "body")
+    bump(PERMISSION_RX, 0.4, "permission")
+    bump(EXCLUSIVE_RX,  0.4, "exclusive")
+    bump(SENSORY_RX,    0.6, "sensory")
+    bump(COMMAND_RX,    0.4, "command")
+    bump(TEASE_RX,      0.6, "tease")
+    bump(WINK_OR_SMIRK, 0.8, "wink")
+    bump(EROTIC_Q_RX,   1.2, "erotic_q")
+    bump(READINESS_RX,  0.9, "readiness")
+    bump(INVITE_RX,     0.5, "invite")
+
+    them_text = expand_slang(" ".join(m.text for m in window if m.role=="them")).lower()
+    you_text  = expand_slang(" ".join(m.text for m in window if m.role=="you")).lower()
+    mutual = 0
+    for rx in (DESIRE_RX, TOUCH_RX, PROX_RX, TEASE_RX, WINK_OR_SMIRK, EROTIC_Q_RX, READINESS_RX):
+        if rx.search(them_text) and rx.search(you_text): mutual += 1
+    if mutual:
+        score += 0.45 * mutual
+        hits.append(("mutual", str(mutual)))
+
+    last4 = [m for m in window if m.text][-4:]
+    hot_theirs = sum(1 for m in last4 if m.role=="them" and (
+        DESIRE_RX.search(m.text.lower()) or TOUCH_RX.search(m.text.lower()) or
+        EROTIC_Q_RX.search(m.text.lower()) or READINESS_RX.search(m.text.lower()) or
+        WINK_OR_SMIRK.search(m.text)
+    ))
+    if hot_theirs >= 2:
+        score += 0.8
+        hits.append(("streak", str(hot_theirs)))
+
+    red_hit = False
+    if GREEN_UP.search(window_text): score += 0.6; hits.append(("green_up","1"))
+    if RED_DOWN.search(window_text):
+        score -= 0.35; hits.append(("red_down","1")); red_hit = True
+
+    if any(rx.search(latest_low) for rx in (DESIRE_RX, TOUCH_RX, PROX_RX, TEASE_RX, WINK_OR_SMIRK, EROTIC_Q_RX, READINESS_RX)):
+        score += 0.8; hits.append(("latest_hot","1"))
+
+    if score >= 3.5: lvl = 4
+    elif score >= 2.6: lvl = 3
+    elif score >= 1.8: lvl = 2
+    elif score >= 1.1: lvl = 1
+    else: lvl = 0
+
+    if not red_hit:
+        lvl = max(lvl, MIN_SPICE_FLOOR)
+
+    if lvl >= 3 and (SPICE4_RX.search(window_text) or SPICE4_RX.search(latest_low)):
+        lvl = 4
+        hits.append(("spice4", "trigger"))
+
+    dbg = {"score": round(score,2), "hits": hits[-10:], "latest": latest, "red_hit": red_hit, "level": lvl}
+    return lvl, dbg
+
+PHRASES = [
+    "want you", "need you", "can't wait", "cant wait", "crave", "dying to", "please me", "kiss", "touch", "grab",
+    "pull you", "hold me", "hands on", "lips", "neck", "waist", "come over", "pull up", "at ur place", "now",
+    "tonight", "later", "swing by", "on my way", "omw", "thighs", "skin", "hair", "if you're into it", "should i",
+    "just us", "my place", "warm", "soft", "whisper", "closer", "come", "bring", "sneak", "tease", "behave",
+    "be good", "make you beg", "😉", "😏", ";)", "what are you gonna do to me", "how r you going to please me",
+    "i'm so ready", "im ready", "i’m so ready", "don't keep me waiting", "so when", "let's meet", "set a time",
+    "dare", "bold", "in bed", "miss you", "busy", "tired", "idk", "not sure", "another time", "explore me",
+    "make me yours", "do it to me", "use me", "i'm all yours tonight", "claim me", "ruin me", "touch my",
+    "kiss me everywhere", "come over now", "take me now", "give it to me", "don't stop", "harder",
+    "you can   kiss", "i want you to\tgrab", "mmmm", "god yes", "🍑🍆 tonight", "💦", "no cap", "tl;dr", "wyd",
+    "fr", "ngl", "lol", "hbu", "ikr", "smh", "rn", "tbh", "brb",
+]
+FILLER = ["hey", "so", "yeah", "the", "movie", "coffee", "and", "maybe", "haha", "ok", "you", "me", "i", "me!",
+          "over", "up", "cap", "no", "casino", "wait", "ready", "me?", "...", "İstanbul", "naïve", "123"]
+
+def random_text(rng: random.Random) -> str:
+    if rng.random() < 0.08:
+        return ""
+    toks = []
+    for _ in range(rng.randint(1, 9)):
+        t = rng.choice(PHRASES) if rng.random() < 0.35 else rng.choice(FILLER)
+        if rng.random() < 0.15:
+            t = t.upper() if rng.random() < 0.5 else t.title()
+        toks.append(t)
+    s = " ".join(toks)
+    if rng.random() < 0.1:
+        s = " ".join([s] * rng.randint(3, 8))          # long message, past the seam window
+    if rng.random() < 0.15:
+        s += rng.choice(["", " ", "!", "?", "  ", "\n"])
+    return s
+
+def random_thread(rng: random.Random) -> Tuple[List[Msg], str]:
+    hist = [Msg(role=rng.choice(("them", "you")), text=random_text(rng)) for _ in range(rng.randint(0, 14))]
+    if hist and rng.random() < 0.4:                        # split a phrase across a message boundary
+        i = rng.randrange(len(hist))
+        words = rng.choice(PHRASES).split(" ")
+        if len(words) > 1:
+            cut = rng.randint(1, len(words) - 1)
+            hist[i] = Msg(role=hist[i].role, text=(hist[i].text + " " + " ".join(words[:cut])).strip())
+            hist.insert(i + 1, Msg(role=rng.choice(("them", "you")), text=" ".join(words[cut:])))
+    return hist, random_text(rng)
+
+def check(cases: int, seed: int) -> int:
+    rng = random.Random(seed)
+    for n in range(cases):
+        hist, latest = random_thread(rng)
+        want = legacy_infer_spice(hist, latest)
+        got = app.infer_spice(hist, latest)
+        if want != got:
+            print(f"MISMATCH case {n}\n  history={[(m.role, m.text) for m in hist]}\n  latest={latest!r}"
+                  f"\n  legacy={want}\n  scanner={got}")
+            return 1
+    print(f"{cases} threads: infer_spice matches the per-regex version")
+    return 0
+
+def short_text(rng: random.Random) -> str:
+    toks = [rng.choice(PHRASES) if rng.random() < 0.25 else rng.choice(FILLER) for _ in range(rng.randint(2, 8))]
+    return " ".join(toks)
+
+def bench(threads: int, seed: int):
+    rng = random.Random(seed + 1)
+    convs = [[Msg(role=("them", "you")[i % 2], text=short_text(rng)) for i in range(30)] for _ in range(threads)]
+    for name, fn in (("per-regex", legacy_infer_spice), ("scanner", app.infer_spice)):
+        t0, calls = time.perf_counter(), 0
+        for conv in convs:
+            for i in range(1, len(conv)):                 # every turn resends the thread so far
+                fn(conv[:i], conv[i].text)
+                calls += 1
+        dt = time.perf_counter() - t0
+        print(f"{name:<10} {calls} calls  {1e6 * dt / calls:8.1f} us/call")
+    print("cue cache:", app.CUES.stats())
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--cases", type=int, default=20000)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--bench", action="store_true", help="also time both versions over growing threads")
+    args = ap.parse_args()
+    rc = check(args.cases, args.seed)
+    if rc == 0 and args.bench:
+        bench(200, args.seed)
+    return rc
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,309 @@
+"""
+Commit store: remembered replies keyed by the incoming message they answered.
+
+    { "<latest text>": { "items": [ {"resp", "stage", "heat", "rating", "reason", "ts"}, ... ] } }
+
+Two backends, picked with QR_COMMIT_STORE:
+    sqlite  one row per (key, resp) in the feedback database; upserts go through the
+            group-committing writer in storage.py                                   (default)
+    log     append-only JSON-lines file, replayed at startup and compacted into a fresh
+            file (atomic rename) once it holds COMPACT_RATIO x more lines than live items
+
+Both upsert in O(items for that key), never O(store). A store that starts empty imports
+the legacy qr_commits.json once; the same migration is available from the command line:
+
+    python commit_store.py migrate qr_commits.json [--to sqlite|log] [--db qrizz.db] [--log qr_commits.log]
+    python commit_store.py export out.json
+"""
+import os, json, threading, time, logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from storage import Storage
+
+log = logging.getLogger("qr.commits")
+
+COMMIT_STORE   = os.getenv("QR_COMMIT_STORE", "sqlite").lower()
+COMMIT_LOG     = os.getenv("QR_COMMIT_LOG", "qr_commits.log")
+COMPACT_RATIO  = float(os.getenv("QR_COMMIT_COMPACT_RATIO", "2.0"))  # log lines per live item before compaction
+COMPACT_MIN    = int(os.getenv("QR_COMMIT_COMPACT_MIN", "1000"))     # never compact logs shorter than this
+
+Item = Dict[str, Any]
+
+def merge_items(items: List[Item], recs: List[Item]) -> int:
+    """
+    Merge RECS into ITEMS in place, de-duped by resp. An update keeps the previous rating
+    when the new one is None and the previous reason when the new one is empty.
+    Returns how many were new.
+    """
+    index_by_resp = {it.get("resp"): i for i, it in enumerate(items) if isinstance(it, dict)}
+    added = 0
+    for rec in recs:
+        rec = dict(rec)
+        s = rec.get("resp")
+        if s in index_by_resp:
+            i = index_by_resp[s]
+            old = items[i] if isinstance(items[i], dict) else {}
+            if rec.get("rating") is None:
+                rec["rating"] = old.get("rating")
+            if not rec.get("reason"):
+                rec["reason"] = old.get("reason", "")
+            items[i] = rec
+        else:
+            index_by_resp[s] = len(items)
+            items.append(rec)
+            added += 1
+    return added
+
+class CommitStore:
+    """Interface shared by the backends."""
+    def load_all(self) -> Dict[str, Dict[str, List[Item]]]:
+        raise NotImplementedError
+
+    def get(self, key: str) -> List[Item]:
+        raise NotImplementedError
+
+    def upsert(self, key: str, recs: List[Item]) -> Tuple[List[Item], int]:
+        """Merge RECS under KEY; returns (all items for KEY, number added)."""
+        raise NotImplementedError
+
+    def fingerprint(self) -> str:
+        """Changes whenever the stored data changes (also across processes)."""
+        raise NotImplementedError
+
+    def is_empty(self) -> bool:
+        raise NotImplementedError
+
+    def import_all(self, data: Dict[str, Any]) -> int:
+        n = 0
+        for key, entry in (data or {}).items():
+            items = [it for it in ((entry or {}).get("items") or []) if isinstance(it, dict) and it.get("resp")]
+            if key and items:
+                self.upsert(key, items)
+                n += len(items)
+        return n
+
+    def close(self):
+        pass
+
+# ---------------- SQLite ----------------
+COMMIT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS commit_items(
+  seq    INTEGER PRIMARY KEY,
+  key    TEXT NOT NULL,
+  resp   TEXT NOT NULL,
+  stage  TEXT,
+  heat   INTEGER,
+  rating TEXT,
+  reason TEXT,
+  ts     INTEGER,
+  UNIQUE(key, resp)
+);
+CREATE TABLE IF NOT EXISTS commit_meta(id INTEGER PRIMARY KEY CHECK (id = 1), rev INTEGER NOT NULL);
+INSERT OR IGNORE INTO commit_meta(id, rev) VALUES (1, 0);
+CREATE TRIGGER IF NOT EXISTS commit_items_ins AFTER INSERT ON commit_items
+  BEGIN UPDATE commit_meta SET rev = rev + 1 WHERE id = 1; END;
+CREATE TRIGGER IF NOT EXISTS commit_items_upd AFTER UPDATE ON commit_items
+  BEGIN UPDATE commit_meta SET rev = rev + 1 WHERE id = 1; END;
+CREATE TRIGGER IF NOT EXISTS commit_items_del AFTER DELETE ON commit_items
+  BEGIN UPDATE commit_meta SET rev = rev + 1 WHERE id = 1; END;
+"""
+
+# same merge rules as merge_items(); seq (insertion order) is kept on update
+UPSERT_SQL = """
+INSERT INTO commit_items(key, resp, stage, heat, rating, reason, ts) VALUES (?,?,?,?,?,?,?)
+ON CONFLICT(key, resp) DO UPDATE SET
+  stage  = excluded.stage,
+  heat   = excluded.heat,
+  rating = COALESCE(excluded.rating, commit_items.rating),
+  reason = CASE WHEN excluded.reason != '' THEN excluded.reason ELSE commit_items.reason END,
+  ts     = excluded.ts
+"""
+
+_COLS = ("resp", "stage", "heat", "rating", "reason", "ts")
+
+def _row_to_item(row) -> Item:
+    return dict(zip(_COLS, row))
+
+class SqliteCommitStore(CommitStore):
+    def __init__(self, db: Storage):
+        self.db = db
+        self.db.executescript(COMMIT_SCHEMA)
+
+    def load_all(self):
+        out: Dict[str, Dict[str, List[Item]]] = {}
+        rows = self.db.reader().execute(
+            "SELECT key, resp, stage, heat, rating, reason, ts FROM commit_items ORDER BY key, seq").fetchall()
+        for key, *rest in rows:
+            out.setdefault(key, {"items": []})["items"].append(_row_to_item(rest))
+        return out
+
+    def get(self, key: str) -> List[Item]:
+        rows = self.db.reader().execute(
+            "SELECT resp, stage, heat, rating, reason, ts FROM commit_items WHERE key = ? ORDER BY seq", (key,)).fetchall()
+        return [_row_to_item(r) for r in rows]
+
+    def upsert(self, key, recs):
+        before = self.db.reader().execute("SELECT COUNT(*) FROM commit_items WHERE key = ?", (key,)).fetchone()[0]
+        rows = [(key, r["resp"], r.get("stage"), r.get("heat"), r.get("rating"), r.get("reason") or "", r.get("ts"))
+                for r in recs]
+        self.db.write_many(UPSERT_SQL, rows).result()   # wait for the batch commit; callers are off-loop
+        items = self.get(key)
+        return items, len(items) - before
+
+    def import_all(self, data):
+        rows = [(key, it["resp"], it.get("stage"), it.get("heat"), it.get("rating"), it.get("reason") or "", it.get("ts"))
+                for key, entry in (data or {}).items() if key
+                for it in ((entry or {}).get("items") or []) if isinstance(it, dict) and it.get("resp")]
+        self.db.write_many(UPSERT_SQL, rows).result()   # one transaction
+        return len(rows)
+
+    def fingerprint(self) -> str:
+        rev = self.db.reader().execute("SELECT rev FROM commit_meta WHERE id = 1").fetchone()
+        return f"sqlite:{rev[0] if rev else 0}"
+
+    def is_empty(self) -> bool:
+        return self.db.reader().execute("SELECT 1 FROM commit_items LIMIT 1").fetchone() is None
+
+# ---------------- append-only log ----------------
+class LogCommitStore(CommitStore):
+    """
+    One JSON object per line: {"key": ..., "item": {...}}. Replaying the log through
+    merge_items() rebuilds the store; compaction rewrites one line per live item.
+    """
+    def __init__(self, path: str = COMMIT_LOG, fsync: bool = True):
+        self.path = path
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._data: Dict[str, List[Item]] = {}
+        self._lines = 0
+        self._replay()
+        self._f = open(self.path, "a", encoding="utf-8")
+
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+        bad = 0
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line)
+                    merge_items(self._data.setdefault(rec["key"], []), [rec["item"]])
+                    self._lines += 1
+                except Exception:
+                    bad += 1   # torn tail from a crash mid-append; the rest is intact
+        if bad:
+            log.warning("skipped %d unreadable lines in %s", bad, self.path)
+
+    def _live(self) -> int:
+        return sum(len(v) for v in self._data.values())
+
+    def load_all(self):
+        with self._lock:
+            return {k: {"items": [dict(it) for it in v]} for k, v in self._data.items()}
+
+    def get(self, key):
+        with self._lock:
+            return [dict(it) for it in self._data.get(key, [])]
+
+    def upsert(self, key, recs):
+        with self._lock:
+            items = self._data.setdefault(key, [])
+            added = merge_items(items, recs)
+            by_resp = {it.get("resp"): it for it in items}
+            # log the merged records, so replay never depends on what came before them
+            self._f.write("".join(json.dumps({"key": key, "item": by_resp[r["resp"]]}, ensure_ascii=False) + "\n"
+                                  for r in recs))
+            self._f.flush()
+            if self.fsync:
+                os.fsync(self._f.fileno())
+            self._lines += len(recs)
+            if self._lines >= COMPACT_MIN and self._lines > COMPACT_RATIO * self._live():
+                self._compact_locked()
+            return [dict(it) for it in items], added
+
+    def _compact_locked(self):
+        t0 = time.perf_counter()
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for key, items in self._data.items():
+                for it in items:
+                    f.write(json.dumps({"key": key, "item": it}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._f.close()
+        os.replace(tmp, self.path)
+        self._f = open(self.path, "a", encoding="utf-8")
+        before, self._lines = self._lines, self._live()
+        log.info("compacted %s lines=%d->%d in %.1fms", self.path, before, self._lines, 1000 * (time.perf_counter() - t0))
+
+    def fingerprint(self) -> str:
+        try:
+            st = os.stat(self.path)
+            return f"log:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+        except OSError:
+            return "log:0"
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return not self._data
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+# ---------------- factory / migration ----------------
+def open_commit_store(kind: str = COMMIT_STORE, db: Optional[Storage] = None, log_path: str = COMMIT_LOG) -> CommitStore:
+    if kind == "sqlite":
+        if db is None:
+            raise RuntimeError("sqlite commit store needs a Storage")
+        return SqliteCommitStore(db)
+    if kind == "log":
+        return LogCommitStore(log_path)
+    raise RuntimeError(f"unknown QR_COMMIT_STORE={kind!r} (expected sqlite or log)")
+
+def load_legacy_json(path: str) -> Dict[str, Any]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except FileNotFoundError:
+        return {}
+
+def migrate_if_empty(store: CommitStore, legacy_path: str) -> int:
+    """Import the legacy qr_commits.json into an empty store; no-op afterwards."""
+    if not store.is_empty() or not os.path.exists(legacy_path):
+        return 0
+    t0 = time.perf_counter()
+    n = store.import_all(load_legacy_json(legacy_path))
+    log.info("migrated %d items from %s in %.0fms", n, legacy_path, 1000 * (time.perf_counter() - t0))
+    return n
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("cmd", choices=["migrate", "export"])
+    ap.add_argument("path", help="legacy JSON to import (migrate) or write (export)")
+    ap.add_argument("--to", default=COMMIT_STORE, choices=["sqlite", "log"], help="store backend")
+    ap.add_argument("--db", default=os.getenv("QR_DB", "qrizz.db"))
+    ap.add_argument("--log", default=COMMIT_LOG)
+    ap.add_argument("--force", action="store_true", help="migrate even if the store already has data")
+    args = ap.parse_args()
+
+    storage = Storage(args.db) if args.to == "sqlite" else None
+    store = open_commit_store(args.to, storage, args.log)
+    try:
+        if args.cmd == "migrate":
+            if not args.force and not store.is_empty():
+                raise SystemExit("store is not empty (use --force to merge anyway)")
+            print(f"imported {store.import_all(load_legacy_json(args.path))} items")
+        else:
+            with open(args.path, "w", encoding="utf-8") as f:
+                json.dump(store.load_all(), f, ensure_ascii=False, indent=2)
+            print(f"wrote {args.path}")
+    finally:
+        store.close()
+        if storage is not None:
+            storage.close()
@@ -1,6 +1,31 @@
 // bg.js — relay fetches to bypass page CSP
 const API = "http://127.0.0.1:8000";
 
+const FB_FLUSH_MS = 1000;
+const FB_MAX_BATCH = 50;
+let fbQueue = [];
+let fbTimer = null;
+
+async function flushFeedback() {
+  if (fbTimer) { clearTimeout(fbTimer); fbTimer = null; }
+  if (!fbQueue.length) return;
+  const events = fbQueue;
+  fbQueue = [];
+  try {
+    const r = await fetch(`${API}/feedback/batch`, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ events })
+    });
+    const data = await r.json().catch(() => ({}));
+    if ((!r.ok && r.status !== 422) || data.error === "busy") throw new Error(`status ${r.status}`);
+  } catch (e) {
+    // backend down or busy: keep the events for the next flush (bounded)
+    fbQueue = events.concat(fbQueue).slice(-500);
+    if (!fbTimer) fbTimer = setTimeout(flushFeedback, FB_FLUSH_MS * 5);
+  }
+}
+
 chrome.runtime.onMessage.addListener((msg, _sender, sendResponse) => {
   if (msg?.type === "qr_suggest") {
     (async () => {
@@ -20,20 +45,12 @@ chrome.runtime.onMessage.addListener((msg, _sender, sendResponse) => {
   }
 
   if (msg?.type === "qr_feedback") {
-    (async () => {
-      try {
-        const r = await fetch(`${API}/feedback`, {
-          method: "POST",
-          headers: { "Content-Type": "application/json" },
-          body: JSON.stringify(msg.body || {})
-        });
-        const data = await r.json().catch(() => ({}));
-        sendResponse({ ok: r.ok, status: r.status, data });
-      } catch (e) {
-        sendResponse({ ok: false, status: 0, data: { error: String(e) } });
-      }
-    })();
-    return true;
+    // buffered; flushed to /feedback/batch so a burst of clicks is one request
+    fbQueue.push({ ...(msg.body || {}), ts: Date.now() });
+    if (fbQueue.length >= FB_MAX_BATCH) flushFeedback();
+    else if (!fbTimer) fbTimer = setTimeout(flushFeedback, FB_FLUSH_MS);
+    sendResponse({ ok: true, status: 202, data: { queued: true } });
+    return false;
   }
 
   if (msg?.type === "qr_commit") {
@@ -647,6 +647,21 @@ function saveCtx(arr) {
 }
 
 let ctx = loadCtx();
+
+// Server-side session per thread: after one full send, only new messages go up
+// (append + base = the length the server reported). A new/reset chat also drops its stage floor.
+let __sync = null; // { thread, sent: [{role,text}], len }
+let __syncReset = false;
+function newSince(prev, cur) {
+  // cur continues prev when a suffix of prev (at least 3 msgs, or all of it) starts cur
+  const same = (a, b) => a.role === b.role && a.text === b.text;
+  for (let j = 0; prev.length - j >= Math.min(prev.length, 3) && j < prev.length; j++) {
+    const tail = prev.slice(j);
+    if (tail.length <= cur.length && tail.every((m, i) => same(m, cur[i])))
+      return cur.slice(tail.length);
+  }
+  return null;
+}
 let lastSeenText = "",
   lastSeenRole = "";
 function maybeThreadRotate() {
@@ -670,6 +685,8 @@ function softResetIfNewConversation(latest, history) {
   if (latest.role === "them" && GREETING_RX.test(latest.text) && gapOk) {
     ctx = [{ role: "them", text: latest.text, ts: now }];
     saveCtx(ctx);
+    __sync = null;
+    __syncReset = true;
     return true;
   }
   return false;
@@ -1013,6 +1030,8 @@ function bindStaticHandlersOnce() {
       saveCtx(ctx);
       lastSeenText = "";
       lastSeenRole = "";
+      __sync = null;
+      __syncReset = true;
       showToast("Context reset");
     }
   });
@@ -1078,14 +1097,35 @@ async function requestSuggestions(curCtx) {
       return;
     }
 
-    const payload = {
-      context: ctxTrim
-        .slice(-MAX_TURNS)
-        .map(({ role, text }) => ({ role, text })),
-      n: 3,
-    };
-    const resp = await askBackend("qr_suggest", payload);
+    const msgs = ctxTrim
+      .slice(-MAX_TURNS)
+      .map(({ role, text }) => ({ role, text }));
+    const thread = getThreadId();
+    const payload = { n: 3, site: location.hostname, thread };
+    const delta =
+      __sync && __sync.thread === thread && !__syncReset
+        ? newSince(__sync.sent, msgs)
+        : null;
+    if (delta) {
+      payload.append = delta;
+      payload.base = __sync.len;
+    } else {
+      payload.context = msgs;
+      if (__syncReset) payload.reset = true;
+    }
+    let resp = await askBackend("qr_suggest", payload);
+    if (resp && resp.data && resp.data.error === "resync") {
+      // server lost the thread (restart/expiry) or we drifted: send it all
+      delete payload.append;
+      delete payload.base;
+      payload.context = msgs;
+      resp = await askBackend("qr_suggest", payload);
+    }
     const json = (resp && resp.data) || {};
+    if (json.session) {
+      __sync = { thread, sent: msgs, len: json.session.len };
+      __syncReset = false;
+    }
     const options = Array.isArray(json.options) ? json.options : [];
     window.__qr_stage = json.stage || "banter";
     window.__qr_spice = typeof json.spice === "number" ? json.spice : 1;
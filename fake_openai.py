@@ -0,0 +1,160 @@
+"""
+Local stand-in for the OpenAI chat-completions endpoint, for load tests and offline runs.
+
+    uvicorn fake_openai:app --port 8001
+    QR_OPENAI_BASE=http://127.0.0.1:8001/v1 uvicorn app:app --port 8000
+
+Knobs (env):
+    FAKE_LATENCY_P50_MS   median latency of a completion              (default 400)
+    FAKE_LATENCY_SIGMA    lognormal sigma; 0 = fixed latency           (default 0.5)
+    FAKE_429_RATE         fraction of calls answered with 429          (default 0)
+    FAKE_5XX_RATE         fraction of calls answered with 503          (default 0)
+    FAKE_RETRY_AFTER      retry-after header sent with 429/503         (default "1"; "" = none)
+    FAKE_RPM / FAKE_TPM   limits reported in x-ratelimit-* headers     (default 500 / 200000)
+    FAKE_STREAM_CHUNK     characters per delta when stream=true        (default 6)
+
+GET /stats returns call counts by prompt kind and status; POST /reset zeroes them.
+"""
+import os, json, time, random, asyncio
+from collections import Counter, deque
+from typing import Any, Dict
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+LATENCY_P50_MS = float(os.getenv("FAKE_LATENCY_P50_MS", "400"))
+LATENCY_SIGMA  = float(os.getenv("FAKE_LATENCY_SIGMA", "0.5"))
+RATE_429       = float(os.getenv("FAKE_429_RATE", "0"))
+RATE_5XX       = float(os.getenv("FAKE_5XX_RATE", "0"))
+RETRY_AFTER    = os.getenv("FAKE_RETRY_AFTER", "1")
+FAKE_RPM       = int(os.getenv("FAKE_RPM", "500"))
+FAKE_TPM       = int(os.getenv("FAKE_TPM", "200000"))
+STREAM_CHUNK   = max(1, int(os.getenv("FAKE_STREAM_CHUNK", "6")))
+
+app = FastAPI()
+
+CALLS: Counter = Counter()
+_window: deque = deque()  # (ts, tokens) over the last minute, for x-ratelimit-remaining-*
+
+STAGES = ["opener", "banter", "rapport", "logistics", "plan", "confirm", "wrap"]
+IDEAS = ["come over tonight", "set a time", "flirty teasing escalates", "grab coffee tmr", "movie night at mine"]
+OPTIONS = [
+    "when am i pulling up tonight",
+    "let's grab coffee tmr at 11",
+    "movie and blanket on my couch 😉",
+    "truth or dare, loser owes a kiss",
+    "pasta night at mine, you taste-test",
+    "late walk then warm up at mine",
+    "I’ll pick the spot, you bring the vibes",
+    "bold of you, i like it",
+]
+
+def _latency() -> float:
+    if LATENCY_SIGMA <= 0:
+        return LATENCY_P50_MS / 1000.0
+    return random.lognormvariate(0.0, LATENCY_SIGMA) * LATENCY_P50_MS / 1000.0
+
+def _kind(payload: Dict[str, Any]) -> str:
+    msgs = payload.get("messages") or [{}]
+    system = str(msgs[0].get("content") or "")
+    if system.startswith("Label the dating chat stage"):
+        return "stage"
+    if system.startswith("Summarize the core conversational idea"):
+        return "idea"
+    fmt = json.dumps(payload.get("response_format") or {})
+    if '"stage"' in fmt or "Also label the chat STAGE" in system:
+        return "fused"
+    return "generate"
+
+def _content(kind: str) -> str:
+    if kind == "stage":
+        return random.choice(STAGES)
+    if kind == "idea":
+        return random.choice(IDEAS)
+    opts = random.sample(OPTIONS, 6)
+    if kind == "fused":
+        return json.dumps({"stage": random.choice(STAGES), "idea": random.choice(IDEAS), "options": opts}, ensure_ascii=False)
+    return json.dumps({"options": opts}, ensure_ascii=False)
+
+def _usage(payload: Dict[str, Any], content: str) -> Dict[str, int]:
+    prompt = sum(len(str(m.get("content") or "")) for m in payload.get("messages") or []) // 4
+    completion = max(1, len(content) // 4)
+    return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+
+def _limit_headers(tokens: int) -> Dict[str, str]:
+    now = time.time()
+    _window.append((now, tokens))
+    while _window and now - _window[0][0] > 60:
+        _window.popleft()
+    used_tok = sum(t for _, t in _window)
+    return {
+        "x-ratelimit-limit-requests": str(FAKE_RPM),
+        "x-ratelimit-limit-tokens": str(FAKE_TPM),
+        "x-ratelimit-remaining-requests": str(max(0, FAKE_RPM - len(_window))),
+        "x-ratelimit-remaining-tokens": str(max(0, FAKE_TPM - used_tok)),
+        "x-ratelimit-reset-requests": "1s",
+        "x-ratelimit-reset-tokens": "1s",
+    }
+
+def _error(status: int) -> JSONResponse:
+    CALLS[f"status_{status}"] += 1
+    headers = {"retry-after": RETRY_AFTER} if RETRY_AFTER else {}
+    return JSONResponse({"error": {"message": "injected", "type": "fake"}}, status_code=status, headers=headers)
+
+@app.post("/v1/chat/completions")
+async def chat_completions(req: Request):
+    payload = await req.json()
+    kind = _kind(payload)
+    CALLS["total"] += 1
+    CALLS[kind] += 1
+
+    roll = random.random()
+    if roll < RATE_429:
+        await asyncio.sleep(0.01)
+        return _error(429)
+    if roll < RATE_429 + RATE_5XX:
+        await asyncio.sleep(_latency() / 2)
+        return _error(503)
+
+    content = _content(kind)
+    usage = _usage(payload, content)
+    headers = _limit_headers(usage["total_tokens"])
+    CALLS["status_200"] += 1
+    delay = _latency()
+
+    if payload.get("stream"):
+        CALLS["stream"] += 1
+        pieces = [content[i:i+STREAM_CHUNK] for i in range(0, len(content), STREAM_CHUNK)] or [""]
+        gap = delay / len(pieces)
+
+        async def events():
+            for p in pieces:
+                await asyncio.sleep(gap)
+                chunk = {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": p}}]}
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            yield f"data: {json.dumps({'object': 'chat.completion.chunk', 'choices': [], 'usage': usage})}\n\n"
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+    await asyncio.sleep(delay)
+    body = {
+        "id": f"fake-{CALLS['total']}",
+        "object": "chat.completion",
+        "model": payload.get("model"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": usage,
+    }
+    return JSONResponse(body, headers=headers)
+
+@app.get("/stats")
+def stats():
+    return dict(CALLS)
+
+@app.post("/reset")
+def reset():
+    CALLS.clear()
+    return {"ok": True}
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="127.0.0.1", port=int(os.getenv("FAKE_PORT", "8001")))
@@ -0,0 +1,183 @@
+"""
+HTTP load generator for the QuickRizz backend.
+
+    python loadtest.py --concurrency 16 --requests 400
+    python loadtest.py --duration 30 --mix suggest=8,feedback=1,commit=1 --repeat 0.3
+
+Drives /suggest (or /suggest/stream with --stream), /feedback and /commit with a fixed number of
+concurrent workers and prints p50/p95/p99 latency, throughput and errors per route. If --fake points
+at fake_openai.py, upstream call counts are read from its /stats before and after the run.
+"""
+import argparse, asyncio, json, random, time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import httpx
+
+THEIRS = [
+    "hey", "haha you're funny", "what are you up to tonight?", "i'm in bed rn", "where are you from?",
+    "that's bold", "not sure yet", "brunch sounds great, where are we going?", "wyd tmrw?",
+    "i like that", "can't wait", "so when are we meeting?", "come over now", "lol ok",
+    "what's the plan", "idk maybe later", "you're trouble", "i'm ready for you",
+]
+YOURS = [
+    "hi", "just chilling", "toronto, wbu?", "let's grab coffee", "pull up at 8",
+    "movie night at mine", "you pick", "i'll pick the spot",
+]
+
+def make_context(rng: random.Random, turns: int) -> List[Dict[str, str]]:
+    ctx = []
+    for i in range(turns):
+        role = "them" if (i % 2 == 0) else "you"
+        pool = THEIRS if role == "them" else YOURS
+        ctx.append({"role": role, "text": rng.choice(pool) + ("" if rng.random() < 0.7 else f" {rng.randint(1, 999)}")})
+    if ctx[-1]["role"] != "them":
+        ctx.append({"role": "them", "text": rng.choice(THEIRS)})
+    return ctx
+
+def pct(xs: List[float], p: float) -> float:
+    if not xs:
+        return 0.0
+    xs = sorted(xs)
+    k = min(len(xs) - 1, max(0, int(round(p / 100.0 * (len(xs) - 1)))))
+    return xs[k]
+
+def parse_mix(s: str) -> Dict[str, int]:
+    out = {}
+    for part in s.split(","):
+        if not part.strip():
+            continue
+        name, _, w = part.partition("=")
+        out[name.strip()] = int(w or 1)
+    return out
+
+class Runner:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.lat: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.first_option: List[float] = []
+        self.recent: List[List[Dict[str, str]]] = []
+        mix = parse_mix(args.mix)
+        self.routes = [r for r, w in mix.items() for _ in range(w)]
+        self.sent = 0
+
+    def context(self) -> List[Dict[str, str]]:
+        # --repeat controls how often an earlier context is resent verbatim (cache/coalescing hits)
+        if self.recent and self.rng.random() < self.args.repeat:
+            return self.rng.choice(self.recent)
+        ctx = make_context(self.rng, self.rng.randint(2, self.args.turns))
+        self.recent = (self.recent + [ctx])[-50:]
+        return ctx
+
+    async def suggest(self, client: httpx.AsyncClient) -> bool:
+        body = {"context": self.context(), "n": 3}
+        if self.args.pipeline:
+            body["pipeline"] = self.args.pipeline
+        if not self.args.stream:
+            r = await client.post("/suggest", json=body)
+            return r.status_code == 200 and "options" in r.json()
+        t0 = time.perf_counter()
+        ok = False
+        async with client.stream("POST", "/suggest/stream", json=body) as r:
+            event = None
+            async for line in r.aiter_lines():
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                    if event == "option" and t0 is not None:
+                        self.first_option.append(time.perf_counter() - t0)
+                        t0 = None
+                    ok = ok or event == "final"
+        return r.status_code == 200 and ok
+
+    async def feedback(self, client: httpx.AsyncClient) -> bool:
+        body = {"stage": self.rng.choice(["banter", "logistics", "confirm"]), "latest": self.rng.choice(THEIRS),
+                "option": self.rng.choice(YOURS), "label": self.rng.choice(["clicked", "up", "down"]),
+                "meta": {"source": "loadtest"}}
+        r = await client.post("/feedback", json=body)
+        return r.status_code == 200
+
+    async def commit(self, client: httpx.AsyncClient) -> bool:
+        body = {"text": f"loadtest {self.rng.choice(THEIRS)} {self.rng.randint(1, 50)}",
+                "stage": "banter", "heat": self.rng.randint(0, 4),
+                "options": [{"text": self.rng.choice(YOURS), "rating": self.rng.choice(["Y", "N", None])}]}
+        r = await client.post("/commit", json=body)
+        return r.status_code == 200 and r.json().get("ok", False)
+
+    async def worker(self, client: httpx.AsyncClient, deadline: Optional[float]):
+        while True:
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+            if deadline is None:
+                if self.sent >= self.args.requests:
+                    return
+            self.sent += 1
+            route = self.rng.choice(self.routes)
+            t0 = time.perf_counter()
+            try:
+                ok = await getattr(self, route)(client)
+            except Exception:
+                ok = False
+            self.lat[route].append(time.perf_counter() - t0)
+            if not ok:
+                self.errors[route] += 1
+
+async def fake_stats(url: Optional[str]) -> Dict[str, int]:
+    if not url:
+        return {}
+    try:
+        async with httpx.AsyncClient(base_url=url, timeout=5) as c:
+            return (await c.get("/stats")).json()
+    except Exception:
+        return {}
+
+async def main(args):
+    runner = Runner(args)
+    before = await fake_stats(args.fake)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base, timeout=args.timeout, limits=limits) as client:
+        t0 = time.perf_counter()
+        deadline = t0 + args.duration if args.duration else None
+        await asyncio.gather(*[runner.worker(client, deadline) for _ in range(args.concurrency)])
+        wall = time.perf_counter() - t0
+        try:
+            server = (await client.get("/stats")).json()
+        except Exception:
+            server = {}
+    after = await fake_stats(args.fake)
+
+    total = sum(len(v) for v in runner.lat.values())
+    print(f"\n{total} requests in {wall:.2f}s  ->  {total / wall:.1f} req/s  (concurrency {args.concurrency})")
+    print(f"{'route':<10} {'count':>6} {'err':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for route, xs in sorted(runner.lat.items()):
+        print(f"{route:<10} {len(xs):>6} {runner.errors[route]:>5} "
+              f"{pct(xs, 50) * 1000:>9.1f} {pct(xs, 95) * 1000:>9.1f} {pct(xs, 99) * 1000:>9.1f} {max(xs) * 1000:>9.1f}")
+    if runner.first_option:
+        fo = runner.first_option
+        print(f"first option (stream): p50 {pct(fo, 50) * 1000:.1f} ms  p95 {pct(fo, 95) * 1000:.1f} ms")
+    if after:
+        upstream = after.get("total", 0) - before.get("total", 0)
+        n_suggest = len(runner.lat.get("suggest", []))
+        per = upstream / n_suggest if n_suggest else 0.0
+        kinds = {k: after.get(k, 0) - before.get(k, 0) for k in after if k != "total"}
+        print(f"upstream calls: {upstream} ({per:.2f} per /suggest)  {json.dumps(kinds)}")
+    if server and args.verbose:
+        print(json.dumps(server, indent=2))
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--base", default="http://127.0.0.1:8000", help="backend under test")
+    ap.add_argument("--fake", default="http://127.0.0.1:8001", help="fake_openai.py base for upstream counts ('' to skip)")
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--requests", type=int, default=200, help="total requests (ignored with --duration)")
+    ap.add_argument("--duration", type=float, default=0, help="run for N seconds instead of a request count")
+    ap.add_argument("--mix", default="suggest=8,feedback=1,commit=1", help="route weights")
+    ap.add_argument("--repeat", type=float, default=0.2, help="probability of resending an earlier context")
+    ap.add_argument("--turns", type=int, default=10, help="max turns per generated context")
+    ap.add_argument("--pipeline", choices=["split", "fused"], default=None)
+    ap.add_argument("--stream", action="store_true", help="use /suggest/stream and report time to first option")
+    ap.add_argument("--timeout", type=float, default=60)
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("--verbose", action="store_true", help="also dump the backend's /stats")
+    asyncio.run(main(ap.parse_args()))
@@ -0,0 +1,117 @@
+"""
+Hashed char-n-gram TF-IDF vectors for memory retrieval (QR_MEM_RETRIEVAL=embed).
+
+Every normalized key is cut into character 3- and 4-grams (padded with a space at each
+end), each gram is hashed with crc32 into one of DIM buckets with a hash-derived sign, and
+the bucket weights are (1 + log tf) * idf, L2-normalized. Rows live in one contiguous
+float32 matrix, so a lookup is a single matrix-vector product (cosine similarity) plus an
+argpartition for the top k. Nothing is downloaded: the "model" is the hash and the IDF
+table fitted on the store at build time. Keys appended later (from /commit) reuse that
+IDF; the next full rebuild refits it.
+
+Paraphrases that share most of their characters ("wyd tmrw" / "wyd tomorrow?", typos,
+reordered clauses) still score high here, where word trigrams would miss them.
+"""
+import math, zlib
+from typing import Dict, Iterable, List, Tuple
+
+try:
+    import numpy as np
+except ImportError:   # only needed when embed retrieval is switched on
+    np = None
+
+NGRAM_MIN, NGRAM_MAX = 3, 4
+
+def require_numpy():
+    if np is None:
+        raise RuntimeError("QR_MEM_RETRIEVAL=embed needs numpy (pip install numpy)")
+
+class HashedTfidf:
+    def __init__(self, dim: int = 1024):
+        require_numpy()
+        if dim < 16 or dim & (dim - 1):
+            raise RuntimeError("QR_MEM_EMBED_DIM must be a power of two >= 16")
+        self.dim = dim
+        self.idf = np.ones(dim, dtype=np.float32)
+
+    def _counts(self, text: str) -> Dict[int, float]:
+        t = f" {text} "
+        raw: Dict[int, int] = {}
+        for n in range(NGRAM_MIN, NGRAM_MAX + 1):
+            for i in range(len(t) - n + 1):
+                h = zlib.crc32(t[i:i + n].encode("utf-8"))
+                raw[h] = raw.get(h, 0) + 1
+        out: Dict[int, float] = {}
+        mask = self.dim - 1
+        for h, tf in raw.items():
+            w = 1.0 + math.log(tf)
+            b = h & mask
+            out[b] = out.get(b, 0.0) + (w if h >> 31 else -w)   # sign from the top bit, bucket from the bottom
+        return out
+
+    def fit(self, texts: Iterable[str]):
+        df = np.zeros(self.dim, dtype=np.float64)
+        n = 0
+        for t in texts:
+            n += 1
+            df[list(self._counts(t).keys())] += 1
+        self.idf = (np.log((1.0 + n) / (1.0 + df)) + 1.0).astype(np.float32)
+
+    def encode(self, text: str) -> "np.ndarray":
+        v = np.zeros(self.dim, dtype=np.float32)
+        c = self._counts(text)
+        if c:
+            idx = np.fromiter(c.keys(), dtype=np.int64, count=len(c))
+            v[idx] = np.fromiter(c.values(), dtype=np.float32, count=len(c)) * self.idf[idx]
+            norm = float(np.linalg.norm(v))
+            if norm > 0:
+                v /= norm
+        return v
+
+def top_k(scores: "np.ndarray", k: int, min_sim: float) -> List[Tuple[int, float]]:
+    """Row ids of the K best SCORES at or above MIN_SIM, best first."""
+    n = scores.shape[0]
+    if n == 0 or k <= 0:
+        return []
+    if n > k:
+        idx = np.argpartition(-scores, k - 1)[:k]
+    else:
+        idx = np.arange(n)
+    idx = idx[np.argsort(-scores[idx], kind="stable")]
+    return [(int(i), float(scores[i])) for i in idx if scores[i] >= min_sim]
+
+def as_rows(buf, dim: int) -> "np.ndarray":
+    """Zero-copy float32 rows over BUF (e.g. a snapshot section)."""
+    return np.frombuffer(buf, dtype=np.float32).reshape(-1, dim)
+
+def as_vector(buf) -> "np.ndarray":
+    return np.frombuffer(buf, dtype=np.float32).copy()
+
+class EmbedMatrix:
+    """Append-only rows of unit vectors in a contiguous float32 buffer (capacity doubles)."""
+    def __init__(self, dim: int, capacity: int = 1024):
+        self.dim = dim
+        self._m = np.zeros((max(16, capacity), dim), dtype=np.float32)
+        self.keys: List[str] = []
+        self._rows: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._rows
+
+    def add(self, key: str, vec: "np.ndarray"):
+        if key in self._rows:
+            return                          # vectors depend only on the key text
+        n = len(self.keys)
+        if n == self._m.shape[0]:
+            grown = np.zeros((2 * n, self.dim), dtype=np.float32)
+            grown[:n] = self._m
+            self._m = grown
+        self._m[n] = vec
+        self._rows[key] = n
+        self.keys.append(key)
+
+    def matrix(self) -> "np.ndarray":
+        return self._m[:len(self.keys)]
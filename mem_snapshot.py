@@ -0,0 +1,219 @@
+"""
+On-disk, memory-mapped snapshot of a built MemIndex.
+
+Opening a snapshot costs a header read regardless of store size; pages are faulted in by
+lookups, and every worker mapping the same file shares them through the page cache.
+
+Layout (little-endian): an 8-byte magic, a u32 version, a u32 section count, then a table
+of (8-byte name, u64 offset, u64 length) entries. Sections start 8-byte aligned:
+
+    meta      JSON: source fingerprint, build recipe, counts, LSH shape
+    gram_off  u64[n_grams+1]  offsets into gram_txt; gram ids follow sorted utf-8 order
+    gram_txt  utf-8 gram strings
+    post_off  u64[n_grams+1]  offsets (in entries) into post
+    post      u32 key ids, sorted within each gram
+    key_off   u64[n_keys+1]   offsets into key_txt; key ids follow sorted utf-8 order
+    key_txt   utf-8 key strings
+    kg_off    u64[n_keys+1]   offsets (in entries) into kg
+    kg        u32 gram ids, sorted within each key
+    item_off  u64[n_keys+1]   offsets into items
+    items     utf-8 JSON list of commit items per key
+    lsh_off   u64[bands+1]    offsets (in entries) into lsh_bk / lsh_kid        (lsh only)
+    lsh_bk    i64 band bucket ids, sorted within each band                     (lsh only)
+    lsh_kid   u32 key id per lsh_bk entry                                      (lsh only)
+    emb       f32[n_keys][emb_dim] hashed TF-IDF row per key id                 (embed only)
+    emb_idf   f32[emb_dim] IDF table the rows were built with                  (embed only)
+"""
+import os, json, mmap, struct, bisect
+from array import array
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+MAGIC   = b"QRMEMSN\0"
+VERSION = 1
+_HDR    = struct.Struct("<8sII")
+_TOC    = struct.Struct("<8sQQ")
+
+def _pad8(n: int) -> int:
+    return (8 - n % 8) % 8
+
+def write_snapshot(path: str, meta: Dict[str, Any], grams: Sequence[str],
+                   keys: Sequence[Tuple[str, Sequence[int], List[Dict[str, Any]]]],
+                   band_ids: Optional[Sequence[Optional[Sequence[int]]]] = None, bands: int = 0,
+                   emb: Optional[Tuple[int, Sequence[Any], Any]] = None):
+    """
+    GRAMS: gram string per in-memory gram id. KEYS: (key, gram ids, items) per in-memory
+    key id. BAND_IDS: per key id, its LSH bucket id per band (None = no signature).
+    EMB: (dim, float32 row buffer per key id, float32 idf buffer).
+    Ids are renumbered into sorted order; written to a temp file then renamed over PATH.
+    """
+    gorder = sorted(range(len(grams)), key=lambda i: grams[i].encode("utf-8"))
+    gmap = array("I", bytes(4 * len(grams)))
+    for new, old in enumerate(gorder):
+        gmap[old] = new
+    korder = sorted(range(len(keys)), key=lambda i: keys[i][0].encode("utf-8"))
+    kmap = array("I", bytes(4 * len(keys)))
+    for new, old in enumerate(korder):
+        kmap[old] = new
+
+    sec: Dict[str, bytes] = {}
+    def blob(texts) -> Tuple[bytes, bytes]:
+        off, parts, pos = array("Q", [0]), [], 0
+        for t in texts:
+            b = t.encode("utf-8")
+            parts.append(b); pos += len(b); off.append(pos)
+        return off.tobytes(), b"".join(parts)
+
+    sec["gram_off"], sec["gram_txt"] = blob(grams[i] for i in gorder)
+    key_kg: List[array] = []
+    for old in korder:
+        key_kg.append(array("I", sorted(gmap[g] for g in keys[old][1])))
+    postings: List[List[int]] = [[] for _ in grams]
+    for kid, kg in enumerate(key_kg):          # kid ascending, so each list comes out sorted
+        for g in kg:
+            postings[g].append(kid)
+    poff, post = array("Q", [0]), array("I")
+    for p in postings:
+        post.extend(p); poff.append(len(post))
+    sec["post_off"], sec["post"] = poff.tobytes(), post.tobytes()
+    sec["key_off"], sec["key_txt"] = blob(keys[i][0] for i in korder)
+    kgoff, kg_all = array("Q", [0]), array("I")
+    for kg in key_kg:
+        kg_all.extend(kg); kgoff.append(len(kg_all))
+    sec["kg_off"], sec["kg"] = kgoff.tobytes(), kg_all.tobytes()
+    sec["item_off"], sec["items"] = blob(json.dumps(keys[i][2], ensure_ascii=False) for i in korder)
+    if band_ids is not None:
+        loff, lbk, lkid = array("Q", [0]), array("q"), array("I")
+        for b in range(bands):
+            col = sorted((bks[b], kmap[old]) for old, bks in enumerate(band_ids) if bks is not None)
+            lbk.extend(bk for bk, _ in col); lkid.extend(k for _, k in col); loff.append(len(lbk))
+        sec["lsh_off"], sec["lsh_bk"], sec["lsh_kid"] = loff.tobytes(), lbk.tobytes(), lkid.tobytes()
+    if emb is not None:
+        sec["emb"] = b"".join(emb[1][i] for i in korder)
+        sec["emb_idf"] = bytes(emb[2])
+    meta = dict(meta, n_grams=len(grams), n_keys=len(keys), bands=bands if band_ids is not None else 0,
+                emb_dim=emb[0] if emb is not None else 0)
+    sec = {"meta": json.dumps(meta).encode("utf-8"), **sec}
+
+    names = list(sec)
+    pos = _HDR.size + _TOC.size * len(names)
+    toc = []
+    for n in names:
+        pos += _pad8(pos)
+        toc.append((n, pos, len(sec[n])))
+        pos += len(sec[n])
+    tmp = f"{path}.{os.getpid()}.tmp"   # workers may rebuild concurrently; last rename wins
+    with open(tmp, "wb") as f:
+        f.write(_HDR.pack(MAGIC, VERSION, len(names)))
+        for n, off, ln in toc:
+            f.write(_TOC.pack(n.encode("ascii"), off, ln))
+        for n, off, ln in toc:
+            f.write(b"\0" * (off - f.tell()))
+            f.write(sec[n])
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+class MemSnapshot:
+    """Read-only view over a snapshot file; all lookups go straight to the mapping."""
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mv = memoryview(self._mm)
+        magic, version, n = _HDR.unpack_from(mv, 0)
+        if magic != MAGIC or version != VERSION:
+            mv.release(); self._mm.close()
+            raise ValueError(f"{path}: not a v{VERSION} memory snapshot")
+        self._mv = mv
+        self._sec: Dict[str, memoryview] = {}
+        for i in range(n):
+            name, off, ln = _TOC.unpack_from(mv, _HDR.size + i * _TOC.size)
+            self._sec[name.rstrip(b"\0").decode("ascii")] = mv[off:off + ln]
+        self.meta: Dict[str, Any] = json.loads(bytes(self._sec["meta"]).decode("utf-8"))
+        self.n_grams, self.n_keys = self.meta["n_grams"], self.meta["n_keys"]
+        self.bands = self.meta.get("bands", 0)
+        self.emb_dim = self.meta.get("emb_dim", 0)
+        c = self._cast
+        self._gram_off, self._gram_txt = c("gram_off", "Q"), self._sec["gram_txt"]
+        self._post_off, self._post = c("post_off", "Q"), c("post", "I")
+        self._key_off, self._key_txt = c("key_off", "Q"), self._sec["key_txt"]
+        self._kg_off, self._kg = c("kg_off", "Q"), c("kg", "I")
+        self._item_off, self._items = c("item_off", "Q"), self._sec["items"]
+        if self.bands:
+            self._lsh_off, self._lsh_bk, self._lsh_kid = c("lsh_off", "Q"), c("lsh_bk", "q"), c("lsh_kid", "I")
+
+    def _cast(self, name: str, fmt: str) -> memoryview:
+        return self._sec[name].cast(fmt)
+
+    @staticmethod
+    def _find(off: memoryview, txt: memoryview, n: int, want: bytes) -> int:
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if txt[off[mid]:off[mid + 1]].tobytes() < want:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < n and txt[off[lo]:off[lo + 1]].tobytes() == want:
+            return lo
+        return -1
+
+    def gram_id(self, gram: str) -> int:
+        return self._find(self._gram_off, self._gram_txt, self.n_grams, gram.encode("utf-8"))
+
+    def key_id(self, key: str) -> int:
+        return self._find(self._key_off, self._key_txt, self.n_keys, key.encode("utf-8"))
+
+    def postings(self, gid: int) -> memoryview:
+        return self._post[self._post_off[gid]:self._post_off[gid + 1]]
+
+    def key(self, kid: int) -> str:
+        return self._key_txt[self._key_off[kid]:self._key_off[kid + 1]].tobytes().decode("utf-8")
+
+    def key_grams(self, kid: int) -> memoryview:
+        return self._kg[self._kg_off[kid]:self._kg_off[kid + 1]]
+
+    def key_len(self, kid: int) -> int:
+        return self._kg_off[kid + 1] - self._kg_off[kid]
+
+    def items(self, kid: int) -> List[Dict[str, Any]]:
+        raw = self._items[self._item_off[kid]:self._item_off[kid + 1]].tobytes()
+        return json.loads(raw.decode("utf-8"))
+
+    def lsh_bucket(self, band: int, bucket: int) -> memoryview:
+        lo, hi = self._lsh_off[band], self._lsh_off[band + 1]
+        col = self._lsh_bk[lo:hi]
+        i = bisect.bisect_left(col, bucket)
+        j = bisect.bisect_right(col, bucket, i)
+        return self._lsh_kid[lo + i:lo + j]
+
+    def emb_rows(self) -> memoryview:
+        """Raw f32 rows, n_keys x emb_dim, in key id order."""
+        return self._sec["emb"]
+
+    def emb_idf(self) -> memoryview:
+        return self._sec["emb_idf"]
+
+    def close(self):
+        """Unmap now if no lookup still holds a view; otherwise the mapping goes with the last one."""
+        self._sec.clear()
+        for name in ("_gram_off", "_gram_txt", "_post_off", "_post", "_key_off", "_key_txt", "_kg_off", "_kg",
+                     "_item_off", "_items", "_lsh_off", "_lsh_bk", "_lsh_kid", "_mv"):
+            self.__dict__.pop(name, None)
+        try:
+            self._mm.close()
+        except BufferError:
+            pass
+
+def open_snapshot(path: str, source: Optional[str], recipe: str) -> Optional[MemSnapshot]:
+    """The snapshot at PATH if it was built with RECIPE from SOURCE (None = any source), else None."""
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        snap = MemSnapshot(path)
+    except (OSError, ValueError, KeyError, struct.error):
+        return None
+    if (source is not None and snap.meta.get("source") != source) or snap.meta.get("recipe") != recipe:
+        snap.close()
+        return None
+    return snap
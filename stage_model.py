@@ -0,0 +1,197 @@
+"""
+Local stage classifier: multinomial naive Bayes over word 1- and 2-grams of the latest
+incoming message, so classify_stage can skip its upstream call when the answer is clear.
+
+    python stage_model.py train                      # qrizz.db feedback + commit store -> qr_stage_model.json
+    python stage_model.py train --out m.json --folds 5 --alpha 0.5
+    python stage_model.py predict "omw, see you at 8"
+
+Training rows are (latest, stage) pairs: the stage stored with each feedback event and each
+committed option, majority-voted per distinct latest. Texts go through app._norm_text both
+at training and at serving time. The artifact is plain JSON with a format version; a file
+with another version, an unreadable one, or one whose classes are not all current STAGES
+(stages renamed since training) is ignored and every request goes upstream.
+
+Plain dicts of log-probabilities rather than NumPy arrays: with six classes and a vocabulary
+of a few thousand n-grams, scoring a message is a dozen lookups per class, and the app keeps
+working where NumPy isn't installed.
+
+`train` also runs k-fold cross-validation: for each confidence threshold, how often the
+model would answer locally (coverage) and how often those answers match the stored label.
+The lowest threshold that reaches --target accuracy is saved as meta.min_conf (null if none
+does), which is what QR_STAGE_LOCAL_MIN_CONF=auto uses.
+"""
+import argparse, json, math, os, re, sys, time
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+VERSION    = 1
+KIND       = "nb-w12"
+THRESHOLDS = (0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99, 0.999)
+_WORD_RX   = re.compile(r"[a-z0-9']+")
+
+def features(text: str) -> List[str]:
+    """Distinct word unigrams and bigrams (presence, not counts: messages are short)."""
+    toks = _WORD_RX.findall(text.lower())
+    return list(dict.fromkeys(toks + [f"{a} {b}" for a, b in zip(toks, toks[1:])]))
+
+class StageModel:
+    def __init__(self, classes: Sequence[str], prior: Dict[str, float], lik: Dict[str, Dict[str, float]],
+                 meta: Optional[Dict[str, object]] = None):
+        self.classes = list(classes)
+        self.prior = prior            # class -> log P(class)
+        self.lik = lik                # class -> feature -> log P(feature | class)
+        self.meta = dict(meta or {})
+        self.vocab = set().union(*(d.keys() for d in lik.values())) if lik else set()
+
+    @classmethod
+    def train(cls, rows: Iterable[Tuple[str, str]], alpha: float = 1.0, **meta) -> "StageModel":
+        counts: Dict[str, Counter] = defaultdict(Counter)
+        docs: Counter = Counter()
+        for text, stage in rows:
+            docs[stage] += 1
+            counts[stage].update(features(text))
+        if not docs:
+            raise RuntimeError("no labelled rows to train the stage model on")
+        vocab = set().union(*counts.values())
+        n = sum(docs.values())
+        classes = sorted(docs)
+        prior = {c: math.log(docs[c] / n) for c in classes}
+        lik: Dict[str, Dict[str, float]] = {}
+        for c in classes:
+            denom = math.log(sum(counts[c].values()) + alpha * len(vocab))
+            lik[c] = {f: math.log(counts[c][f] + alpha) - denom for f in vocab}
+        return cls(classes, prior, lik, dict(meta, rows=n, vocab=len(vocab), alpha=alpha,
+                                             per_class={c: docs[c] for c in classes}))
+
+    def scores(self, text: str) -> Dict[str, float]:
+        feats = [f for f in features(text) if f in self.vocab]   # unseen n-grams carry no evidence
+        return {c: self.prior[c] + sum(self.lik[c][f] for f in feats) for c in self.classes}
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """(stage, posterior probability of that stage)."""
+        s = self.scores(text)
+        top = max(s.values())
+        z = sum(math.exp(v - top) for v in s.values())
+        best = max(self.classes, key=lambda c: s[c])
+        return best, 1.0 / z
+
+    def to_json(self) -> Dict[str, object]:
+        return {"version": VERSION, "kind": KIND, "classes": self.classes, "prior": self.prior,
+                "lik": self.lik, "meta": self.meta}
+
+    def save(self, path: str):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.to_json(), f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+def load_model(path: str, stages: Optional[Sequence[str]] = None) -> Optional[StageModel]:
+    """The model at PATH, or None if it is missing, unreadable, another format version or has classes outside STAGES."""
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            d = json.load(f)
+        if d.get("version") != VERSION or d.get("kind") != KIND:
+            return None
+        if stages is not None and not set(d["classes"]) <= set(stages):
+            return None
+        return StageModel(d["classes"], d["prior"], d["lik"], d.get("meta"))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def majority(pairs: Iterable[Tuple[str, str]], stages: Sequence[str]) -> List[Tuple[str, str]]:
+    """One row per distinct text, labelled with its most frequent stage (ties: the later stage)."""
+    votes: Dict[str, Counter] = defaultdict(Counter)
+    for text, stage in pairs:
+        if text and stage in stages:
+            votes[text][stage] += 1
+    order = {s: i for i, s in enumerate(stages)}
+    return [(t, max(v, key=lambda s: (v[s], order[s]))) for t, v in votes.items()]
+
+def cross_validate(rows: List[Tuple[str, str]], folds: int, alpha: float,
+                   thresholds: Sequence[float]) -> List[Tuple[float, float, float]]:
+    """(threshold, coverage, accuracy on covered rows) from FOLDS-fold cross-validation."""
+    preds: List[Tuple[float, bool]] = []
+    for k in range(folds):
+        train = [r for i, r in enumerate(rows) if i % folds != k]
+        test = [r for i, r in enumerate(rows) if i % folds == k]
+        if not train or not test:
+            continue
+        m = StageModel.train(train, alpha)
+        for text, stage in test:
+            got, conf = m.predict(text)
+            preds.append((conf, got == stage))
+    out = []
+    for th in thresholds:
+        kept = [ok for conf, ok in preds if conf >= th]
+        out.append((th, len(kept) / len(preds) if preds else 0.0, sum(kept) / len(kept) if kept else 0.0))
+    return out
+
+def calibrate(cv: Sequence[Tuple[float, float, float]], target: float, min_cover: float) -> Optional[float]:
+    """Lowest threshold whose cross-validated accuracy reaches TARGET on at least MIN_COVER of rows."""
+    for th, cov, acc in cv:
+        if acc >= target and cov >= min_cover:
+            return th
+    return None
+
+def _training_rows(app) -> List[Tuple[str, str]]:
+    pairs: List[Tuple[str, str]] = []
+    for latest, stage in app.DB.reader().execute("SELECT latest, stage FROM feedback"):
+        pairs.append((app._norm_text(latest or ""), stage))
+    for key, rec in app.COMMIT_STORE.load_all().items():
+        for it in (rec.get("items") or []):
+            if isinstance(it, dict):
+                pairs.append((app._norm_text(key), it.get("stage")))
+    return majority(pairs, app.STAGES)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    tr = sub.add_parser("train", help="fit on the feedback table and commit store, write the artifact")
+    tr.add_argument("--out", default=None, help="artifact path (default: QR_STAGE_MODEL)")
+    tr.add_argument("--alpha", type=float, default=1.0, help="add-alpha smoothing")
+    tr.add_argument("--folds", type=int, default=5, help="cross-validation folds (0 = skip; min_conf stays null)")
+    tr.add_argument("--target", type=float, default=0.9, help="accuracy a threshold must reach to become min_conf")
+    tr.add_argument("--min-cover", type=float, default=0.05, help="...on at least this share of rows")
+    pr = sub.add_parser("predict", help="classify a message with the saved artifact")
+    pr.add_argument("text")
+    pr.add_argument("--model", default=None)
+    args = ap.parse_args()
+
+    os.environ.setdefault("QR_OPENAI_BASE", "http://127.0.0.1:9/v1")   # app import must not need a key
+    os.environ.setdefault("QR_LOG_LEVEL", "WARNING")
+    import app  # noqa: E402  (for _norm_text, the DB and the commit store)
+
+    if args.cmd == "predict":
+        m = load_model(args.model or app.STAGE_MODEL_PATH, app.STAGES)
+        if m is None:
+            print("no usable model; run: python stage_model.py train")
+            return 1
+        stage, conf = m.predict(app._norm_text(args.text))
+        print(f"{stage} {conf:.3f}")
+        return 0
+
+    rows = _training_rows(app)
+    print(f"{len(rows)} labelled texts: {dict(Counter(s for _, s in rows))}")
+    cv: List[Tuple[float, float, float]] = []
+    if args.folds > 1:
+        cv = cross_validate(rows, args.folds, args.alpha, THRESHOLDS)
+        print(f"{'min conf':>8} {'local':>7} {'accuracy':>9}   ({args.folds}-fold)")
+        for th, cov, acc in cv:
+            print(f"{th:>8.3f} {cov:>7.1%} {acc:>9.1%}")
+    min_conf = calibrate(cv, args.target, args.min_cover)
+    m = StageModel.train(rows, args.alpha, trained_at=int(time.time()), source=app.DB_PATH,
+                         min_conf=min_conf, target=args.target, cv=[list(r) for r in cv])
+    out = args.out or app.STAGE_MODEL_PATH
+    m.save(out)
+    print(f"wrote {out} ({m.meta['vocab']} features)")
+    if min_conf is None:
+        print(f"no threshold reached {args.target:.0%} accuracy: with QR_STAGE_LOCAL_MIN_CONF=auto every request still asks the LLM")
+    else:
+        print(f"min_conf {min_conf}: requests at or above it skip the LLM stage call")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,216 @@
+"""
+SQLite access for the QuickRizz backend.
+
+    DB = Storage("qrizz.db")
+    DB.executescript(SCHEMA)                          # synchronous, at startup
+    DB.write("INSERT INTO t VALUES (?)", (1,))        # queued; returns a Future
+    DB.write_many("INSERT INTO t VALUES (?)", rows)   # one queued item, many rows
+    DB.reader().execute("SELECT ...")                 # per-thread read connection
+
+The database runs in WAL mode so readers never block the writer. All writes go through one
+background thread that drains the queue and commits everything it picked up in a single
+transaction (group commit), so a burst of N inserts costs one fsync instead of N and callers
+only pay for a queue put.
+"""
+import os, sqlite3, threading, queue, time, logging
+from concurrent.futures import Future
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+log = logging.getLogger("qr.storage")
+
+BATCH_MAX     = int(os.getenv("QR_DB_BATCH_MAX", "1000"))       # max queued writes per transaction
+BATCH_WAIT_MS = float(os.getenv("QR_DB_BATCH_WAIT_MS", "5"))    # linger after the first write to grow the batch
+QUEUE_SIZE    = int(os.getenv("QR_DB_QUEUE_SIZE", "100000"))    # pending writes before write() raises queue.Full
+SYNCHRONOUS   = os.getenv("QR_DB_SYNCHRONOUS", "NORMAL").upper() # NORMAL is durable across app crashes in WAL mode
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    f"PRAGMA synchronous={SYNCHRONOUS}",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",       # ~16 MB page cache per connection
+    "PRAGMA wal_autocheckpoint=1000",
+)
+
+_Item = Tuple[str, Any, bool, Optional[Future]]   # (sql, params or rows, many, future)
+_STOP = object()
+
+class Storage:
+    def __init__(self, path: str, batch_max: int = BATCH_MAX, batch_wait_ms: float = BATCH_WAIT_MS,
+                 queue_size: int = QUEUE_SIZE):
+        self.path = path
+        self.batch_max = max(1, batch_max)
+        self.batch_wait = max(0.0, batch_wait_ms) / 1000.0
+        self._q: "queue.Queue" = queue.Queue(maxsize=max(0, queue_size))
+        self._local = threading.local()
+        self._readers: List[sqlite3.Connection] = []
+        self._readers_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._closed = False
+        self.counters: Dict[str, float] = {"writes": 0, "rows": 0, "batches": 0, "max_batch": 0,
+                                           "errors": 0, "commit_seconds": 0.0}
+
+    # ---- connections ----
+    def connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False)
+        for p in PRAGMAS:
+            db.execute(p)
+        return db
+
+    def reader(self) -> sqlite3.Connection:
+        """Connection owned by the calling thread; WAL readers see the last committed batch."""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = self.connect()
+            db.execute("PRAGMA query_only=1")
+            with self._readers_lock:
+                self._readers.append(db)
+        return db
+
+    def executescript(self, sql: str):
+        """Schema/DDL, run synchronously on a throwaway connection before the writer starts."""
+        db = self.connect()
+        try:
+            db.executescript(sql)
+            db.commit()
+        finally:
+            db.close()
+
+    # ---- writes ----
+    def _ensure_writer(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="qr-db-writer", daemon=True)
+                self._thread.start()
+
+    def _put(self, item: _Item) -> Future:
+        if self._closed:
+            raise RuntimeError("storage is closed")
+        self._ensure_writer()
+        self._q.put_nowait(item)   # never block the caller (often the event loop); shed load instead
+        return item[3]
+
+    def write(self, sql: str, params: Sequence[Any] = ()) -> Future:
+        """Queue one statement; the Future resolves once its batch is committed."""
+        return self._put((sql, tuple(params), False, Future()))
+
+    def write_many(self, sql: str, rows: Iterable[Sequence[Any]]) -> Future:
+        return self._put((sql, [tuple(r) for r in rows], True, Future()))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Block until everything queued so far is committed."""
+        if self._thread is None:
+            return True
+        try:
+            self._put(("", (), False, Future())).result(timeout)   # no-op marker behind everything queued
+            return True
+        except Exception:
+            return False
+
+    def close(self, timeout: float = 5.0):
+        if self._closed:
+            return
+        self.flush(timeout)
+        self._closed = True
+        if self._thread is not None:
+            self._q.put(_STOP)
+            self._thread.join(timeout)
+        with self._readers_lock:
+            for db in self._readers:
+                _close_quietly(db)
+            self._readers.clear()
+
+    # ---- writer thread ----
+    def _drain(self, first: _Item) -> Tuple[List[_Item], bool]:
+        batch, stop = [first], False
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_max:
+            try:
+                item = self._q.get_nowait()
+            except queue.Empty:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                try:
+                    item = self._q.get(timeout=left)
+                except queue.Empty:
+                    break
+            if item is _STOP:
+                stop = True
+                break
+            batch.append(item)
+        return batch, stop
+
+    @staticmethod
+    def _apply(db: sqlite3.Connection, item: _Item) -> int:
+        sql, args, many, _ = item
+        if not sql:
+            return 0
+        if many:
+            db.executemany(sql, args)
+            return len(args)
+        db.execute(sql, args)
+        return 1
+
+    def _commit(self, db: sqlite3.Connection, batch: List[_Item]):
+        t0 = time.perf_counter()
+        rows = 0
+        try:
+            db.execute("BEGIN")
+            for item in batch:
+                rows += self._apply(db, item)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            if len(batch) == 1:
+                self.counters["errors"] += 1
+                log.warning("write failed: %s", e, extra={"data": {"sql": batch[0][0][:120]}})
+                _resolve(batch[0][3], e)
+                return
+            # one bad statement must not take the rest of the batch down: retry them one by one
+            for item in batch:
+                self._commit(db, [item])
+            return
+        for item in batch:
+            _resolve(item[3])
+        dt = time.perf_counter() - t0
+        c = self.counters
+        c["writes"] += len(batch); c["rows"] += rows; c["batches"] += 1
+        c["max_batch"] = max(c["max_batch"], len(batch)); c["commit_seconds"] += dt
+
+    def _run(self):
+        db = self.connect()
+        db.isolation_level = None   # explicit BEGIN/COMMIT per batch
+        try:
+            while True:
+                first = self._q.get()
+                if first is _STOP:
+                    break
+                batch, stop = self._drain(first)
+                self._commit(db, batch)
+                if stop:
+                    break
+        finally:
+            _close_quietly(db)
+
+    def stats(self) -> Dict[str, float]:
+        out = dict(self.counters)
+        out["queued"] = self._q.qsize()
+        return out
+
+def _close_quietly(db: sqlite3.Connection):
+    try:
+        db.close()
+    except Exception:
+        pass
+
+def _resolve(fut: Future, exc: Optional[BaseException] = None):
+    if fut.done():   # caller cancelled it; nothing to report
+        return
+    if exc is None:
+        fut.set_result(None)
+    else:
+        fut.set_exception(exc)